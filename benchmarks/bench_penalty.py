@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+bench_penalty.py
+
+Compares the incremental penalty index against the full recomputation over the history.
+Run from the repository root: python -m benchmarks.bench_penalty
+"""
+
+import time
+import random
+import argparse
+import collections
+
+from dopq_server.model.model_helper import ModelHelper
+
+
+FakeContainer = collections.namedtuple('FakeContainer', ['user', 'created_at'])
+
+
+def build_history(helper, users, length):
+    """
+    fill the history of helper with length finished containers, pushing them one by one like the queue does
+    :return: time spent for all pushes in seconds
+    """
+    history = []
+    helper.set_dopq_history(history)
+    start = time.time()
+    for i in range(length):
+        helper.add_to_history(FakeContainer(random.choice(users), str(i)))
+    return time.time() - start
+
+
+def time_sort(helper, queue, key_fn, repeats):
+    start = time.time()
+    for _ in range(repeats):
+        ordering = sorted(queue, key=key_fn)
+    return (time.time() - start) / repeats, ordering
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__)
+    arg_parser.add_argument('--history', type=int, default=10000, help='number of history entries')
+    arg_parser.add_argument('--queue', type=int, default=100, help='number of enqueued containers')
+    arg_parser.add_argument('--users', type=int, default=8, help='number of distinct users')
+    arg_parser.add_argument('--repeats', type=int, default=5, help='number of sorts to average over')
+    args = arg_parser.parse_args()
+
+    random.seed(0)
+    users = ['user{}'.format(i) for i in range(args.users)]
+    helper = ModelHelper()
+    push_time = build_history(helper, users, args.history)
+    queue = [FakeContainer(random.choice(users), str(i)) for i in range(args.queue)]
+
+    def full_sort_fn(container):
+        return helper.calc_penalty_full(container.user), container.created_at
+
+    full_time, full_order = time_sort(helper, queue, full_sort_fn, args.repeats)
+    index_time, index_order = time_sort(helper, queue, helper.sort_fn, args.repeats)
+
+    max_error = max(abs(helper.calc_penalty(u) - helper.calc_penalty_full(u)) for u in users)
+
+    print("history={} queue={} users={}".format(args.history, args.queue, args.users))
+    print("pushing {} history entries: {:.4f}s".format(args.history, push_time))
+    print("sort per tick, full recomputation: {:.6f}s".format(full_time))
+    print("sort per tick, penalty index:      {:.6f}s".format(index_time))
+    print("speedup: {:.1f}x".format(full_time / max(index_time, 1e-9)))
+    print("identical ordering: {}, max penalty deviation: {:.3e}".format(full_order == index_order, max_error))
+
+
+if __name__ == '__main__':
+    main()
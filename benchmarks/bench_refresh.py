@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+bench_refresh.py
+
+Measures how long it takes to inspect many containers, one blocking docker-py call after the other versus
+concurrently through the asyncio engine. Both talk to a fake daemon on a unix socket that answers every request
+after a fixed latency.
+Run from the repository root: python -m benchmarks.bench_refresh
+"""
+
+import os
+import time
+import uuid
+import argparse
+import tempfile
+
+import docker
+
+from benchmarks.fake_docker import FakeDockerSocket
+from dopq_server.model.docker_helper.async_engine import SyncEngine
+
+
+def time_calls(fn, repeats):
+    durations = []
+    for _ in range(repeats):
+        start = time.time()
+        fn()
+        durations.append(time.time() - start)
+    return min(durations), sum(durations) / len(durations)
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__)
+    arg_parser.add_argument('--containers', type=int, default=64, help='number of containers to inspect')
+    arg_parser.add_argument('--latency', type=float, default=10, help='daemon latency per request in ms')
+    arg_parser.add_argument('--connections', type=int, default=16, help='connections of the asyncio engine')
+    arg_parser.add_argument('--repeats', type=int, default=5, help='number of refreshes to average over')
+    args = arg_parser.parse_args()
+
+    container_ids = [uuid.uuid4().hex + uuid.uuid4().hex for _ in range(args.containers)]
+    socket_path = os.path.join(tempfile.mkdtemp(), 'docker.sock')
+    server = FakeDockerSocket(socket_path, container_ids, latency=args.latency / 1000.0).start()
+
+    api = docker.APIClient(base_url='unix://' + socket_path, version=docker.constants.DEFAULT_DOCKER_API_VERSION)
+    engine = SyncEngine(socket_path, api.api_version, max_connections=args.connections)
+
+    def sequential():
+        return [api.inspect_container(container_id) for container_id in container_ids]
+
+    def concurrent():
+        return engine.inspect_many(container_ids)
+
+    assert sequential() == concurrent(), 'both paths have to return the same snapshots'
+    sequential_best, sequential_mean = time_calls(sequential, args.repeats)
+    concurrent_best, concurrent_mean = time_calls(concurrent, args.repeats)
+
+    print("containers={} latency={}ms connections={}".format(args.containers, args.latency, args.connections))
+    print("sequential docker-py inspect:  best {:.1f} ms, mean {:.1f} ms".format(
+        sequential_best * 1000, sequential_mean * 1000))
+    print("asyncio engine inspect_many:   best {:.1f} ms, mean {:.1f} ms".format(
+        concurrent_best * 1000, concurrent_mean * 1000))
+    print("speedup:                       {:.1f}x".format(sequential_mean / concurrent_mean))
+
+    engine.close()
+    api.close()
+    server.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+bench_scheduler.py
+
+Drives DopQContainer with a synthetic workload against the fake docker backend and reports scheduling metrics.
+Durations and arrivals are given in simulated seconds and are scaled to real time with --time-scale.
+Run from the repository root: python -m benchmarks.bench_scheduler
+"""
+
+import os
+import sys
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import contextlib
+import collections
+import configparser
+
+from benchmarks import fake_docker
+from dopq_server.model.utils import gpu_backend
+
+
+Job = collections.namedtuple('Job', ['arrival', 'duration', 'num_gpus', 'user'])
+
+
+def parse_mix(mix):
+    """
+    :param mix: string like '0:0.2,1:0.5,2:0.2,4:0.1' mapping gpu counts to probabilities
+    :return: tuple of (gpu counts, weights)
+    """
+    counts, weights = [], []
+    for item in mix.split(','):
+        count, weight = item.split(':')
+        counts.append(int(count))
+        weights.append(float(weight))
+    return counts, weights
+
+
+def generate_workload(num_jobs, arrival_rate, mean_duration, gpu_mix, users, rng):
+    """
+    poisson arrivals with exponentially distributed durations
+    :return: list of Job tuples sorted by arrival
+    """
+    counts, weights = parse_mix(gpu_mix)
+    jobs, arrival = [], 0.0
+    for _ in range(num_jobs):
+        arrival += rng.expovariate(arrival_rate) if arrival_rate > 0 else 0.0
+        jobs.append(Job(arrival=arrival,
+                        duration=rng.expovariate(1.0 / mean_duration),
+                        num_gpus=rng.choices(counts, weights)[0],
+                        user=rng.choice(users)))
+    return jobs
+
+
+def write_config(path, work_dir, sleep_interval, backfill, num_gpus=8, topology='', topology_aware=True):
+    config = configparser.ConfigParser()
+    config['paths'] = {'container.dir': work_dir, 'network.dir': work_dir, 'unzip.dir': work_dir,
+                       'log.dir': work_dir, 'history.dir': work_dir, 'failed.dir': work_dir,
+                       'user_database.dir': os.path.join(work_dir, 'users.db')}
+    config['queue'] = {'max.history': '500', 'verbose': 'no', 'sleep.interval': str(sleep_interval),
+                       'max.gpu.assignment': '1', 'backfill': 'yes' if backfill else 'no',
+                       'memory.headroom': '0g', 'gpu.backend': 'fake', 'gpu.fake.count': str(num_gpus),
+                       'gpu.fake.topology': topology, 'gpu.topology': 'yes' if topology_aware else 'no',
+                       'cpu.pinning': 'yes'}
+    config['docker'] = {'mount.volumes': '', 'remove': 'yes', 'network.mode': 'host', 'mem.limit': '32g',
+                        'logging.interval': '10'}
+    config['fetcher'] = {'valid.executors': 'bench', 'min.space': '0.05', 'remove.invalid.containers': 'yes',
+                         'sleep.interval': '10'}
+    config['builder'] = {'sleep.interval': '10', 'load.suffix': 'tar', 'build.suffix': 'zip'}
+    with open(path, 'w') as conf:
+        config.write(conf)
+
+
+def percentile(values, q):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100.0 * (len(values) - 1))))]
+
+
+def run(args):
+    client = fake_docker.install(num_gpus=args.gpus)
+
+    # imported after the fakes are installed, so that all module level lookups see them
+    from dopq_server.model.docker_pq_model import DopQContainer
+    from dopq_server.model.utils.memory import parse_memory
+    from dopq_server.model.utils.numa import CoreLedger, parse_cpu_list
+    from dopq_server.model.container_handler.container import Container
+    from dopq_server.model.container_handler.container_config import ContainerConfig
+
+    rng = random.Random(args.seed)
+    users = ['user{}'.format(i) for i in range(args.users)]
+    jobs = generate_workload(args.jobs, args.arrival_rate, args.mean_duration, args.gpu_mix, users, rng)
+
+    work_dir = tempfile.mkdtemp(prefix='dopq_bench_')
+    configfile = os.path.join(work_dir, 'config.ini')
+    write_config(configfile, work_dir, args.sleep, not args.no_backfill, args.gpus, args.topology,
+                 not args.no_topology)
+
+    tick_times, decisions, submit_times = [], [0], {}
+    try:
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            pq = DopQContainer(configfile=configfile, logfile=os.path.join(work_dir, 'dopq.log'))
+            pq.memory_ledger.capacity = parse_memory(args.host_memory)
+            # fake host with one numa node per fake socket, so that pinning does not depend on the machine
+            numa_nodes = gpu_backend.get_backend().numa_nodes()
+            num_nodes = max(numa_nodes.values()) + 1 if numa_nodes else 1
+            pq.core_ledger = CoreLedger(dict((node, range(node * args.host_cores // num_nodes,
+                                                          (node + 1) * args.host_cores // num_nodes))
+                                             for node in range(num_nodes)))
+
+            schedule_tick = pq.schedule_tick
+
+            def timed_tick():
+                start = time.perf_counter()
+                started = schedule_tick()
+                tick_times.append(time.perf_counter() - start)
+                decisions[0] += len(started)
+                return started
+
+            pq.schedule_tick = timed_tick
+            pq.start_dopq_process()
+
+            begin = time.time()
+            for i, job in enumerate(jobs):
+                delay = begin + job.arrival * args.time_scale - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+                image_id = 'bench-image-{}'.format(i)
+                client.durations[image_id] = job.duration * args.time_scale
+                config = ContainerConfig(name='bench-{}'.format(i), executor_name=job.user, num_gpus=job.num_gpus,
+                                         num_slots=1, required_memory=args.job_memory)
+                container = Container(config, image_id)
+                submit_times[container.job_id] = time.time()
+                pq.queue.put(container)
+
+            deadline = time.time() + args.timeout
+            while len(client.finish_times) < len(jobs) and time.time() < deadline:
+                time.sleep(0.05)
+            end = time.time()
+
+            pq.terminating_flag = True
+            pq.dopq_stop()
+            topology = gpu_backend.get_backend().topology()
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    waits = [(client.start_times[job_id] - submitted) / args.time_scale
+             for job_id, submitted in submit_times.items() if job_id in client.start_times]
+    makespan = end - begin
+    total_tick_time = sum(tick_times)
+
+    print("jobs={} gpus={} users={} backfill={} time_scale={}".format(
+        args.jobs, args.gpus, args.users, not args.no_backfill, args.time_scale))
+    print("finished jobs:              {}/{}".format(len(client.finish_times), len(jobs)))
+    print("scheduling ticks:           {}".format(len(tick_times)))
+    print("tick latency mean/p95/max:  {:.3f} / {:.3f} / {:.3f} ms".format(
+        1e3 * total_tick_time / max(len(tick_times), 1), 1e3 * percentile(tick_times, 95),
+        1e3 * max(tick_times or [0])))
+    print("decisions per second:       {:.1f}".format(decisions[0] / max(total_tick_time, 1e-9)))
+    print("submit to start mean/p95:   {:.1f} / {:.1f} s (simulated)".format(
+        sum(waits) / max(len(waits), 1), percentile(waits, 95)))
+    print("gpu utilization:            {:.1f}%".format(
+        100.0 * client.gpu_busy_seconds / max(args.gpus * makespan, 1e-9)))
+    print("makespan:                   {:.1f} s (simulated)".format(makespan / args.time_scale))
+    print("docker calls:               {}".format(dict(client.calls)))
+    if topology:
+        # worst link inside the gpu set of each multi gpu job
+        links = collections.Counter(
+            max((topology[a][b] for a in minors for b in minors if a != b), key=gpu_backend.link_cost)
+            for minors in client.assignments.values() if len(minors) > 1)
+        print("worst link of multi gpu jobs: {}".format(dict(links)))
+    if numa_nodes:
+        local = [set(parse_cpu_list(client.cpusets[job_id][1])) <= set(numa_nodes[minor] for minor in minors)
+                 for job_id, minors in client.assignments.items() if minors]
+        print("gpu jobs on local numa nodes: {}/{}".format(sum(local), len(local)))
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument('--jobs', type=int, default=200, help='number of submitted jobs')
+    arg_parser.add_argument('--gpus', type=int, default=8, help='number of fake gpus')
+    arg_parser.add_argument('--users', type=int, default=6, help='number of distinct users')
+    arg_parser.add_argument('--arrival-rate', type=float, default=0.05, help='jobs per simulated second, 0 = burst')
+    arg_parser.add_argument('--mean-duration', type=float, default=600, help='mean job duration in simulated seconds')
+    arg_parser.add_argument('--gpu-mix', default='0:0.2,1:0.5,2:0.2,4:0.1', help='gpu count:probability pairs')
+    arg_parser.add_argument('--job-memory', default='4g', help='required memory per job')
+    arg_parser.add_argument('--host-memory', default='512g', help='host memory seen by the admission control')
+    arg_parser.add_argument('--host-cores', type=int, default=32, help='cpu cores of the fake host')
+    arg_parser.add_argument('--time-scale', type=float, default=0.001, help='real seconds per simulated second')
+    arg_parser.add_argument('--sleep', type=int, default=1, help='safety net sleep interval of the queue')
+    arg_parser.add_argument('--timeout', type=float, default=120, help='real seconds to wait for all jobs')
+    arg_parser.add_argument('--no-backfill', action='store_true', help='disable backfill scheduling')
+    arg_parser.add_argument('--topology', default='nvlink=2,socket=4', help='fake gpu topology, empty for unknown')
+    arg_parser.add_argument('--no-topology', action='store_true', help='assign the lowest free minors')
+    arg_parser.add_argument('--seed', type=int, default=0)
+    run(arg_parser.parse_args())
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,540 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+fake_docker.py
+
+In-memory stand-ins for the docker client and the GPUs, so that the queue can be driven without a docker daemon or
+real GPUs. Containers "run" for a given duration on a timer and emit docker events on exit.
+"""
+
+import copy
+import json
+import time
+import queue
+import asyncio
+import uuid
+import threading
+import collections
+import urllib.parse
+
+import docker
+
+from dopq_server.model.utils import gpu_backend
+from dopq_server.model.docker_helper import docker_client, stats_collector
+
+
+class FakeImage(object):
+    def __init__(self, image_id):
+        self.id = image_id
+        self.tags = [image_id]
+
+
+class FakeImages(object):
+    def __init__(self):
+        self._images = {}
+
+    def get(self, image_id):
+        return self._images.setdefault(image_id, FakeImage(image_id))
+
+
+class FakeContainer(object):
+    """
+    Mimics docker.models.containers.Container. Started containers exit after the duration registered for their image.
+    """
+
+    def __init__(self, backend, image_id, environment, labels, host_config=None):
+        self.backend = backend
+        self.id = uuid.uuid4().hex
+        self.name = 'fake_{}'.format(self.id[:8])
+        self.image_id = image_id
+        self.labels = dict(labels or {})
+        self.status = 'created'
+        self.exit_code = None
+        self.started_at = None
+        self.finished_at = None
+        self.attrs = {'Id': self.id, 'Name': '/' + self.name,
+                      'Config': {'Env': list(environment or []), 'Labels': self.labels},
+                      'HostConfig': dict(host_config or {}),
+                      'State': {'Status': 'created', 'StartedAt': '0001-01-01T00:00:00Z',
+                                'FinishedAt': '0001-01-01T00:00:00Z', 'ExitCode': 0}}
+        self._exited = threading.Event()
+
+    @property
+    def gpu_minors(self):
+        for env in self.attrs['Config']['Env']:
+            if env.startswith('NVIDIA_VISIBLE_DEVICES='):
+                value = env.split('=', 1)[1]
+                return [] if value in ('none', 'void', '') else value.split(',')
+        return []
+
+    def reload(self):
+        self.backend.count_call('inspect')
+
+    def start(self, **kwargs):
+        self.backend.count_call('start')
+        self._set_status('running')
+        self.started_at = time.time()
+        self.attrs['State']['StartedAt'] = _iso(self.started_at)
+        self.backend.on_start(self)
+        duration = self.backend.durations.get(self.image_id, 0)
+        timer = threading.Timer(duration, self.exit)
+        timer.daemon = True
+        timer.start()
+
+    def exit(self, exit_code=0):
+        self.finished_at = time.time()
+        self.exit_code = exit_code
+        self.attrs['State']['FinishedAt'] = _iso(self.finished_at)
+        self.attrs['State']['ExitCode'] = exit_code
+        self._set_status('exited')
+        self.backend.on_exit(self)
+        self._exited.set()
+
+    def stop(self):
+        self.exit(exit_code=137)
+
+    kill = stop
+
+    def wait(self, **kwargs):
+        self._exited.wait()
+        return {'StatusCode': self.exit_code}
+
+    def remove(self, **kwargs):
+        self.backend.count_call('remove')
+        self.backend.containers.drop(self.id)
+
+    def stats(self, decode=True, stream=True):
+        self.backend.count_call('stats')
+        return FakeStatsStream(self, stream)
+
+    def logs(self, stream=False, follow=False, **kwargs):
+        if not stream:
+            return b''.join(self.log_line(index) for index in range(self.backend.lines_logged(self)))
+
+        def line_stream():
+            # one line per stats interval, the stream ends once the container exited
+            index = 0
+            while True:
+                exited = self._exited.is_set()
+                for index in range(index, self.backend.lines_logged(self)):
+                    yield self.log_line(index)
+                    index += 1
+                if not follow or exited:
+                    return
+                self._exited.wait(self.backend.stats_interval)
+
+        return line_stream()
+
+    def log_line(self, index):
+        return '{} line {}\n'.format(self.name, index).encode()
+
+    def _set_status(self, status):
+        self.status = status
+        self.attrs['State']['Status'] = status
+
+
+class FakeStatsStream(object):
+    """
+    Mimics the closeable stats stream. Like docker, the stream ends once the container is not running anymore
+    """
+
+    def __init__(self, container, stream=True):
+        self.container = container
+        self.stream = stream
+        self._closed = False
+
+    def __iter__(self):
+        while not self._closed:
+            yield self.container.backend.stats_sample(self.container)
+            if not self.stream or self.container._exited.wait(self.container.backend.stats_interval):
+                return
+
+    def close(self):
+        self._closed = True
+
+
+class FakeListEntry(object):
+    """
+    Mimics a container returned by containers.list(sparse=True), the state is a plain string
+    """
+
+    def __init__(self, container):
+        self.id = container.id
+        self.attrs = {'Id': container.id, 'Names': ['/' + container.name], 'Image': container.image_id,
+                      'Labels': dict(container.labels), 'State': container.status}
+
+
+class FakeContainers(object):
+    def __init__(self, backend):
+        self.backend = backend
+        self._containers = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def create(self, image, environment=None, labels=None, **kwargs):
+        self.backend.count_call('create')
+        image_id = image.id if isinstance(image, FakeImage) else image
+        host_config = {'CpusetCpus': kwargs.get('cpuset_cpus', ''), 'CpusetMems': kwargs.get('cpuset_mems', '')}
+        container = FakeContainer(self.backend, image_id, environment, labels, host_config)
+        with self._lock:
+            self._containers[container.id] = container
+        return container
+
+    def get(self, container_id):
+        self.backend.count_call('inspect')
+        try:
+            return self._containers[container_id]
+        except KeyError:
+            raise docker.errors.NotFound('No such container: {}'.format(container_id))
+
+    def prepare_model(self, attrs):
+        return self._containers[attrs['Id']]
+
+    def list(self, all=False, filters=None, sparse=False, **kwargs):
+        self.backend.count_call('list')
+        filters = filters or {}
+        with self._lock:
+            containers = list(self._containers.values())
+        if not all:
+            containers = [c for c in containers if c.status == 'running']
+        label = filters.get('label')
+        if label is not None:
+            containers = [c for c in containers if label in c.labels]
+        if sparse:
+            return [FakeListEntry(c) for c in containers]
+        return containers
+
+    def drop(self, container_id):
+        with self._lock:
+            self._containers.pop(container_id, None)
+
+
+class FakeEventStream(object):
+    def __init__(self, backend):
+        self.backend = backend
+        self.queue = queue.Queue()
+        self._closed = False
+
+    def __iter__(self):
+        while not self._closed:
+            event = self.queue.get()
+            if event is None:
+                return
+            yield event
+
+    def close(self):
+        self._closed = True
+        self.queue.put(None)
+        self.backend.drop_stream(self)
+
+
+class FakeAPIClient(object):
+    """
+    Stand-in for the low level docker.APIClient
+    """
+
+    api_version = docker.constants.DEFAULT_DOCKER_API_VERSION
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.hooks = {'response': []}
+
+    def inspect_container(self, container_id):
+        container = self.backend.containers.get(container_id)
+        return copy.deepcopy(container.attrs)
+
+    def logs(self, container_id, **kwargs):
+        return self.backend.containers.prepare_model({'Id': container_id}).logs(**kwargs)
+
+    def stats(self, container_id, decode=True, stream=True):
+        return self.backend.containers.prepare_model({'Id': container_id}).stats(decode=decode, stream=stream)
+
+
+class FakeDockerClient(object):
+    """
+    Stand-in for docker.DockerClient. Keeps track of the gpu busy time and of start/exit times of all containers.
+    """
+
+    def __init__(self, stats_interval=1.0):
+        self.api = FakeAPIClient(self)
+        self.containers = FakeContainers(self)
+        self.images = FakeImages()
+        self.durations = {}
+        self.stats_interval = stats_interval
+        self.calls = collections.Counter()
+        self.start_times = {}
+        self.finish_times = {}
+        self.assignments = {}
+        self.cpusets = {}
+        self.gpu_busy_seconds = 0.0
+        self._streams = []
+        self._lock = threading.Lock()
+
+    def count_call(self, name):
+        with self._lock:
+            self.calls[name] += 1
+
+    def events(self, decode=True, since=None, filters=None, **kwargs):
+        stream = FakeEventStream(self)
+        with self._lock:
+            self._streams.append(stream)
+        return stream
+
+    def drop_stream(self, stream):
+        with self._lock:
+            if stream in self._streams:
+                self._streams.remove(stream)
+
+    def emit(self, container, action):
+        event = {'Type': 'container', 'Action': action, 'status': action, 'id': container.id,
+                 'time': int(time.time()), 'timeNano': int(time.time() * 1e9),
+                 'Actor': {'ID': container.id, 'Attributes': dict(container.labels)}}
+        with self._lock:
+            streams = list(self._streams)
+        for stream in streams:
+            stream.queue.put(event)
+
+    def on_start(self, container):
+        job_id = container.labels.get('dopq.job_id', container.id)
+        self.start_times[job_id] = container.started_at
+        self.assignments[job_id] = [int(minor) for minor in container.gpu_minors]
+        self.cpusets[job_id] = (container.attrs['HostConfig']['CpusetCpus'], container.attrs['HostConfig']['CpusetMems'])
+        self.set_gpu_usage(container, 1.0)
+        self.emit(container, 'start')
+
+    def on_exit(self, container):
+        job_id = container.labels.get('dopq.job_id', container.id)
+        self.finish_times[job_id] = container.finished_at
+        with self._lock:
+            self.gpu_busy_seconds += len(container.gpu_minors) * (container.finished_at - container.started_at)
+        self.set_gpu_usage(container, 0.0)
+        self.emit(container, 'die')
+
+    def set_gpu_usage(self, container, load):
+        backend = gpu_backend.get_backend()
+        if isinstance(backend, gpu_backend.FakeBackend):
+            for minor in container.gpu_minors:
+                backend.set_usage(minor, load, load * backend.memory_total / 2)
+
+    def stats_sample(self, container):
+        now = time.time()
+        return {'read': _iso(now),
+                'cpu_stats': {'cpu_usage': {'total_usage': int(now * 1e9) // 2}, 'system_cpu_usage': int(now * 1e9) * 8,
+                              'online_cpus': 8, 'throttling_data': {'periods': 0, 'throttled_periods': 0,
+                                                                    'throttled_time': 0}},
+                'precpu_stats': {'cpu_usage': {'total_usage': 0}, 'system_cpu_usage': 0, 'online_cpus': 8},
+                'memory_stats': {'usage': 2 * 1024 ** 3, 'limit': 32 * 1024 ** 3,
+                                 'stats': {'cache': 512 * 1024 ** 2, 'rss': 1536 * 1024 ** 2}}}
+
+    def lines_logged(self, container):
+        """
+        fake containers log one line per stats interval while running
+        """
+        if container.started_at is None:
+            return 0
+        end = container.finished_at or time.time()
+        return int((end - container.started_at) / self.stats_interval) + 1
+
+    def close(self):
+        pass
+
+
+def install(num_gpus=8, gpu_memory_total=24576, stats_interval=1.0):
+    """
+    Replace docker.from_env with the fake client, the stats streams with the ones of the fake containers and the GPU
+    backend with the fake backend. Has to be called before the queue and its allocators are created.
+    :param num_gpus: number of fake gpus
+    :param gpu_memory_total: memory per fake gpu in MiB
+    :param stats_interval: seconds between two samples of a stats stream
+    :return: the FakeDockerClient instance that is handed out by docker.from_env
+    """
+    client = FakeDockerClient(stats_interval=stats_interval)
+    docker.from_env = lambda *args, **kwargs: client
+    stats_collector.open_stats_stream = lambda fake_client, container_id: fake_client.api.stats(container_id)
+    docker_client.reset()
+    gpu_backend.set_backend(gpu_backend.FakeBackend(num_gpus, gpu_memory_total))
+    return client
+
+
+def _iso(timestamp):
+    return time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(timestamp)) + '.{:06d}Z'.format(int(timestamp % 1 * 1e6))
+
+
+class FakeDockerSocket(object):
+    """
+    HTTP server on a unix socket that answers docker requests after a fixed latency, like a busy daemon: version,
+    image inspect, container list, inspect, create, start and stop, the stats streams of running containers and the
+    events stream. Requests are handled concurrently, requests on one keep-alive connection one after the other.
+    """
+
+    def __init__(self, path, container_ids=(), latency=0.01, stats_interval=0.1):
+        self.path = path
+        self.latency = latency
+        self.stats_interval = stats_interval
+        self.attrs = dict((container_id, {'Id': container_id, 'Name': '/fake_' + container_id[:8],
+                                          'Config': {'Labels': {}},
+                                          'State': {'Status': 'running', 'ExitCode': 0}})
+                          for container_id in container_ids)
+        self.requests = 0
+        self.calls = collections.Counter()
+        self.loop = asyncio.new_event_loop()
+        self._event_queues = []
+        self._started = threading.Event()
+        self.thread = threading.Thread(target=self._serve)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+        self._started.wait()
+        return self
+
+    def stop(self):
+        """
+        stop accepting connections, cancel the handlers of the open ones and stop the server thread
+        """
+        asyncio.run_coroutine_threadsafe(self._shutdown(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+    def exit(self, container_id, exit_code=0):
+        """
+        let a container exit, like a job that has finished
+        """
+        self.loop.call_soon_threadsafe(self._set_state, container_id, 'exited', 'die', exit_code)
+
+    async def _shutdown(self):
+        self.server.close()
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def _serve(self):
+        asyncio.set_event_loop(self.loop)
+        self.server = self.loop.run_until_complete(asyncio.start_unix_server(self._handle, path=self.path))
+        self._started.set()
+        self.loop.run_forever()
+
+    def _set_state(self, container_id, status, action, exit_code=0):
+        attrs = self.attrs[container_id]
+        attrs['State'].update(Status=status, Running=status == 'running', ExitCode=exit_code)
+        event = {'Type': 'container', 'Action': action, 'status': action, 'id': container_id,
+                 'time': int(time.time()), 'timeNano': int(time.time() * 1e9),
+                 'Actor': {'ID': container_id, 'Attributes': dict(attrs['Config']['Labels'] or {})}}
+        for events in self._event_queues:
+            events.put_nowait(event)
+
+    def _create(self, query, body):
+        container_id = uuid.uuid4().hex + uuid.uuid4().hex
+        name = query.get('name', ['fake_' + container_id[:8]])[0]
+        self.attrs[container_id] = {'Id': container_id, 'Name': '/' + name,
+                                    'Config': {'Image': body.get('Image'), 'Env': body.get('Env') or [],
+                                               'Labels': body.get('Labels') or {}},
+                                    'HostConfig': body.get('HostConfig') or {},
+                                    'State': {'Status': 'created', 'Running': False, 'ExitCode': 0}}
+        return 201, {'Id': container_id, 'Warnings': []}
+
+    async def _stats(self, container_id):
+        # like docker, the stream ends once the container is not running anymore
+        while True:
+            now = time.time()
+            yield {'read': _iso(now), 'id': container_id,
+                   'cpu_stats': {'cpu_usage': {'total_usage': int(now * 1e9) // 2},
+                                 'system_cpu_usage': int(now * 1e9) * 8, 'online_cpus': 8},
+                   'precpu_stats': {'cpu_usage': {'total_usage': 0}, 'system_cpu_usage': 0, 'online_cpus': 8},
+                   'memory_stats': {'usage': 2 * 1024 ** 3, 'limit': 32 * 1024 ** 3}}
+            await asyncio.sleep(self.stats_interval)
+            if self.attrs.get(container_id, {}).get('State', {}).get('Status') != 'running':
+                return
+
+    async def _events(self):
+        events = asyncio.Queue()
+        self._event_queues.append(events)
+        try:
+            while True:
+                yield await events.get()
+        finally:
+            self._event_queues.remove(events)
+
+    def _respond(self, method, path, body):
+        """
+        :return: tuple of (status, JSON payload or async generator of the objects of a streaming response)
+        """
+        url = urllib.parse.urlparse(path)
+        query = urllib.parse.parse_qs(url.query)
+        parts = url.path.strip('/').split('/')
+        if parts and parts[0][:1] == 'v' and parts[0][1:2].isdigit():
+            parts = parts[1:]
+        self.calls[(method, '/'.join(part if part not in self.attrs else '<id>' for part in parts))] += 1
+
+        if parts == ['version']:
+            return 200, {'ApiVersion': docker.constants.DEFAULT_DOCKER_API_VERSION, 'Version': 'fake'}
+        if parts == ['events']:
+            return 200, self._events()
+        if parts[:1] == ['images'] and parts[-1:] == ['json']:
+            return 200, {'Id': 'sha256:' + '/'.join(parts[1:-1])}
+        if parts == ['containers', 'json']:
+            return 200, [dict(Id=a['Id'], State=a['State']['Status'], Names=[a['Name']],
+                              Labels=a['Config']['Labels']) for a in self.attrs.values()]
+        if parts == ['containers', 'create'] and method == 'POST':
+            return self._create(query, body)
+        if len(parts) == 3 and parts[0] == 'containers':
+            if parts[1] not in self.attrs:
+                return 404, {'message': 'No such container: {}'.format(parts[1])}
+            if parts[2] == 'json':
+                return 200, self.attrs[parts[1]]
+            if parts[2] == 'stats':
+                return 200, self._stats(parts[1])
+            if parts[2] == 'start' and method == 'POST':
+                self._set_state(parts[1], 'running', 'start')
+                return 204, None
+            if parts[2] == 'stop' and method == 'POST':
+                self._set_state(parts[1], 'exited', 'die', 137)
+                return 204, None
+        return 404, {'message': 'page not found'}
+
+    async def _handle(self, reader, writer):
+        try:
+            await self._serve_connection(reader, writer)
+        except (asyncio.CancelledError, ConnectionError):
+            # cancelled by stop() or a stream closed by the client
+            pass
+        finally:
+            writer.close()
+
+    async def _serve_connection(self, reader, writer):
+        while True:
+            request_line = await reader.readline()
+            if not request_line:
+                break
+            length = 0
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                if line.lower().startswith(b'content-length:'):
+                    length = int(line.split(b':')[1])
+            body = json.loads(await reader.readexactly(length)) if length else {}
+
+            method, path = request_line.decode('latin-1').split()[:2]
+            self.requests += 1
+            await asyncio.sleep(self.latency)
+            status, payload = self._respond(method, path, body)
+            reason = {200: 'OK', 201: 'Created', 204: 'No Content'}.get(status, 'Not Found')
+
+            if hasattr(payload, '__aiter__'):
+                writer.write('HTTP/1.1 {} {}\r\nContent-Type: application/json\r\n'
+                             'Transfer-Encoding: chunked\r\n\r\n'.format(status, reason).encode('latin-1'))
+                await writer.drain()
+                async for item in payload:
+                    data = json.dumps(item).encode('utf-8') + b'\n'
+                    writer.write('{:x}\r\n'.format(len(data)).encode('latin-1') + data + b'\r\n')
+                    await writer.drain()
+                writer.write(b'0\r\n\r\n')
+                await writer.drain()
+                continue
+
+            data = json.dumps(payload).encode('utf-8') if payload is not None else b''
+            writer.write('HTTP/1.1 {} {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\n\r\n'.format(
+                status, reason, len(data)).encode('latin-1') + data)
+            await writer.drain()
@@ -76,6 +76,20 @@ class DopqController():
     def get_dopq_user_statistics(self):
         return self.dp_obj.get_user_statistics
 
+    @property
+    def get_docker_call_stats(self):
+        return self.dp_obj.get_docker_call_stats
+
+    @property
+    def get_gpu_sampler_stats(self):
+        return self.dp_obj.get_gpu_sampler_stats
+
+    def get_gpu_telemetry(self, start=None, end=None, minors=None, resolution=None):
+        return self.dp_obj.get_gpu_telemetry(start, end, minors, resolution)
+
+    def tail_container_logs(self, job_id, offset=None, lines=100):
+        return self.dp_obj.get_log_tail(job_id, offset, lines)
+
     def dopq_system_lock(self, lock_state):
         self.dp_obj.exec_dopq_lock_state(lock_state)
 
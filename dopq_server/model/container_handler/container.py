@@ -11,6 +11,7 @@ Provides a wrapper for container objects
 
 import os
 import time
+import uuid
 import docker
 import traceback
 
@@ -18,19 +19,61 @@ from dateutil import parser
 from datetime import datetime
 from docker.errors import APIError
 from dopq_server.model.utils import log
-from dopq_server.model.utils.cpu import CPU
+from dopq_server.model.utils.cpu import container_usages
 from dopq_server.model.utils.gpu import get_gpus_status, get_gpu_infos
+from dopq_server.model.utils.gpu_allocator import select_minors
+from dopq_server.model.docker_helper import docker_client, stats_collector, async_engine
+from dopq_server.model.docker_helper.docker_events import dopq_labels
 from dopq_server.model.container_handler.container_config import ContainerConfig
 
 
 LOG = log.get_module_log(__name__)
 
 
+def format_run_time(start_time, end_time):
+    """
+    Formats the time between start and end.
+
+    :param start_time: datetime (utc) the container started
+    :param end_time: datetime (utc) the container finished, year 1 if not yet finished
+    :return: Run time as {hours}h {minutes}m {seconds}s
+    """
+
+    # replace finish time with now if not yet finished.
+    if end_time.year == 1:
+        end_time = datetime.utcnow()
+
+    # calc delta
+    time_delta = end_time - start_time
+    time_delta = int(time_delta.total_seconds())
+
+    minutes, seconds = divmod(time_delta, 60)
+    hours, minutes = divmod(minutes, 60)
+
+    runtime = ''
+    runtime += '{}h '.format(hours) if hours > 0 else ''
+    runtime += '{}m '.format(minutes) if minutes > 0 else ''
+    runtime += '{}s '.format(seconds) if minutes == 0 else ''
+
+    return runtime
+
+
 class Container:
     """
     Wrapper for docker container objects
+
+    The inspect result of the docker container is cached as a snapshot for attrs_ttl seconds. All derived properties
+    (status, docker name, start/finish time, ...) read from that snapshot. It is invalidated by the lifecycle methods
+    of the wrapper and by docker events handled in the queue.
     """
 
+    # seconds an inspect snapshot stays valid, set from the config by the queue
+    attrs_ttl = 2.0
+
+    # (cpus, memory nodes) pinned by the queue, None if the container is not pinned. A class attribute, so that
+    # containers restored from older queue files have it as well
+    cpuset = None
+
     def __init__(self, config, image_id, log_dir=None, mounts=None):
         """
         Creates a new container instance.
@@ -40,13 +83,15 @@ class Container:
         """
 
         self.config = config
+        self.job_id = uuid.uuid4().hex
         self.container_id = None
         self.image_id = image_id
         self.last_log_update = int(time.time())
-        self.last_log_file_update = int(time.time())
         self.log_dir = log_dir if log_dir is not None else ""
-        self._stats = None
         self._gpu_minors = None
+        self._attrs = None
+        self._attrs_time = 0
+        self.peak_stats = {}
         self.created_at = datetime.fromtimestamp(time.time()).strftime("%a, %d.%b %H:%M")
         try:
             iter(mounts)
@@ -56,16 +101,73 @@ class Container:
             self.mounts = mounts
         self.mounts = self.create_mounts()
 
+    def __setstate__(self, state):
+        """
+        Restores a pickled container. Containers written by older versions lack the job id, the snapshot cache and the
+        peak stats and still carry members that are not used anymore.
+        """
+        state = dict(state)
+        # the queue is keyed by job id, containers enqueued before it existed get a new one
+        state.setdefault('job_id', uuid.uuid4().hex)
+        state.pop('_stats', None)
+        state.pop('last_log_file_update', None)
+        state.setdefault('_attrs', None)
+        state.setdefault('_attrs_time', 0)
+        state.setdefault('peak_stats', {})
+        self.__dict__.update(state)
+
     @property
     def container_obj(self):
+        """
+        docker container model built from the cached snapshot, no additional docker call if the snapshot is valid
+        """
+        attrs = self.snapshot()
+        if attrs is None:
+            return None
+        client = docker_client.get_client()
+        return client.containers.prepare_model(attrs)
+
+    def snapshot(self):
+        """
+        Cached result of inspecting the docker container, refreshed if older than attrs_ttl. If the refresh fails
+        (e.g. because the container has been removed in the meantime), the last snapshot is returned.
+
+        :return: inspect dictionary or None if the container has not been created yet
+        """
         if self.container_id is None:
             return None
-        client = docker.from_env()
-        return client.containers.get(self.container_id)
+
+        if self._attrs is None or time.time() - self._attrs_time > self.attrs_ttl:
+            try:
+                attrs = docker_client.get_client().api.inspect_container(self.container_id)
+            except APIError:
+                if self._attrs is None:
+                    raise
+                LOG.warning("Could not inspect container {}, using the last snapshot".format(self.name))
+            else:
+                self.update_snapshot(attrs)
+
+        return self._attrs
+
+    def update_snapshot(self, attrs):
+        """
+        Replace the cached snapshot, e.g. with the result of a batched inspect
+        :param attrs: inspect dictionary of the docker container
+        :return: None
+        """
+        self._attrs = attrs
+        self._attrs_time = time.time()
+
+    def invalidate(self):
+        """
+        Mark the cached snapshot as outdated, the next access inspects the container again
+        :return: None
+        """
+        self._attrs_time = 0
 
     @property
     def image(self):
-        client = docker.from_env()
+        client = docker_client.get_client()
         return client.images.get(self.image_id)
 
     @property
@@ -74,8 +176,7 @@ class Container:
         wrapper for getting the creation time of the container object
         :return: creation date and time as unicode
         """
-        self.reload()
-        state_val = self.container_obj.attrs.get('State')
+        state_val = self.snapshot().get('State')
         if state_val is not None:
             start_val = state_val.get('StartedAt')
             if start_val is not None:
@@ -91,8 +192,7 @@ class Container:
         :return: creation date and time as unicode
         """
 
-        self.reload()
-        state_val = self.container_obj.attrs.get('State')
+        state_val = self.snapshot().get('State')
         if state_val is not None:
             start_val = state_val.get('FinishedAt')
             if start_val is not None:
@@ -129,24 +229,7 @@ class Container:
         :return: Run time as {hours}h {minutes}m {seconds}s
         """
 
-        # try to get finish time, replace with now if not yet finished.
-        end_time = self.finish_time
-        if end_time.year == 1:
-            end_time = datetime.utcnow()
-
-        # calc delta
-        time_delta = end_time - self.start_time
-        time_delta = int(time_delta.total_seconds())
-
-        minutes, seconds = divmod(time_delta, 60)
-        hours, minutes = divmod(minutes, 60)
-
-        runtime = ''
-        runtime += '{}h '.format(hours) if hours > 0 else ''
-        runtime += '{}m '.format(minutes) if minutes > 0 else ''
-        runtime += '{}s '.format(seconds) if minutes == 0 else ''
-
-        return runtime
+        return format_run_time(self.start_time, self.finish_time)
 
     @property
     def name(self):
@@ -170,7 +253,7 @@ class Container:
         Provides the name of the container given by docker
         :return: Name of the container given by docker
         """
-        return self.container_obj.name
+        return self.snapshot()['Name'].lstrip('/')
 
     @property
     def status(self):
@@ -180,8 +263,7 @@ class Container:
         if self.container_id is None:
             return 'not created'
         else:
-            self.reload()
-            return self.container_obj.status
+            return self.snapshot()['State']['Status']
 
     def attach(self, **kwargs):
         """
@@ -245,30 +327,32 @@ class Container:
         return self.container_obj.exec_run(cmd, stdout, stderr, stdin, tty, privileged, user, detach, stream,
                                            socket, environment)
 
-    def start(self, **kwargs):
+    def create(self, gpu_minors=None, link_costs=None):
         """
-        Start this container. Similar to the ``docker start`` command, but
-        doesn't support attach options.
+        Assign the GPU minors and create the docker container without starting it.
+
+        Args:
+            gpu_minors (list): GPU minors (as strings) reserved for this container,
+                e.g. by the GPU allocator of the queue. If None, the free GPUs are
+                looked up by inspecting all containers on the host.
+            link_costs (dict): Link costs between GPU minors, e.g. of the GPU
+                allocator of the queue, used to choose among the free GPUs.
+                The lowest free minors are chosen if None.
 
         Raises:
+            IOError
+                If not enough GPUs are available.
             :py:class:`docker.errors.APIError`
                 If the dopq_server returns an error.
         """
 
-        # check status
-        if self.status == 'running' or self.status == 'restarting':
-            LOG.warning("Container is already running or restarting (status={}). "
-                        "Calling start has no effect here!".format(self.status))
-            return self
-
-        # for non-paused containers
-        if self.status != 'paused':
+        # read number of requested GPUs from config
+        n_gpus = self.config.num_gpus
 
-            # read number of requested GPUs from config
-            n_gpus = self.config.num_gpus
+        # gpus required?
+        if n_gpus > 0:
 
-            # gpus required?
-            if n_gpus > 0:
+            if gpu_minors is None:
 
                 # get free gpus
                 free_gpus, _ = get_gpus_status()
@@ -279,30 +363,76 @@ class Container:
                     raise IOError("Not enough GPUs available to run container "
                                   "(available={}, required={})!".format(len(free_gpus), n_gpus))
 
-                # assign
-                minors = [str(m) for m in free_gpus[:n_gpus]]
-                self.gpu_minors = minors
+                gpu_minors = [str(m) for m in select_minors(sorted(free_gpus), n_gpus, link_costs)]
 
-            else:
-                self.gpu_minors = ['none']
+            # assign
+            self.gpu_minors = gpu_minors
+
+        else:
+            self.gpu_minors = ['none']
 
-            # create the container
+        # remove a container that was created before but never started, e.g. after a failed start
+        if self.container_id is not None:
             try:
+                self.remove(force=True)
+            except APIError:
+                LOG.warning("Could not remove the previously created container of {}".format(self.name))
+            self.container_id = None
+            self._attrs = None
 
-                self.create_container()
-            except APIError as e:
-                LOG.error(traceback.format_exc())
-                raise e
+        # create the container
+        try:
 
-            # start it
-            self._stats = self.container_obj.stats(decode=True, stream=True)
-            return self.container_obj.start(**kwargs)
+            self.create_container()
+        except APIError as e:
+            LOG.error(traceback.format_exc())
+            raise e
+
+    def start(self, gpu_minors=None, link_costs=None, **kwargs):
+        """
+        Start this container. Similar to the ``docker start`` command, but
+        doesn't support attach options. The container is created first, unless
+        :py:meth:`create` has already been called.
+
+        Args:
+            gpu_minors (list): GPU minors (as strings) reserved for this container,
+                see :py:meth:`create`.
+            link_costs (dict): Link costs between GPU minors, see :py:meth:`create`.
+
+        Raises:
+            :py:class:`docker.errors.APIError`
+                If the dopq_server returns an error.
+        """
+
+        # check status
+        status = self.status
+        if status == 'running' or status == 'restarting':
+            LOG.warning("Container is already running or restarting (status={}). "
+                        "Calling start has no effect here!".format(status))
+            return self
+
+        # for non-paused containers
+        if status != 'paused':
+
+            # create the container, if not done yet
+            if status != 'created':
+                self.create(gpu_minors, link_costs)
+
+            # start it, through the asyncio engine unless docker-py specific options are given
+            engine = async_engine.get_engine()
+            if engine is not None and not kwargs:
+                result = engine.start(self.container_id)
+            else:
+                result = self.container_obj.start(**kwargs)
+            self.invalidate()
+            return result
 
         else:
 
             LOG.warning("You should not call start to unpause a paused container!")
-            self._stats = self.container_obj.stats(decode=True, stream=True)
-            return self.container_obj.unpause(**kwargs)
+            result = self.container_obj.unpause(**kwargs)
+            self.invalidate()
+            return result
 
     def restart(self, **kwargs):
         """
@@ -312,7 +442,9 @@ class Container:
             :py:class:`docker.errors.APIError`
                 If the dopq_server returns an error.
         """
-        return self.container_obj.restart(**kwargs)
+        result = self.container_obj.restart(**kwargs)
+        self.invalidate()
+        return result
 
     def pause(self):
         """
@@ -322,7 +454,9 @@ class Container:
             :py:class:`docker.errors.APIError`
                 If the dopq_server returns an error.
         """
-        return self.container_obj.pause()
+        result = self.container_obj.pause()
+        self.invalidate()
+        return result
 
     def unpause(self):
         """
@@ -332,7 +466,9 @@ class Container:
             :py:class:`docker.errors.APIError`
                 If the dopq_server returns an error.
         """
-        return self.container_obj.unpause()
+        result = self.container_obj.unpause()
+        self.invalidate()
+        return result
 
     def stop(self):
         """
@@ -342,7 +478,13 @@ class Container:
             :py:class:`docker.errors.APIError`
                 If the dopq_server returns an error.
         """
-        return self.container_obj.stop()
+        engine = async_engine.get_engine()
+        if engine is not None:
+            result = engine.stop(self.container_id)
+        else:
+            result = self.container_obj.stop()
+        self.invalidate()
+        return result
 
     def kill(self, signal=None):
         """
@@ -355,7 +497,9 @@ class Container:
             :py:class:`docker.errors.APIError`
                 If the dopq_server returns an error.
         """
-        return self.container_obj.kill(signal)
+        result = self.container_obj.kill(signal)
+        self.invalidate()
+        return result
 
     def get_archive(self, path):
         """
@@ -408,26 +552,39 @@ class Container:
             :py:class:`docker.errors.APIError`
                 If the dopq_server returns an error.
         """
-        return self.container_obj.remove(**kwargs)
+        result = self.container_obj.remove(**kwargs)
+        self.invalidate()
+        return result
 
     def reload(self):
+        """
+        Force a refresh of the cached snapshot
+        """
+        self.invalidate()
         try:
-            self.container_obj.reload()
+            self.snapshot()
         except Exception:
             pass
 
     @property
     def stats(self):
         """
-        wrapper that return the next item of the stats stream that is created in init
+        latest sample of the docker stats stream, collected in the background. Does not block.
+        :return: stats dictionary or None if no sample has arrived yet
+        """
+        return stats_collector.get_collector().latest(self.job_id)
+
+    def stats_history(self):
+        """
+        :return: list of the buffered stats samples, oldest first
         """
-        if self._stats is None or not iter(self._stats) is iter(self._stats):
-            self._stats = self.container_obj.stats(decode=True, stream=True)
+        return stats_collector.get_collector().samples(self.job_id)
 
-        return next(self._stats)
+    def start_stats_stream(self):
+        stats_collector.get_collector().watch(self)
 
     def stop_stats_stream(self):
-        self._stats = None
+        stats_collector.get_collector().unwatch(self.job_id)
 
     def top(self, **kwargs):
         """
@@ -453,7 +610,9 @@ class Container:
             :py:class:`docker.errors.APIError`
                 If the dopq_server returns an error.
         """
-        return self.container_obj.update(**kwargs)
+        result = self.container_obj.update(**kwargs)
+        self.invalidate()
+        return result
 
     def wait(self, **kwargs):
         """
@@ -563,74 +722,41 @@ class Container:
         # return the number of new bytes
         return len(new_logs)
 
-    def append_new_logs_to_file(self, file_path=None):
-        """
-        Appends the newly created log data to given file path.
-
-        :param file_path: Path for container log (if none, a name will be generated)
-        :return: Number of new bytes
-        """
-
-        # if no file path has been given
-        if file_path is None:
-            # build file path
-            file_path = os.path.join(self.log_dir, "{}_{}.log".format(self.name(), self.created_at))
-
-        # get new logs
-        new_logs = self.logs(stdout=True, stderr=True, since=self.last_log_file_update)
-
-        # update
-        self.last_log_file_update = int(time.time())
-
-        # leave
-        if len(new_logs) == 0:
-            return 0
-
-        # open in append mode and add
-        with open(file_path, 'a+') as file_h:
-            file_h.write(new_logs)
-
-        # return the number of new bytes
-        return len(new_logs)
-
-    def container_stats(self, runtime_stats=True):
+    def container_stats(self, runtime_stats=True, usage=None):
         """
         Provides information about container including also runtime info (if flag is set).
 
         :param runtime_stats: If true also actual hardware runtime info will be added.
+        :param usage: cpu and memory usage of the container as computed by cpu.container_usages, computed from the
+                      latest stats sample if not given
         :return: String with container info.
         """
 
-        self.reload()
-
-        # build base info
-        if self.container_obj is None:
+        # build base info, all properties below read from the same snapshot (at most one inspect)
+        if self.snapshot() is None:
             base_info = {'name': self.name, 'executor': self.executor, 'run_time': '',
-                         'docker name': '', 'created': '', 'status': 'not built'}
+                         'docker name': '', 'created': '', 'status': 'not built', 'job id': self.job_id}
         else:
             base_info = {'name': self.name, 'executor': self.executor, 'run_time': self.run_time,
-                         'docker name': self.docker_name, 'created': self.created_at, 'status': self.status}
+                         'docker name': self.docker_name, 'created': self.created_at, 'status': self.status,
+                         'job id': self.job_id}
 
         # also show runtime info?
         if runtime_stats:
 
-            # get stats
-            stats_dict = self.stats
-
-            # TODO: Extract cpu usage percentage (which seems to be a bit tricky..)
-            # cpu_stats = stats_dict['cpu_stats']
-            cpu = CPU(interval=0.1)
-            cpu_usage_percentage = cpu.cpu_percent()  # changed this because psutil.cpu_percentage with interval is blocking
-            cpu_usage_percentage = '{}%'.format(cpu_usage_percentage)
-
-            # calc memory usage
-            mem_stats = stats_dict['memory_stats']
-            mem_usage = mem_stats.get('usage')
-            if mem_usage is not None:
-                mem_usage = '{}%'.format(round(mem_usage * 100.0 / mem_stats['limit'], 1))
+            # usage from the latest sample of the background collector, there is none right after the start
+            if usage is None:
+                usage = container_usages([self.stats])[0]
 
-            # add base runtime info
-            base_info.update({'cpu': cpu_usage_percentage, 'memory': mem_usage})
+            if usage is None:
+                base_info.update({'cpu': None, 'memory': None})
+            else:
+                memory_percent = usage['memory'] * 100.0 / usage['memory limit'] if usage['memory limit'] else 0
+                base_info.update({'cpu': '{}%'.format(usage['cpu']),
+                                  'memory': '{}%'.format(round(memory_percent, 1)),
+                                  'cpu throttled': '{}%'.format(usage['throttled']),
+                                  'memory cache': '{}MB'.format(usage['memory cache'] // 1024 ** 2),
+                                  'memory rss': '{}MB'.format(usage['memory rss'] // 1024 ** 2)})
 
             # add gpu info, if required
             if self.use_gpu:
@@ -641,6 +767,17 @@ class Container:
 
         return base_info
 
+    def update_peak_stats(self, **values):
+        """
+        Keep the maximum of each runtime statistic, they are preserved in the history record of the container.
+
+        :param values: e.g. cpu=12.5 (percent), memory=1073741824 (bytes), None values are ignored
+        :return: None
+        """
+        for key, value in values.items():
+            if value is not None and value > self.peak_stats.get(key, value - 1):
+                self.peak_stats[key] = value
+
     def history_info(self):
         """
         Returns information about the container, dedicated to build a history.
@@ -690,12 +827,20 @@ class Container:
         :return: docker container
         """
 
-        client = docker.from_env()
+        client = docker_client.get_client()
         create_conf = self.config.docker_params(image=self.image, detach=True, mounts=self.mounts,
                                                 environment=[
-                                                    "NVIDIA_VISIBLE_DEVICES=" + str(','.join(self.gpu_minors))])
-        container = client.containers.create(**create_conf)
-        self.container_id = container.id
+                                                    "NVIDIA_VISIBLE_DEVICES=" + str(','.join(self.gpu_minors))],
+                                                labels=dopq_labels(self), cpuset=self.cpuset)
+        engine = async_engine.get_engine()
+        if engine is None:
+            container = client.containers.create(**create_conf)
+            self.container_id = container.id
+            self.update_snapshot(container.attrs)
+        else:
+            config, params = async_engine.create_request(client.api, create_conf)
+            self.container_id = engine.create(config, params)
+            self.update_snapshot(engine.inspect(self.container_id))
 
 
 if __name__ == '__main__':
@@ -10,20 +10,48 @@ import json
 
 from dopq_server.model.utils import log
 from dopq_server.model.utils.gpu import get_system_gpus
+from dopq_server.model.utils.memory import parse_memory
+from dopq_server.model.utils.numa import format_cpu_list
 
 LOG = log.get_module_log(__name__)
 
 
 class ContainerConfig:
-    def __init__(self, name, executor_name, num_gpus, num_slots, required_memory, build_flag=True, run_params=None):
+    def __init__(self, name, executor_name, num_gpus, num_slots, required_memory, build_flag=True, run_params=None,
+                 gpu_memory=None, num_cpus=None):
         self.name = name
         self.executor_name = executor_name
         self.required_memory = required_memory
+        self.gpu_memory = gpu_memory
+        self.num_cpus = num_cpus
         self.num_gpus = num_gpus
         self.num_slots = num_slots
         self.build_flag = build_flag
         self.run_params = run_params if run_params is not None else dict()
 
+    def __setstate__(self, state):
+        # configs pickled by older versions have no gpu memory and cpu declarations
+        state = dict(state)
+        state.setdefault('gpu_memory', None)
+        state.setdefault('num_cpus', None)
+        self.__dict__.update(state)
+
+    @property
+    def required_memory_bytes(self):
+        """
+        :return: required host memory in bytes
+        """
+        return parse_memory(self.required_memory)
+
+    @property
+    def required_gpu_memory_bytes(self):
+        """
+        :return: declared gpu memory per gpu in bytes, None if the container needs whole gpus
+        """
+        if self.gpu_memory is None:
+            return None
+        return parse_memory(self.gpu_memory)
+
     @staticmethod
     def from_dict(config_dict):
         """
@@ -35,6 +63,8 @@ class ContainerConfig:
         name = config_dict.get('name')
         executor_name = config_dict.get('executor_name')
         required_memory = config_dict.get('required_memory', '20g')
+        gpu_memory = config_dict.get('gpu_memory')
+        num_cpus = config_dict.get('num_cpus')
         num_gpus = config_dict.get('num_gpus', 1)
         num_slots = config_dict.get('num_slots', 1)
         build_flag = config_dict.get('build_flag', True)
@@ -62,7 +92,8 @@ class ContainerConfig:
 
         # create instance
         return ContainerConfig(name=name, executor_name=executor_name, required_memory=required_memory,
-                               num_gpus=num_gpus, num_slots=num_slots, build_flag=build_flag, run_params=run_params)
+                               num_gpus=num_gpus, num_slots=num_slots, build_flag=build_flag, run_params=run_params,
+                               gpu_memory=gpu_memory, num_cpus=num_cpus)
 
     @classmethod
     def from_string(cls, json_str):
@@ -92,6 +123,8 @@ class ContainerConfig:
 
         return {'executor_name': self.executor_name,
                 'required_memory': self.required_memory,
+                'gpu_memory': self.gpu_memory,
+                'num_cpus': self.num_cpus,
                 'num_gpus': self.num_gpus,
                 'num_slots': self.num_slots,
                 'build_flag': self.build_flag,
@@ -112,7 +145,7 @@ class ContainerConfig:
         with open(file_path, 'w') as file_h:
             json.dump(config_dict, file_h)
 
-    def docker_params(self, image, detach, mounts, environment=None):
+    def docker_params(self, image, detach, mounts, environment=None, labels=None, cpuset=None):
         """
         Build docker params from config and given parameters. Will perform a merge operation, if overlap exists.
 
@@ -124,6 +157,9 @@ class ContainerConfig:
         :param detach: Whether to run in detached mode (instant return)
         :param mounts: Mount configuration.
         :param environment: Environment variables.
+        :param labels: Docker labels to attach to the container.
+        :param cpuset: Tuple of (cpus, memory nodes) the container is pinned to, not pinned if None. An explicit
+                       cpuset_cpus in the run params takes precedence.
         :return: Dictionary which can be passed as kwargs to client.containers.run
         """
 
@@ -158,5 +194,15 @@ class ContainerConfig:
         else:
             docker_params['environment'] = environment
 
+        # add or update labels
+        if labels is not None:
+            docker_params['labels'] = dict(docker_params.get('labels', {}), **labels)
+
+        # pin to the reserved cores and their memory nodes
+        if cpuset is not None and 'cpuset_cpus' not in self.run_params:
+            cpus, mems = cpuset
+            docker_params['cpuset_cpus'] = format_cpu_list(cpus)
+            docker_params['cpuset_mems'] = format_cpu_list(mems)
+
         # return params
         return docker_params
@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+container_queue.py
+
+Provides a heap based priority queue for the enqueued containers
+"""
+
+import heapq
+import itertools
+import threading
+
+
+class ContainerQueue(object):
+    """
+    Priority queue of containers ordered by (user penalty, created_at).
+
+    All containers of one user share the same penalty, so every user gets a heap of (created_at, seq, container)
+    entries and a second heap orders the users by (penalty rank, key of their first container). Changing the penalty
+    of a user therefore only re-keys that user's entry in the user heap. Removed entries and outdated user keys are
+    invalidated lazily and skipped when they reach the top of their heap.
+
+    The queue is changed by the scheduler thread while RPC threads read it, so every method takes a lock and readers
+    get a list snapshot instead of a live view.
+    """
+
+    _REMOVED = None
+
+    def __init__(self, penalty_index, containers=None):
+        """
+        :param penalty_index: PenaltyIndex instance providing the rank of a user
+        :param containers: iterable of containers to initialize the queue with
+        """
+        self.penalty_index = penalty_index
+        self._counter = itertools.count()
+        self._user_heaps = {}
+        self._user_entries = {}
+        self._user_heap = []
+        self._entries = {}
+        self._lock = threading.Lock()
+
+        for container in containers if containers is not None else []:
+            self.push(container)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __bool__(self):
+        return bool(self._entries)
+
+    __nonzero__ = __bool__
+
+    def __iter__(self):
+        return iter(self.ordered())
+
+    def __contains__(self, container):
+        return container.job_id in self._entries
+
+    def push(self, container):
+        """
+        Insert a container in O(log n)
+        :param container: Container object
+        :return: None
+        """
+        with self._lock:
+            self._push(container)
+
+    def _push(self, container):
+        if container.job_id in self._entries:
+            return
+
+        entry = [container.created_at, next(self._counter), container]
+        self._entries[container.job_id] = entry
+        heap = self._user_heaps.setdefault(container.user, [])
+        heapq.heappush(heap, entry)
+
+        # the user only needs a new key if the container became the first one of that user
+        if heap[0] is entry:
+            self._rekey(container.user)
+
+    def pop(self):
+        """
+        Remove and return the container with the highest priority in O(log n)
+        :return: Container object
+        """
+        with self._lock:
+            return self._pop()
+
+    def _pop(self):
+        while self._user_heap:
+            user_entry = heapq.heappop(self._user_heap)
+            user = user_entry[-1]
+            if self._user_entries.get(user) is not user_entry:
+                continue
+            del self._user_entries[user]
+
+            heap = self._user_heaps[user]
+            entry = heapq.heappop(heap)
+            container = entry[-1]
+            del self._entries[container.job_id]
+            self._drop_removed(user)
+            self._rekey(user)
+            return container
+
+        raise IndexError('pop from an empty container queue')
+
+    def peek(self):
+        """
+        :return: container with the highest priority without removing it, None if the queue is empty
+        """
+        head = self.ordered(limit=1)
+        return head[0] if head else None
+
+    def remove(self, job_id):
+        """
+        Delete the container with given job id
+        :param job_id: job id of the container
+        :return: the removed container or None if there is no such job
+        """
+        with self._lock:
+            return self._remove(job_id)
+
+    def _remove(self, job_id):
+        entry = self._entries.pop(job_id, None)
+        if entry is None:
+            return None
+
+        container = entry[-1]
+        entry[-1] = self._REMOVED
+        self._drop_removed(container.user)
+        self._rekey(container.user)
+        return container
+
+    def rekey(self, user):
+        """
+        Update the position of all containers of user, e.g. after the penalty of that user changed. O(log n)
+        :param user: name of the user
+        :return: None
+        """
+        with self._lock:
+            self._rekey(user)
+
+    def _rekey(self, user):
+        heap = self._user_heaps.get(user)
+        if not heap:
+            self._user_entries.pop(user, None)
+            self._user_heaps.pop(user, None)
+            return
+
+        created_at, seq, _ = heap[0]
+        user_entry = (self.penalty_index.rank(user), created_at, seq, user)
+        self._user_entries[user] = user_entry
+        heapq.heappush(self._user_heap, user_entry)
+
+        # outdated user keys are skipped lazily, rebuild once they dominate the heap
+        if len(self._user_heap) > 2 * len(self._user_entries) + 64:
+            self._user_heap = list(self._user_entries.values())
+            heapq.heapify(self._user_heap)
+
+    def rekey_all(self):
+        """
+        Update the position of every user, needed after the penalty index has been rebuilt since the rebuilt ranks are
+        not comparable with the ones stored before. O(u log u) for u users.
+        :return: None
+        """
+        with self._lock:
+            self._user_entries = {}
+            self._user_heap = []
+            for user in list(self._user_heaps):
+                self._rekey(user)
+
+    def ordered(self, limit=None, where=None):
+        """
+        Snapshot of the containers in priority order, taken without modifying the queue. Collecting the first k
+        containers costs O(k log n), so callers that only look at the head of the queue stay cheap.
+        :param limit: maximum number of containers, all if None
+        :param where: predicate, only containers for which it returns True are collected
+        :return: list of Container objects
+        """
+        with self._lock:
+            walk = self._walk()
+            if where is not None:
+                walk = (container for container in walk if where(container))
+            return list(itertools.islice(walk, limit))
+
+    def _walk(self):
+        # lazy, must only be consumed while the lock is held
+        candidates = []
+        for user, user_entry in self._user_entries.items():
+            heap = self._user_heaps[user]
+            rank = user_entry[0]
+            candidates.append((rank, heap[0][0], heap[0][1], user, 0))
+        heapq.heapify(candidates)
+
+        while candidates:
+            rank, _, _, user, index = heapq.heappop(candidates)
+            heap = self._user_heaps[user]
+            container = heap[index][-1]
+
+            # walk the user heap in sorted order by expanding the children of each visited node
+            for child in (2 * index + 1, 2 * index + 2):
+                if child < len(heap):
+                    heapq.heappush(candidates, (rank, heap[child][0], heap[child][1], user, child))
+
+            if container is not self._REMOVED:
+                yield container
+
+    def _drop_removed(self, user):
+        heap = self._user_heaps.get(user)
+        while heap and heap[0][-1] is self._REMOVED:
+            heapq.heappop(heap)
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+history_record.py
+
+Provides a compact, immutable record of a finished container for the history
+"""
+
+from datetime import datetime
+from dateutil import parser
+from docker.errors import APIError
+
+from dopq_server.model.utils import log
+from dopq_server.model.container_handler.container import format_run_time
+
+LOG = log.get_module_log(__name__)
+
+NOT_FINISHED = datetime(1, 1, 1)
+
+
+class HistoryRecord(object):
+    """
+    Frozen snapshot of a container, taken once when it exits. Rendering the history from these records does not
+    need the docker daemon, and the records stay valid after the docker container has been removed.
+    """
+
+    __slots__ = ('job_id', 'name', 'executor', 'docker_name', 'gpu_minors', 'created_at', 'start_time',
+                 'finish_time', 'exit_code', 'status', 'peak_stats')
+
+    def __init__(self, job_id, name, executor, docker_name, gpu_minors, created_at, start_time, finish_time,
+                 exit_code, status, peak_stats):
+        values = (job_id, name, executor, docker_name, tuple(gpu_minors or ()), created_at, start_time,
+                  finish_time, exit_code, status, tuple(sorted((peak_stats or {}).items())))
+        for slot, value in zip(self.__slots__, values):
+            object.__setattr__(self, slot, value)
+
+    def __setattr__(self, key, value):
+        raise AttributeError("HistoryRecord is immutable")
+
+    def __delattr__(self, key):
+        raise AttributeError("HistoryRecord is immutable")
+
+    def __reduce__(self):
+        values = [getattr(self, slot) for slot in self.__slots__]
+        values[-1] = dict(values[-1])
+        return self.__class__, tuple(values)
+
+    def __repr__(self):
+        return "HistoryRecord(name={!r}, executor={!r}, status={!r})".format(self.name, self.executor, self.status)
+
+    @classmethod
+    def from_container(cls, container, refresh=True):
+        """
+        Captures the final state of a container with a single inspect.
+
+        :param container: Container object that has exited
+        :param refresh: inspect the container again, False if its snapshot has just been fetched
+        :return: HistoryRecord instance
+        """
+        docker_name, status, exit_code = '', 'removed', None
+        start_time, finish_time = NOT_FINISHED, NOT_FINISHED
+
+        attrs = None
+        if container.container_id is not None:
+            if refresh:
+                container.invalidate()
+            try:
+                attrs = container.snapshot()
+            except APIError:
+                LOG.warning("Container {} is gone, its history record is incomplete".format(container.name))
+
+        if attrs is not None:
+            state = attrs.get('State', {})
+            docker_name = attrs.get('Name', '').lstrip('/')
+            status = state.get('Status', status)
+            exit_code = state.get('ExitCode')
+            if state.get('OOMKilled'):
+                status = 'oom killed'
+            start_time = cls._parse_time(state.get('StartedAt'))
+            finish_time = cls._parse_time(state.get('FinishedAt'))
+
+        return cls(job_id=container.job_id, name=container.name, executor=container.executor,
+                   docker_name=docker_name, gpu_minors=container.gpu_minors, created_at=container.created_at,
+                   start_time=start_time, finish_time=finish_time, exit_code=exit_code, status=status,
+                   peak_stats=container.peak_stats)
+
+    @staticmethod
+    def _parse_time(value):
+        if not value:
+            return NOT_FINISHED
+        return parser.parse(value).replace(tzinfo=None)
+
+    @property
+    def user(self):
+        return self.executor
+
+    @property
+    def run_time(self):
+        if self.start_time.year == 1:
+            return ''
+        return format_run_time(self.start_time, self.finish_time)
+
+    def container_stats(self, runtime_stats=False):
+        """
+        Same information as Container.container_stats, built from memory only. A finished container has no runtime
+        statistics, the peak values are reported instead.
+
+        :param runtime_stats: ignored, kept for compatibility with Container
+        :return: dictionary with the container information
+        """
+        peak_stats = dict(self.peak_stats)
+        info = {'name': self.name, 'executor': self.executor, 'run_time': self.run_time,
+                'docker name': self.docker_name, 'created': self.created_at, 'status': self.status,
+                'job id': self.job_id, 'exit code': self.exit_code, 'gpus': list(self.gpu_minors)}
+        if 'cpu' in peak_stats:
+            info['peak cpu'] = '{}%'.format(round(peak_stats['cpu'], 1))
+        if 'memory' in peak_stats:
+            info['peak memory'] = '{}MB'.format(int(peak_stats['memory'] / 1024 ** 2))
+        return info
+
+    def history_info(self):
+        return self.container_stats(runtime_stats=False)
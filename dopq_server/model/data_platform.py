@@ -3,6 +3,10 @@ import Pyro4
 import hashlib
 import pickledb
 
+from dopq_server.model.utils import gpu
+from dopq_server.model.utils.cpu import container_usages
+from dopq_server.model.docker_helper import docker_client
+
 ##################### Data Platform class #####################
 # Provides necessary wrapper accessed from the viewcontroller #
 ###############################################################
@@ -59,11 +63,15 @@ class DataPlatform():
     @property
     def get_running_info(self):
         run_cont_list = []  # A list of dictionary
-        containers = self.dopq_wrp_obj.running_containers
+        containers = list(self.dopq_wrp_obj.running_containers)
+        self.dopq_wrp_obj.refresh_running_containers() # one docker call for the state of all containers
 
-        for c in containers:
-            print("(Data Platform) --> Current running Container : ", c.container_stats())
-            run_cont_list.append(c.container_stats())
+        # cpu usage of all containers is computed at once from their latest stats samples
+        usages = container_usages([c.stats for c in containers])
+        for c, usage in zip(containers, usages):
+            info = c.container_stats(usage=usage)
+            print("(Data Platform) --> Current running Container : ", info)
+            run_cont_list.append(info)
 
         return run_cont_list
 
@@ -92,6 +100,42 @@ class DataPlatform():
 
         return system_status
 
+    @property
+    def get_docker_call_stats(self):
+        """
+        :return: per endpoint count, mean and max latency (seconds) of the docker API calls of the server process
+        """
+        return docker_client.latency_stats()
+
+    @property
+    def get_gpu_sampler_stats(self):
+        """
+        :return: number of gpu samples taken, their mean duration in seconds and the sampling period
+        """
+        return gpu.get_sampler().overhead()
+
+    def get_gpu_telemetry(self, start=None, end=None, minors=None, resolution=None):
+        """
+        recorded gpu utilization, memory used (MiB), temperature and power (W) in a time range
+        :param start: unix time, defaults to one hour before end
+        :param end: unix time, defaults to now
+        :param minors: list of GPU minors, all if None
+        :param resolution: seconds per value, chosen from the range if None
+        :return: dictionary with the 'resolution', the 'times' and per gpu a dictionary of metric -> values
+        """
+        return self.dopq_wrp_obj.gpu_telemetry.query(start, end, minors, resolution)
+
+    def get_log_tail(self, job_id, offset=None, lines=100):
+        """
+        last log lines of a running job, served from memory
+        :param job_id: job id of the container, as in the running containers info
+        :param offset: 'offset' returned by the previous call, None for the last lines
+        :param lines: maximum number of lines
+        :return: dictionary with 'lines', the 'offset' for the next call and the number of 'skipped' lines, None if
+                 there is no running job with this id
+        """
+        return self.dopq_wrp_obj.log_pump.tail(job_id, offset, lines)
+
     @property
     def get_completed_containers_info(self):
         history = []  # A list of dictionary
@@ -107,7 +151,7 @@ class DataPlatform():
     def get_enqueued_container_list(self):
         enq_list = []  # A list of dictionary
 
-        containers = self.dopq_wrp_obj.container_list
+        containers = self.dopq_wrp_obj.container_list.ordered()
         enq_list = [c.history_info() for c in containers]
         #print("(Data Platform)--> enqueued_containers : ", enq_list)
         print("(Data Platform)--> enqueued_containers length: ", len(enq_list))
@@ -154,6 +198,9 @@ class DataPlatform():
         """
 
         self.dopq_wrp_obj.history = [] # Clear the current history list
+        self.dopq_wrp_obj.helper_obj.set_dopq_history(self.dopq_wrp_obj.history)
+        # the rebuilt penalty index starts over, the queue has to re-rank its users
+        self.dopq_wrp_obj.container_list.rekey_all()
         # Clear the history dill files, so next time, upon starting, system can have a fresh start
         path = os.path.join(self.dopq_wrp_obj.paths['history'], self.dopq_wrp_obj.history_file)
         print("Deleted history dill path: ", path)
@@ -0,0 +1,388 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+async_engine.py
+
+asyncio client for the docker engine API over the unix socket, with a synchronous facade for threaded callers
+"""
+
+import os
+import json
+import asyncio
+import threading
+import urllib.parse
+
+import docker.utils
+import docker.errors
+import docker.models.images
+import docker.models.containers
+
+from dopq_server.model.utils import log
+from dopq_server.model.docker_helper import docker_client
+
+LOG = log.get_module_log(__name__)
+
+__authors__ = "Md Rezaur Rahman, Ilja Mankov, Markus Rohm"
+
+DEFAULT_SOCKET = '/var/run/docker.sock'
+MAX_CONNECTIONS = 16
+
+_facade = None
+_facade_pid = None
+_lock = threading.Lock()
+
+
+def socket_path_from_env():
+    """
+    :return: path of the docker unix socket as configured by DOCKER_HOST, None if docker is not reached over a socket
+    """
+    host = os.environ.get('DOCKER_HOST', 'unix://' + DEFAULT_SOCKET)
+    if host.startswith('unix://'):
+        return host[len('unix://'):]
+    return None
+
+
+def _raise_for_status(status, path, body):
+    if status < 400:
+        return
+    try:
+        explanation = json.loads(body.decode('utf-8')).get('message')
+    except (ValueError, AttributeError):
+        explanation = body.decode('utf-8', 'replace')
+    message = '{} error for {}'.format(status, path)
+    if status == 404:
+        raise docker.errors.NotFound(message, explanation=explanation)
+    raise docker.errors.APIError(message, explanation=explanation)
+
+
+def create_request(api, params):
+    """
+    Translate the keyword arguments of docker-py's containers.create into the body and the query of the engine API
+    create request, the same way docker-py does it, so that both create identical containers
+    :param api: docker.APIClient, for its API version and proxy configuration
+    :param params: keyword arguments of containers.create including the image, e.g. from ContainerConfig.docker_params
+    :return: tuple of (request body, query parameters)
+    """
+    image = params['image']
+    if isinstance(image, docker.models.images.Image):
+        image = image.id
+    create_kwargs = docker.models.containers._create_container_args(dict(params, image=image, version=api.api_version,
+                                                                         command=params.get('command')))
+    query = dict((key, create_kwargs.pop(key)) for key in ('name', 'platform') if create_kwargs.get(key))
+    environment = create_kwargs.pop('environment', None)
+    if isinstance(environment, dict):
+        environment = docker.utils.utils.format_environment(environment)
+    if create_kwargs.pop('use_config_proxy', True):
+        environment = api._proxy_configs.inject_proxy_environment(environment) or None
+    return api.create_container_config(environment=environment, **create_kwargs), query
+
+
+class _Response(object):
+    """
+    status, headers and body reader of one HTTP/1.1 response
+    """
+
+    def __init__(self, reader, status, headers):
+        self.reader = reader
+        self.status = status
+        self.headers = headers
+
+    @property
+    def chunked(self):
+        return self.headers.get('transfer-encoding', '').lower() == 'chunked'
+
+    @property
+    def keep_alive(self):
+        return self.headers.get('connection', '').lower() != 'close' and (
+            self.chunked or 'content-length' in self.headers)
+
+    async def chunks(self):
+        """
+        yields the body in the pieces the server sent it
+        """
+        if self.chunked:
+            while True:
+                size = int((await self.reader.readline()).split(b';')[0].strip() or b'0', 16)
+                if size == 0:
+                    await self.reader.readline()
+                    return
+                data = await self.reader.readexactly(size)
+                await self.reader.readline()
+                yield data
+        elif 'content-length' in self.headers:
+            length = int(self.headers['content-length'])
+            if length:
+                yield await self.reader.readexactly(length)
+        else:
+            data = await self.reader.read()
+            if data:
+                yield data
+
+    async def read(self):
+        return b''.join([chunk async for chunk in self.chunks()])
+
+
+class AsyncDockerEngine(object):
+    """
+    Minimal docker engine API client on asyncio: inspect, create, start, stop, the stats streams and the events stream.
+    Requests are sent over a pool of keep-alive connections to the unix socket, so independent requests run
+    concurrently. Every stream gets a connection of its own, which is closed when the stream is closed.
+    """
+
+    def __init__(self, socket_path, api_version, max_connections=MAX_CONNECTIONS):
+        """
+        :param socket_path: path of the docker unix socket
+        :param api_version: docker engine API version used in the request paths, e.g. as negotiated by docker-py
+        :param max_connections: maximum number of concurrent requests
+        """
+        self.socket_path = socket_path
+        self.max_connections = max_connections
+        self.api_version = api_version
+        self._idle = []
+        self._semaphore = None
+
+    def _url(self, path, params=None):
+        url = '/v{}{}'.format(self.api_version, path)
+        if params:
+            url += '?' + urllib.parse.urlencode(params)
+        return url
+
+    async def _connect(self):
+        if self._idle:
+            return self._idle.pop()
+        return await asyncio.open_unix_connection(self.socket_path)
+
+    async def _send(self, reader_writer, method, url, body=None):
+        reader, writer = reader_writer
+        headers = ['{} {} HTTP/1.1'.format(method, url), 'Host: docker']
+        if body is not None:
+            headers += ['Content-Type: application/json', 'Content-Length: {}'.format(len(body))]
+        elif method in ('POST', 'PUT'):
+            headers.append('Content-Length: 0')
+        writer.write(('\r\n'.join(headers) + '\r\n\r\n').encode('latin-1') + (body or b''))
+        await writer.drain()
+
+        status_line = await reader.readline()
+        if not status_line:
+            raise ConnectionResetError('docker closed the connection')
+        status = int(status_line.split()[1])
+        response_headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            key, _, value = line.decode('latin-1').partition(':')
+            response_headers[key.strip().lower()] = value.strip()
+        return _Response(reader, status, response_headers)
+
+    async def request(self, method, path, params=None, data=None):
+        """
+        :param method: HTTP method
+        :param path: API path without version, e.g. /containers/<id>/json
+        :param params: query parameters
+        :param data: JSON serializable request body
+        :return: decoded JSON response, None for empty responses
+        """
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_connections)
+        url = self._url(path, params)
+        body = json.dumps(data).encode('utf-8') if data is not None else None
+
+        async with self._semaphore:
+            connection = await self._connect()
+            try:
+                try:
+                    response = await self._send(connection, method, url, body)
+                except (ConnectionError, asyncio.IncompleteReadError):
+                    # an idle keep-alive connection may have been closed by docker in the meantime
+                    connection[1].close()
+                    connection = await asyncio.open_unix_connection(self.socket_path)
+                    response = await self._send(connection, method, url, body)
+                content = await response.read()
+            except BaseException:
+                connection[1].close()
+                raise
+
+            if response.keep_alive:
+                self._idle.append(connection)
+            else:
+                connection[1].close()
+
+        _raise_for_status(response.status, path, content)
+        return json.loads(content.decode('utf-8')) if content.strip() else None
+
+    async def stream(self, path, params=None):
+        """
+        yields the decoded JSON objects of a streaming endpoint, one per line
+        """
+        connection = await asyncio.open_unix_connection(self.socket_path)
+        try:
+            response = await self._send(connection, 'GET', self._url(path, params))
+            if response.status >= 400:
+                _raise_for_status(response.status, path, await response.read())
+            buffer = b''
+            async for chunk in response.chunks():
+                buffer += chunk
+                *lines, buffer = buffer.split(b'\n')
+                for line in lines:
+                    if line.strip():
+                        yield json.loads(line.decode('utf-8'))
+        finally:
+            connection[1].close()
+
+    async def inspect(self, container_id):
+        return await self.request('GET', '/containers/{}/json'.format(container_id))
+
+    async def inspect_many(self, container_ids):
+        """
+        inspect several containers concurrently
+        :param container_ids: list of container ids
+        :return: list of inspect dictionaries in the same order, the exception for containers that failed
+        """
+        return await asyncio.gather(*[self.inspect(c) for c in container_ids], return_exceptions=True)
+
+    async def create(self, config, params=None):
+        """
+        :param config: container configuration in engine API format, see create_request
+        :param params: query parameters, i.e. name and platform
+        :return: id of the new container
+        """
+        result = await self.request('POST', '/containers/create', params=params, data=config)
+        return result['Id']
+
+    async def start(self, container_id):
+        await self.request('POST', '/containers/{}/start'.format(container_id))
+
+    async def stop(self, container_id, timeout=10):
+        await self.request('POST', '/containers/{}/stop'.format(container_id), params={'t': timeout})
+
+    def stats(self, container_id):
+        """
+        async generator of the stats samples of a container, ends when the container stops
+        :param container_id: id of the container
+        """
+        return self.stream('/containers/{}/stats'.format(container_id), {'stream': 1})
+
+    def events(self, filters=None, since=None):
+        """
+        async generator of the decoded docker events
+        :param filters: dictionary of event filters in docker-py format, e.g. {'type': 'container'}
+        :param since: unix timestamp
+        """
+        params = {}
+        if filters:
+            params['filters'] = docker.utils.convert_filters(filters)
+        if since is not None:
+            params['since'] = since
+        return self.stream('/events', params)
+
+    async def close(self):
+        while self._idle:
+            self._idle.pop()[1].close()
+
+
+class SyncEngine(object):
+    """
+    Synchronous facade of AsyncDockerEngine for threaded callers. The engine lives in an event loop on a daemon thread
+    of its own, calls block only the calling thread until their result is there. Long running consumers of the streams
+    are submitted as coroutines and run on the loop without a thread of their own.
+    """
+
+    def __init__(self, socket_path, api_version, max_connections=MAX_CONNECTIONS, timeout=60):
+        self.engine = AsyncDockerEngine(socket_path, api_version, max_connections)
+        self.timeout = timeout
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name='DoPQ-DockerEngine')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self, coroutine):
+        """
+        run a coroutine on the engine loop and wait for its result
+        """
+        return self.submit(coroutine).result(self.timeout)
+
+    def submit(self, coroutine):
+        """
+        schedule a coroutine on the engine loop without waiting for it
+        :return: concurrent.futures.Future of the result, cancelling it cancels the coroutine
+        """
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def inspect(self, container_id):
+        return self.run(self.engine.inspect(container_id))
+
+    def inspect_many(self, container_ids):
+        return self.run(self.engine.inspect_many(container_ids))
+
+    def create(self, config, params=None):
+        return self.run(self.engine.create(config, params))
+
+    def start(self, container_id):
+        return self.run(self.engine.start(container_id))
+
+    def stop(self, container_id, timeout=10):
+        return self.run(self.engine.stop(container_id, timeout))
+
+    async def _shutdown(self):
+        await self.engine.close()
+        # stream consumers and requests abandoned after a timeout must not be destroyed while they are pending
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def close(self):
+        """
+        close the connections, cancel the outstanding requests and stop the loop thread
+        """
+        if self.loop.is_running():
+            self.run(self._shutdown())
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join(self.timeout)
+        if not self.loop.is_running() and not self.loop.is_closed():
+            self.loop.close()
+
+
+def get_engine():
+    """
+    Returns the docker engine facade of this process, created on first use
+    :return: SyncEngine or None if docker is not reached over a unix socket
+    """
+    global _facade, _facade_pid
+
+    pid = os.getpid()
+    if _facade is not None and _facade_pid == pid:
+        return _facade
+
+    socket_path = socket_path_from_env()
+    if socket_path is None or not os.path.exists(socket_path):
+        return None
+
+    with _lock:
+        if _facade is None or _facade_pid != pid:
+            # same API version as the shared docker-py client, which negotiates it with the daemon
+            api_version = docker_client.get_client().api.api_version
+            _facade, _facade_pid = SyncEngine(socket_path, api_version), pid
+    return _facade
+
+
+def reset():
+    """
+    Drop the engine facade, the next get_engine() call creates a new one
+    :return: None
+    """
+    global _facade, _facade_pid
+    if _facade is not None and _facade_pid == os.getpid():
+        _facade.close()
+    _facade, _facade_pid = None, None
+
+
+def _forget():
+    global _facade, _facade_pid
+    _facade, _facade_pid = None, None
+
+
+if hasattr(os, 'register_at_fork'):
+    # the loop thread of the parent does not exist in a forked child
+    os.register_at_fork(after_in_child=_forget)
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+container_refresh.py
+
+Refreshes the cached state of many containers with a single docker list call
+"""
+
+import copy
+import time
+import threading
+import traceback
+
+from docker.errors import APIError, NotFound
+
+from dopq_server.model.utils import log
+from dopq_server.model.docker_helper import docker_client, async_engine
+from dopq_server.model.docker_helper.docker_events import JOB_LABEL
+
+LOG = log.get_module_log(__name__)
+
+__authors__ = "Md Rezaur Rahman, Ilja Mankov, Markus Rohm"
+
+# status of a container that is not known to docker anymore
+REMOVED = 'removed'
+
+
+def list_dopq_containers():
+    """
+    one docker call for the state of all containers created by DoPQ, including the exited ones
+    :return: dictionary mapping container id to the (sparse) list entry of the container
+    """
+    client = docker_client.get_client()
+    containers = client.containers.list(all=True, sparse=True, filters={'label': JOB_LABEL})
+    return dict((container.id, container.attrs) for container in containers)
+
+
+def fetch_snapshots(containers):
+    """
+    inspect several containers concurrently through the asyncio engine and replace their snapshots
+    :param containers: list of Container objects
+    :return: set of the job ids whose snapshot has been replaced, empty if the engine is not available
+    """
+    engine = async_engine.get_engine()
+    if engine is None or not containers:
+        return set()
+
+    try:
+        results = engine.inspect_many([c.container_id for c in containers])
+    except Exception:
+        LOG.warning("Concurrent inspect failed, containers are inspected one by one:\n{}".format(
+            traceback.format_exc()))
+        return set()
+
+    fetched = set()
+    for container, attrs in zip(containers, results):
+        if isinstance(attrs, dict):
+            container.update_snapshot(attrs)
+            fetched.add(container.job_id)
+    return fetched
+
+
+def inspect_unlisted(container):
+    """
+    inspect a tracked container that is missing from the labelled list, e.g. because it was started before DoPQ
+    labelled its containers. Only a 404 means that the container is gone.
+    :param container: Container object
+    :return: True if the snapshot was updated
+    """
+    try:
+        attrs = docker_client.get_client().api.inspect_container(container.container_id)
+    except NotFound:
+        return patch_snapshot(container, None)
+    except APIError:
+        LOG.warning("Could not inspect container {}, keeping its last state:\n{}".format(
+            container.name, traceback.format_exc()))
+        return False
+    container.update_snapshot(attrs)
+    return True
+
+
+def patch_snapshot(container, entry):
+    """
+    update the cached inspect snapshot of a container with the state from a list entry. The list entry only holds
+    the status, everything else of the snapshot is kept. Containers without a snapshot are left alone, they are
+    inspected on their next access.
+    :param container: Container object
+    :param entry: list entry of the container or None if docker does not know the container anymore
+    :return: True if the snapshot was updated
+    """
+    attrs = container._attrs
+    if attrs is None:
+        return False
+
+    if entry is None:
+        status = REMOVED
+    else:
+        state = entry.get('State')
+        # the list endpoint reports the state as a plain string, inspect as a dictionary
+        status = state.get('Status') if isinstance(state, dict) else state
+
+    if status is None:
+        return False
+
+    if attrs['State'].get('Status') != status:
+        attrs = copy.copy(attrs)
+        attrs['State'] = dict(attrs['State'], Status=status)
+    container.update_snapshot(attrs)
+    return True
+
+
+class ContainerRefresher(object):
+    """
+    Refreshes the status of all tracked containers with one list call instead of one inspect per container. Calls
+    within min_interval seconds of the last refresh reuse its result, so several callers per tick cost one call.
+    """
+
+    def __init__(self, min_interval=2.0):
+        """
+        :param min_interval: seconds a refresh stays valid
+        """
+        self.min_interval = min_interval
+        self.last_refresh = 0
+        self.refresh_count = 0
+        self._lock = threading.Lock()
+
+    def refresh(self, containers, force=False):
+        """
+        :param containers: iterable of Container objects
+        :param force: refresh even if the last refresh is still valid
+        :return: number of containers whose snapshot was updated
+        """
+        containers = [c for c in containers if c.container_id is not None]
+        if not containers:
+            return 0
+
+        with self._lock:
+            if not force and time.time() - self.last_refresh < self.min_interval:
+                return 0
+            entries = list_dopq_containers()
+            self.last_refresh = time.time()
+            self.refresh_count += 1
+
+        # containers without a snapshot yet (e.g. restored on startup) are inspected all at once
+        fetched = fetch_snapshots([c for c in containers if c._attrs is None and c.container_id in entries])
+        return len(fetched) + sum(patch_snapshot(c, entries[c.container_id]) if c.container_id in entries
+                                  else inspect_unlisted(c) for c in containers if c.job_id not in fetched)
@@ -5,6 +5,7 @@ import zipfile
 import docker.errors
 
 from dopq_server.model.utils import log
+from dopq_server.model.docker_helper import docker_client
 
 LOG = log.get_module_log(__name__)
 
@@ -82,7 +83,7 @@ def load_image(filename, failed_dir="", rm_invalid=False, logger=LOG):
     with open(filename, 'r') as f:
         data = f.read()
     try:
-        client = docker.from_env()
+        client = docker_client.get_client()
         output = next(client.images.load(data))
 
         if 'error' in list(output.keys()):
@@ -116,7 +117,7 @@ def build_image(filename, dockerfile, unzip_dir="", tag=None, logger = LOG):
                     "lower case of filename will be used, which is deprecated!")
 
     try:
-        client = docker.from_env()
+        client = docker_client.get_client()
         image = client.images.build(path=os.path.dirname(dockerfile), rm=True, tag=tag)
     except (docker.errors.BuildError, docker.errors.APIError) as e:
         logger.error('\terror while building image {} (tag={}):\n\t\t{}'.format(filename, tag, e))
@@ -182,7 +183,7 @@ def create_container(image, config, mounts, logger=LOG):
     """
 
     mounts = create_mounts(mounts, config.executor_name)
-    client = docker.from_env()
+    client = docker_client.get_client()
     try:
         create_conf = config.docker_params(image=image, detach=True, mounts=mounts, environment=["NVIDIA_VISIBLE_DEVICES=none"])
         container = client.containers.create(**create_conf)
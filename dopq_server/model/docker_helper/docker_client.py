@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+docker_client.py
+
+Provides a process wide, shared docker client
+"""
+
+import os
+import re
+import docker
+import threading
+
+from dopq_server.model.utils import log
+
+LOG = log.get_module_log(__name__)
+
+__authors__ = "Md Rezaur Rahman, Ilja Mankov, Markus Rohm"
+
+MAX_POOL_SIZE = 32
+
+_client = None
+_client_pid = None
+_lock = threading.Lock()
+
+_ID_PATTERN = re.compile(r'/[0-9a-f]{12,64}(?=/|$)')
+_VERSION_PATTERN = re.compile(r'^/v\d+\.\d+')
+
+
+class CallStats(object):
+    """
+    Collects count, total and maximum latency of the docker API calls per endpoint
+    """
+
+    def __init__(self):
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def endpoint(method, path):
+        """
+        normalize a request to an endpoint, e.g. GET /v1.40/containers/3f4e.../json -> GET /containers/{id}/json
+        """
+        path = path.split('?', 1)[0]
+        path = _VERSION_PATTERN.sub('', path)
+        path = _ID_PATTERN.sub('/{id}', path)
+        return '{} {}'.format(method, path)
+
+    def record(self, method, path, seconds):
+        key = self.endpoint(method, path)
+        with self._lock:
+            count, total, maximum = self._stats.get(key, (0, 0.0, 0.0))
+            self._stats[key] = (count + 1, total + seconds, max(maximum, seconds))
+
+    def summary(self):
+        """
+        :return: dictionary mapping endpoint to {'count', 'mean', 'max'} with latencies in seconds
+        """
+        with self._lock:
+            return dict((key, {'count': count, 'mean': total / count, 'max': maximum})
+                        for key, (count, total, maximum) in self._stats.items())
+
+    def reset(self):
+        with self._lock:
+            self._stats = {}
+
+
+CALL_STATS = CallStats()
+
+
+def _record_latency(response, *args, **kwargs):
+    """
+    requests response hook, elapsed is the time until the response headers arrived
+    """
+    CALL_STATS.record(response.request.method, response.request.path_url, response.elapsed.total_seconds())
+    return response
+
+
+def get_client():
+    """
+    Returns the docker client of this process. The client and its connection pool are created once and reused by all
+    threads. A forked process (e.g. the provider) gets its own client instead of sharing the sockets of the parent.
+    :return: docker.DockerClient
+    """
+    global _client, _client_pid
+
+    pid = os.getpid()
+    if _client is not None and _client_pid == pid:
+        return _client
+
+    with _lock:
+        if _client is None or _client_pid != pid:
+            client = docker.from_env(max_pool_size=MAX_POOL_SIZE)
+            client.api.hooks['response'].append(_record_latency)
+            _client, _client_pid = client, pid
+
+    return _client
+
+
+def reset():
+    """
+    Drop the shared client, the next get_client() call creates a new one
+    :return: None
+    """
+    global _client, _client_pid
+    _client, _client_pid = None, None
+
+
+def latency_stats():
+    """
+    :return: per endpoint latency summary of all docker API calls made through the shared client
+    """
+    return CALL_STATS.summary()
+
+
+if hasattr(os, 'register_at_fork'):
+    # do not let a forked child touch the connection pool of the parent
+    os.register_at_fork(after_in_child=reset)
@@ -0,0 +1,147 @@
+import time
+import asyncio
+import threading
+import traceback
+
+from dopq_server.model.utils import log
+from dopq_server.model.docker_helper import docker_client, async_engine
+
+LOG = log.get_module_log(__name__)
+
+__authors__ = "Md Rezaur Rahman, Ilja Mankov, Markus Rohm"
+
+# label that is attached to every container created by DoPQ, its value is the job id of the container
+JOB_LABEL = 'dopq.job_id'
+GPU_LABEL = 'dopq.gpus'
+
+
+def dopq_labels(container):
+    """
+    labels that mark a container as created by DoPQ
+    :param container: Container object (wrapper)
+    :return: dictionary of docker labels
+    """
+    return {JOB_LABEL: container.job_id,
+            GPU_LABEL: ','.join(container.gpu_minors) if container.gpu_minors else 'none',
+            'dopq.executor': container.executor}
+
+
+def event_job_id(event):
+    """
+    :param event: decoded docker event
+    :return: DoPQ job id of the container the event belongs to, None if it is not a DoPQ container
+    """
+    return event.get('Actor', {}).get('Attributes', {}).get(JOB_LABEL)
+
+
+def event_uses_gpu(event):
+    """
+    :param event: decoded docker event
+    :return: True if the container the event belongs to holds gpus
+    """
+    return event.get('Actor', {}).get('Attributes', {}).get(GPU_LABEL, 'none') not in ('none', '')
+
+
+class DockerEventListener(object):
+    """
+    Consumes the docker events stream of all DoPQ containers and passes each event to a callback. The stream is read
+    by a coroutine on the loop of the asyncio engine, or by a background thread if docker is not reached over a unix
+    socket. A single stream is used no matter how many containers are running. After the stream had to be
+    reconnected, a pseudo event {'Action': 'resync'} is emitted since events could have been missed in between.
+    """
+
+    def __init__(self, callback, actions=('start', 'die', 'oom'), retry_interval=1):
+        """
+        :param callback: function that is called with every decoded event, must not block
+        :param actions: container actions to subscribe to
+        :param retry_interval: seconds to wait before reconnecting a broken stream
+        """
+        self.callback = callback
+        self.actions = list(actions)
+        self.retry_interval = retry_interval
+        self.thread = None
+        self.future = None
+        self._stream = None
+        self._stop_flag = threading.Event()
+
+    @property
+    def status(self):
+        if self.future is not None:
+            return 'terminated' if self.future.done() else 'running'
+        if self.thread is None:
+            return 'not started'
+        return 'running' if self.thread.is_alive() else 'terminated'
+
+    def start(self):
+        self._stop_flag.clear()
+        engine = async_engine.get_engine()
+        if engine is not None:
+            self.future = engine.submit(self.listen_async(engine.engine))
+            return
+        self.thread = threading.Thread(target=self.listen, name='DoPQ-DockerEvents')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self._stop_flag.set()
+        if self.future is not None:
+            self.future.cancel()
+        stream = self._stream
+        if stream is not None:
+            try:
+                stream.close()
+            except Exception:
+                pass
+
+    def filters(self):
+        return {'type': 'container', 'label': JOB_LABEL, 'event': self.actions}
+
+    def listen(self):
+        since = None
+        while not self._stop_flag.is_set():
+            try:
+                client = docker_client.get_client()
+                self._stream = client.events(decode=True, since=since, filters=self.filters())
+                if since is not None:
+                    self.callback({'Action': 'resync'})
+
+                for event in self._stream:
+                    since = event.get('time', since)
+                    self.callback(event)
+
+            except Exception:
+                if self._stop_flag.is_set():
+                    break
+                LOG.error(traceback.format_exc())
+
+            if since is None:
+                since = int(time.time())
+            self._stop_flag.wait(self.retry_interval)
+
+    async def listen_async(self, engine):
+        """
+        coroutine on the loop of the asyncio engine, same as listen without a thread of its own
+        :param engine: AsyncDockerEngine
+        :return: None
+        """
+        since = None
+        while not self._stop_flag.is_set():
+            stream = engine.events(filters=self.filters(), since=since)
+            try:
+                if since is not None:
+                    self.callback({'Action': 'resync'})
+
+                async for event in stream:
+                    since = event.get('time', since)
+                    self.callback(event)
+
+            except Exception:
+                if self._stop_flag.is_set():
+                    break
+                LOG.error(traceback.format_exc())
+            finally:
+                await stream.aclose()
+
+            if since is None:
+                since = int(time.time())
+            await asyncio.sleep(self.retry_interval)
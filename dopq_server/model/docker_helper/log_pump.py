@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+log_pump.py
+
+Follows the log streams of the running containers and writes them to size rotated files
+"""
+
+import os
+import gzip
+import queue
+import shutil
+import threading
+import traceback
+
+from dopq_server.model.utils import log
+from dopq_server.model.docker_helper import docker_client
+from dopq_server.model.docker_helper.log_tail import LogTail, MAX_LINES
+
+LOG = log.get_module_log(__name__)
+
+__authors__ = "Md Rezaur Rahman, Ilja Mankov, Markus Rohm"
+
+# marks the end of a log stream in the queue
+_END = None
+
+
+class RotatingLogFile(object):
+    """
+    Binary log file that is rotated once it exceeds max_bytes: job.log -> job.log.1 -> job.log.2 ... Rotated files
+    beyond backup_count are deleted, with compress they are gzipped (job.log.1.gz).
+    """
+
+    def __init__(self, path, max_bytes=10 * 1024 ** 2, backup_count=5, compress=False):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.compress = compress
+        self._file = None
+        self._size = 0
+
+    def _backup_name(self, index):
+        return '{}.{}{}'.format(self.path, index, '.gz' if self.compress else '')
+
+    def _open(self):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._file = open(self.path, 'ab')
+        self._size = self._file.tell()
+
+    def rotate(self):
+        self.close()
+        if self.backup_count > 0:
+            for index in range(self.backup_count - 1, 0, -1):
+                if os.path.exists(self._backup_name(index)):
+                    os.replace(self._backup_name(index), self._backup_name(index + 1))
+            if self.compress:
+                with open(self.path, 'rb') as source, gzip.open(self._backup_name(1), 'wb') as target:
+                    shutil.copyfileobj(source, target)
+                os.remove(self.path)
+            else:
+                os.replace(self.path, self._backup_name(1))
+        else:
+            os.remove(self.path)
+
+    def write(self, data):
+        if self._file is None:
+            self._open()
+        if self._size > 0 and self._size + len(data) > self.max_bytes:
+            self.rotate()
+            self._open()
+        self._file.write(data)
+        self._size += len(data)
+
+    def flush(self):
+        if self._file is not None:
+            self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class LogPump(object):
+    """
+    Follows the log stream of every watched container in a reader thread per container. The readers hand the chunks
+    to a single writer thread through a bounded queue: if the writer falls behind, the readers block and docker buffers
+    the output instead of DoPQ. A container's file is flushed and closed as soon as its stream has been drained, i.e.
+    after the container exited. The readers also keep the last lines of each job in memory (LogTail), until the job
+    is dropped by the queue.
+    """
+
+    def __init__(self, log_dir, max_bytes=10 * 1024 ** 2, backup_count=5, compress=False, queue_size=1024,
+                 tail_lines=MAX_LINES):
+        """
+        :param log_dir: root directory of the job logs, each user gets a sub directory
+        :param max_bytes: size at which a job log is rotated
+        :param backup_count: number of rotated files kept per job
+        :param compress: gzip rotated files
+        :param queue_size: number of chunks buffered between the readers and the writer
+        :param tail_lines: number of lines kept in memory per job
+        """
+        self.log_dir = log_dir
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.compress = compress
+        self.tail_lines = tail_lines
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.files = {}
+        self.tails = {}
+        self.writer = None
+        self._watched = set()
+        self._stop_flag = threading.Event()
+        self._lock = threading.Lock()
+
+    def log_path(self, container):
+        """
+        :param container: Container object
+        :return: path of the current log file of the container
+        """
+        return os.path.join(self.log_dir, container.executor, '{}_{}.log'.format(container.name, container.job_id))
+
+    def start(self):
+        self._stop_flag.clear()
+        self.writer = threading.Thread(target=self.write_logs, name='DoPQ-LogWriter')
+        self.writer.daemon = True
+        self.writer.start()
+
+    def stop(self, timeout=5):
+        """
+        stop following all streams, write out what has been queued and close all files
+        :param timeout: seconds to wait for the writer
+        :return: None
+        """
+        self._stop_flag.set()
+        if self.writer is not None:
+            self.writer.join(timeout)
+
+    def watch(self, container, since=None):
+        """
+        start following the log stream of a running container, does nothing if it is followed already
+        :param container: Container object that has been started
+        :param since: unix timestamp of the first line to fetch, None for the whole log
+        :return: None
+        """
+        with self._lock:
+            if container.job_id in self._watched:
+                return
+            self._watched.add(container.job_id)
+            self.files[container.job_id] = RotatingLogFile(self.log_path(container), self.max_bytes,
+                                                           self.backup_count, self.compress)
+            self.tails[container.job_id] = LogTail(self.tail_lines)
+
+        thread = threading.Thread(target=self.follow, args=(container, self.tails[container.job_id], since),
+                                  name='DoPQ-Logs-{}'.format(container.job_id[:8]))
+        thread.daemon = True
+        thread.start()
+
+    def tail(self, job_id, offset=None, limit=100):
+        """
+        last lines of a job's log, see LogTail.read
+        :param job_id: job id of the container
+        :return: dictionary with 'lines', 'offset' and 'skipped', None if the job is not followed
+        """
+        log_tail = self.tails.get(job_id)
+        if log_tail is None:
+            return None
+        return log_tail.read(offset, limit)
+
+    def drop(self, job_id):
+        """
+        forget the in-memory tail of a job, its file is closed by the writer once the stream has ended
+        :param job_id: job id of the container
+        :return: None
+        """
+        with self._lock:
+            self.tails.pop(job_id, None)
+
+    def put(self, item):
+        """
+        blocking put that gives up once the pump is stopped
+        :return: True if the item has been queued
+        """
+        while not self._stop_flag.is_set():
+            try:
+                self.queue.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def follow(self, container, log_tail, since=None):
+        """
+        reader thread target, queues the chunks of one container's log stream until it ends
+        :param container: Container object
+        :param log_tail: LogTail of the container
+        :param since: unix timestamp of the first line to fetch
+        :return: None
+        """
+        try:
+            client = docker_client.get_client()
+            kwargs = {} if since is None else {'since': since}
+            stream = client.api.logs(container.container_id, stdout=True, stderr=True, stream=True, follow=True,
+                                     **kwargs)
+            for chunk in stream:
+                log_tail.append(chunk)
+                if not self.put((container.job_id, chunk)):
+                    break
+        except Exception:
+            if not self._stop_flag.is_set():
+                LOG.warning("Log stream of container {} failed:\n{}".format(container.name, traceback.format_exc()))
+        finally:
+            log_tail.close()
+            self.put((container.job_id, _END))
+
+    def write_logs(self):
+        """
+        writer thread target, appends the queued chunks to the files of their jobs
+        :return: None
+        """
+        while True:
+            try:
+                job_id, chunk = self.queue.get(timeout=0.5)
+            except queue.Empty:
+                if self._stop_flag.is_set():
+                    break
+                for log_file in list(self.files.values()):
+                    log_file.flush()
+                continue
+
+            log_file = self.files.get(job_id)
+            if log_file is None:
+                continue
+            try:
+                if chunk is _END:
+                    log_file.close()
+                    with self._lock:
+                        self.files.pop(job_id, None)
+                        self._watched.discard(job_id)
+                else:
+                    log_file.write(chunk)
+            except (IOError, OSError):
+                LOG.error(traceback.format_exc())
+
+        for log_file in list(self.files.values()):
+            log_file.close()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+log_tail.py
+
+Keeps the last lines of a job's log in memory
+"""
+
+import itertools
+import threading
+import collections
+
+__authors__ = "Md Rezaur Rahman, Ilja Mankov, Markus Rohm"
+
+# number of lines kept per job
+MAX_LINES = 1000
+
+
+class LogTail(object):
+    """
+    Ring buffer of the last max_lines log lines of one job. Every line has an offset, the number of lines logged
+    before it. Clients keep the offset returned by read() and pass it back to only get the lines added since.
+    """
+
+    def __init__(self, max_lines=MAX_LINES):
+        self.lines = collections.deque(maxlen=max_lines)
+        self.total = 0
+        self._partial = b''
+        self._lock = threading.Lock()
+
+    def append(self, chunk):
+        """
+        add a chunk of log output, an incomplete last line is kept back until it is completed
+        :param chunk: bytes as received from the docker log stream
+        :return: None
+        """
+        data = self._partial + chunk
+        lines = data.split(b'\n')
+        self._partial = lines.pop()
+        self._add(lines)
+
+    def close(self):
+        """
+        the stream ended, add the incomplete last line
+        :return: None
+        """
+        if self._partial:
+            self._add([self._partial])
+            self._partial = b''
+
+    def _add(self, lines):
+        if not lines:
+            return
+        with self._lock:
+            self.lines.extend(line.decode('utf-8', 'replace') for line in lines)
+            self.total += len(lines)
+
+    def read(self, offset=None, limit=100):
+        """
+        :param offset: offset of the first line to return, None for the last 'limit' lines
+        :param limit: maximum number of lines to return
+        :return: dictionary with the 'lines', the 'offset' to pass in the next call and the number of lines that
+                 were 'skipped' because they have already been dropped from the buffer
+        """
+        with self._lock:
+            first = self.total - len(self.lines)
+            if offset is None:
+                offset = max(first, self.total - limit)
+            offset = min(max(offset, 0), self.total)
+            skipped = max(first - offset, 0)
+            start = offset + skipped - first
+            lines = list(itertools.islice(self.lines, start, start + limit))
+        return {'lines': lines, 'offset': offset + skipped + len(lines), 'skipped': skipped}
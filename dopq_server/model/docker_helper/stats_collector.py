@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+stats_collector.py
+
+Consumes the docker stats streams of the running containers in the background
+"""
+
+import asyncio
+import threading
+import traceback
+import collections
+
+from docker.errors import APIError, NotFound
+from docker.types import CancellableStream
+
+from dopq_server.model.utils import log
+from dopq_server.model.utils.cpu import container_usages
+from dopq_server.model.docker_helper import docker_client, async_engine
+
+LOG = log.get_module_log(__name__)
+
+__authors__ = "Md Rezaur Rahman, Ilja Mankov, Markus Rohm"
+
+# number of samples kept per container, docker sends one sample per second
+BUFFER_SIZE = 60
+
+# seconds to wait before reopening a stream that ended while its container is running, doubled up to the maximum
+RETRY_DELAY = 1.0
+MAX_RETRY_DELAY = 30.0
+
+
+def open_stats_stream(client, container_id):
+    """
+    Open the docker stats stream of a container. Like the events stream of docker-py, it can be closed from another
+    thread, which ends a read that is waiting for the next sample.
+    :param client: docker client
+    :param container_id: id of the container
+    :return: CancellableStream of decoded samples
+    """
+    api = client.api
+    response = api._get(api._url('/containers/{0}/stats', container_id), params={'stream': True}, stream=True)
+    api._raise_for_status(response)
+    return CancellableStream(api._stream_helper(response, decode=True), response)
+
+
+def is_running(container):
+    """
+    inspect a container and update its snapshot
+    :param container: Container object
+    :return: False if the container is not running anymore or has been removed, True if it could not be inspected
+    """
+    try:
+        attrs = docker_client.get_client().api.inspect_container(container.container_id)
+    except NotFound:
+        return False
+    except APIError:
+        return True
+    container.update_snapshot(attrs)
+    return attrs['State']['Status'] == 'running'
+
+
+async def is_running_async(engine, container):
+    """
+    same as is_running through the asyncio engine
+    :param engine: AsyncDockerEngine
+    :param container: Container object
+    :return: False if the container is not running anymore or has been removed, True if it could not be inspected
+    """
+    try:
+        attrs = await engine.inspect(container.container_id)
+    except NotFound:
+        return False
+    except (APIError, OSError):
+        return True
+    container.update_snapshot(attrs)
+    return attrs['State']['Status'] == 'running'
+
+
+class StatsCollector(object):
+    """
+    Keeps the latest stats samples of every watched container in a fixed size ring buffer. The streams are read by
+    coroutines on the loop of the asyncio engine, or by a daemon thread per container if docker is not reached over a
+    unix socket, since a docker-py stats stream blocks until the next sample arrives. Readers never touch the streams
+    and get the latest sample immediately. Collecting ends when the container exits, when the container is unwatched,
+    which closes its stream, or when the collector is stopped. A stream that ends while the container is still running
+    is reopened with a backoff.
+    """
+
+    def __init__(self, buffer_size=BUFFER_SIZE):
+        """
+        :param buffer_size: number of samples kept per container
+        """
+        self.buffer_size = buffer_size
+        self.buffers = {}
+        self._stop_flags = {}
+        # job id -> function that closes the stream of the container or cancels its coroutine
+        self._closers = {}
+        self._lock = threading.Lock()
+
+    def watch(self, container):
+        """
+        start collecting the stats of a running container, does nothing if it is watched already
+        :param container: Container object that has been started
+        :return: None
+        """
+        with self._lock:
+            if container.job_id in self._stop_flags:
+                return
+            stop_flag = threading.Event()
+            self._stop_flags[container.job_id] = stop_flag
+            self.buffers[container.job_id] = collections.deque(maxlen=self.buffer_size)
+
+        engine = async_engine.get_engine()
+        if engine is not None:
+            future = engine.submit(self.collect_async(engine.engine, container, stop_flag))
+            self.set_closer(container.job_id, stop_flag, future.cancel)
+            return
+
+        thread = threading.Thread(target=self.collect, args=(container, stop_flag),
+                                  name='DoPQ-Stats-{}'.format(container.job_id[:8]))
+        thread.daemon = True
+        thread.start()
+
+    def unwatch(self, job_id):
+        """
+        stop collecting the stats of a container and drop its samples
+        :param job_id: job id of the container
+        :return: None
+        """
+        with self._lock:
+            stop_flag = self._stop_flags.pop(job_id, None)
+            closer = self._closers.pop(job_id, None)
+            self.buffers.pop(job_id, None)
+        if stop_flag is not None:
+            stop_flag.set()
+        if closer is not None:
+            # ends the read of the collector instead of waiting for the next sample
+            self.close(closer)
+
+    def stop(self):
+        """
+        stop all streams
+        :return: None
+        """
+        with self._lock:
+            job_ids = list(self._stop_flags)
+        for job_id in job_ids:
+            self.unwatch(job_id)
+
+    def latest(self, job_id):
+        """
+        :param job_id: job id of the container
+        :return: most recent stats sample of the container, None if there is none yet
+        """
+        buffer = self.buffers.get(job_id)
+        try:
+            return buffer[-1]
+        except (TypeError, IndexError):
+            return None
+
+    def samples(self, job_id):
+        """
+        :param job_id: job id of the container
+        :return: list of the buffered stats samples of the container, oldest first
+        """
+        return list(self.buffers.get(job_id, ()))
+
+    def collect(self, container, stop_flag):
+        """
+        thread target, appends the samples of one container to its buffer until the container exits or is unwatched
+        :param container: Container object
+        :param stop_flag: threading.Event that is set when the container is unwatched
+        :return: None
+        """
+        buffer = self.buffers.get(container.job_id)
+        delay = RETRY_DELAY
+        try:
+            while not stop_flag.is_set():
+                try:
+                    stream = open_stats_stream(docker_client.get_client(), container.container_id)
+                    if not self.set_closer(container.job_id, stop_flag, stream.close):
+                        break
+                    for sample in stream:
+                        if stop_flag.is_set():
+                            break
+                        self.record(container, buffer, sample)
+                        delay = RETRY_DELAY
+                except Exception:
+                    if stop_flag.is_set():
+                        break
+                    LOG.warning("Stats stream of container {} failed:\n{}".format(
+                        container.name, traceback.format_exc()))
+                finally:
+                    with self._lock:
+                        if self._stop_flags.get(container.job_id) is stop_flag:
+                            self._closers.pop(container.job_id, None)
+
+                if stop_flag.is_set() or not is_running(container):
+                    break
+                # the stream ended while the container is running, e.g. because the daemon restarted
+                stop_flag.wait(delay)
+                delay = min(2 * delay, MAX_RETRY_DELAY)
+        finally:
+            self.finish(container.job_id, stop_flag)
+
+    async def collect_async(self, engine, container, stop_flag):
+        """
+        coroutine on the loop of the asyncio engine, same as collect without a thread of its own
+        :param engine: AsyncDockerEngine
+        :param container: Container object
+        :param stop_flag: threading.Event that is set when the container is unwatched
+        :return: None
+        """
+        buffer = self.buffers.get(container.job_id)
+        delay = RETRY_DELAY
+        try:
+            while not stop_flag.is_set():
+                stream = engine.stats(container.container_id)
+                try:
+                    async for sample in stream:
+                        self.record(container, buffer, sample)
+                        delay = RETRY_DELAY
+                except Exception:
+                    LOG.warning("Stats stream of container {} failed:\n{}".format(
+                        container.name, traceback.format_exc()))
+                finally:
+                    await stream.aclose()
+
+                if stop_flag.is_set() or not await is_running_async(engine, container):
+                    break
+                # the stream ended while the container is running, e.g. because the daemon restarted
+                await asyncio.sleep(delay)
+                delay = min(2 * delay, MAX_RETRY_DELAY)
+        finally:
+            self.finish(container.job_id, stop_flag)
+
+    def set_closer(self, job_id, stop_flag, closer):
+        """
+        register the function that ends the collecting of a container, calls it right away if the container has been
+        unwatched in the meantime
+        :return: False if the container has been unwatched
+        """
+        with self._lock:
+            unwatched = stop_flag.is_set()
+            if not unwatched:
+                self._closers[job_id] = closer
+        if unwatched:
+            self.close(closer)
+        return not unwatched
+
+    def finish(self, job_id, stop_flag):
+        with self._lock:
+            if self._stop_flags.get(job_id) is stop_flag:
+                # the container exited. Keep the last samples for readers
+                del self._stop_flags[job_id]
+                self._closers.pop(job_id, None)
+
+    @staticmethod
+    def record(container, buffer, sample):
+        buffer.append(sample)
+        usage = container_usages([sample])[0]
+        if usage is not None:
+            container.update_peak_stats(cpu=usage['cpu'], memory=usage['memory'])
+
+    @staticmethod
+    def close(closer):
+        try:
+            closer()
+        except Exception:
+            LOG.debug("Closing a stats stream failed:\n{}".format(traceback.format_exc()))
+
+
+COLLECTOR = StatsCollector()
+
+
+def get_collector():
+    """
+    :return: the stats collector of this process
+    """
+    return COLLECTOR
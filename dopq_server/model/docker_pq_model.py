@@ -1,15 +1,29 @@
 import os
 import dill
 import time
+import queue
 import datetime
+import collections
 import traceback
 import threading
 import multiprocessing as mp
+from concurrent.futures import ThreadPoolExecutor
 
 from dopq_server.model.utils import log
 from docker.errors import APIError
-from dopq_server.model.utils.gpu import get_gpus_status
+from dopq_server.model.utils.memory import MemoryLedger, parse_memory
+from dopq_server.model.utils import gpu, gpu_backend
+from dopq_server.model.utils.gpu_allocator import GPUAllocator
+from dopq_server.model.utils.gpu_telemetry import GPUTelemetry, parse_levels
+from dopq_server.model.utils.numa import CoreLedger
 from dopq_server.model.model_helper import ModelHelper
+from dopq_server.model.container_handler.container import Container
+from dopq_server.model.container_handler.container_queue import ContainerQueue
+from dopq_server.model.container_handler.history_record import HistoryRecord
+from dopq_server.model.docker_helper import docker_events, stats_collector
+from dopq_server.model.docker_helper import container_refresh
+from dopq_server.model.docker_helper.container_refresh import ContainerRefresher, REMOVED
+from dopq_server.model.docker_helper.log_pump import LogPump
 
 
 __authors__ = "Ilja Mankov, Markus Rohm, Md Rezaur Rahman"
@@ -32,7 +46,7 @@ class DopQContainer():
         self.container_list_file = 'container_list.dill'
         self.running_containers_file = 'running_containers.dill'
         self.history = []
-        self.container_list = []
+        self.container_list = ContainerQueue(self.helper_obj.penalty_index)
         self.running_containers = []
         self.lock_state = False
         # Variables that are initialized only once in a lifetime
@@ -41,12 +55,42 @@ class DopQContainer():
             self.helper_obj.write_default_config(configfile)
         self.config = self.helper_obj.parse_config(configfile) # Get the config dictionary
         self.paths = self.config['paths']
+        Container.attrs_ttl = self.config['docker']['inspect_ttl']
+        stats_collector.get_collector().buffer_size = self.config['docker']['stats_samples']
         self.dopq_process = None
+        self.provider_listener = None
         self.queue = mp.Queue()
+        self.inbox = collections.deque() # containers received from the provider, not yet enqueued
+        self.docker_events = collections.deque() # lifecycle events of DoPQ containers, not yet processed
+        self.event_listener = docker_events.DockerEventListener(self.on_docker_event)
+        self.refresher = ContainerRefresher(min_interval=Container.attrs_ttl)
+        self.log_pump = LogPump(self.paths['log'], max_bytes=parse_memory(self.config['docker']['log_max_size']),
+                                backup_count=self.config['docker']['log_backups'],
+                                compress=self.config['docker']['log_compress'],
+                                tail_lines=self.config['docker']['log_tail_lines'])
+        self.wakeup = threading.Event()
+        self.pending_releases = collections.deque() # timestamps of gpu releases that did not lead to a start yet
+        self.start_latencies = collections.deque(maxlen=100)
+        self.start_pool = ThreadPoolExecutor(max_workers=self.config['queue']['start_workers'],
+                                             thread_name_prefix='DoPQ-Start')
+        self.starting = {} # containers handed to the start pool, by job id
+        self.start_results = collections.deque() # (container, exception or None) of finished launches
 
         self.mapping = self.restore('all')
         self.logger = log.init_log(logfile)
-        self.helper_obj.set_dopq_history(self.history)
+        gpu_backend.configure(self.config['queue']['gpu_backend'], self.config['queue']['gpu_fake_count'],
+                              self.config['queue']['gpu_fake_topology'])
+        self.gpu_allocator = GPUAllocator(packing=self.config['queue']['gpu_packing'],
+                                          max_jobs_per_gpu=self.config['queue']['gpu_max_jobs'],
+                                          topology_aware=self.config['queue']['gpu_topology'])
+        self.memory_ledger = MemoryLedger(headroom=self.config['queue']['memory_headroom'])
+        self.core_ledger = CoreLedger() if self.config['queue']['cpu_pinning'] else None
+        self.gpu_telemetry = GPUTelemetry(gpu.get_system_gpus(),
+                                          parse_levels(self.config['queue']['gpu_telemetry_levels']))
+        self.blocked_head = None # job id of the first container in the queue while it does not fit
+        self.head_bypasses = 0 # number of gpu containers that were backfilled past the blocked head
+        self.unfittable = set() # job ids of queued containers that have been reported as never fitting
+        self.clamped = set() # job ids of cpu containers whose declared num_cpus has been reported as clamped
 
     def start_dopq_process(self):
         """
@@ -54,23 +98,44 @@ class DopQContainer():
         :return: dopq_process id
         """
         self.process_starttime()
+        gpu.get_sampler().listeners.append(self.gpu_telemetry.record_snapshot)
+        gpu.get_sampler().start(self.config['queue']['gpu_sample_interval'])
+        self.reconcile_ledgers()
+        self.log_pump.start()
+        for container in self.running_containers:
+            container.start_stats_stream()
+            # the output up to now has been written before DoPQ went down
+            self.log_pump.watch(container, since=int(time.time()))
         self.dopq_process = threading.Thread(target=self.exec_dopq_process)
         self.dopq_process.start()
+        self.provider_listener = threading.Thread(target=self.listen_provider_queue, name='DoPQ-ProviderListener')
+        self.provider_listener.daemon = True
+        self.provider_listener.start()
+        self.event_listener.start()
+        # containers restored from disk may have exited while DoPQ was down
+        self.on_docker_event({'Action': 'resync'})
 
     @property
     def mapping(self):
         return {
             'history': [self.history_file, self.history],
-            'list': [self.container_list_file, self.container_list],
+            'list': [self.container_list_file, list(self.container_list)],
             'running': [self.running_containers_file, self.running_containers]
         }
 
     @mapping.setter
     def mapping(self, value):
-        self.history_file, self.history = value['history']
-        self.container_list_file, self.container_list = value['list']
+        self.history_file, history = value['history']
+        self.container_list_file, container_list = value['list']
         self.running_containers_file, self.running_containers = value['running']
 
+        # histories written by older versions contain Container objects
+        self.history = [HistoryRecord.from_container(c) if isinstance(c, Container) else c for c in history]
+
+        # the penalty index has to match the history before the containers are ordered by it
+        self.helper_obj.set_dopq_history(self.history)
+        self.container_list = ContainerQueue(self.helper_obj.penalty_index, container_list)
+
     @property
     def uptime(self):
         days = 0
@@ -92,7 +157,7 @@ class DopQContainer():
 
     @property
     def status(self):
-        if self.dopq_process.isAlive():
+        if self.dopq_process is not None and self.dopq_process.is_alive():
             return 'running'
         elif self.starttime is None:
             return 'not started'
@@ -113,7 +178,7 @@ class DopQContainer():
             single_user_stats = {'user': user,
                                  'penalty': round(self.helper_obj.calc_penalty(user), 4),
                                  'containers run': self.helper_obj.container_freq_for_user(user, self.history),
-                                 'containers enqueued': self.helper_obj.container_freq_for_user(user, self.container_list)}
+                                 'containers enqueued': self.helper_obj.container_freq_for_user(user, self.container_list.ordered())}
 
             user_stats.append(single_user_stats)
 
@@ -124,8 +189,69 @@ class DopQContainer():
         self.startime_formatted = datetime.datetime.fromtimestamp(self.starttime).strftime("%A, %d.%b %H:%M:%S")
         print("Current time: ", self.startime_formatted)
 
+    @property
+    def release_to_start_latency(self):
+        """
+        :return: (last, mean) seconds between a gpu being released and the next container starting, None if unknown
+        """
+        if not self.start_latencies:
+            return None
+        return self.start_latencies[-1], sum(self.start_latencies) / len(self.start_latencies)
+
     def sleep(self):
-        time.sleep(self.config['queue']['sleep'])
+        """
+        Wait until notify() is called, but at most the configured sleep interval which serves as a safety net
+        :return: None
+        """
+        self.wakeup.wait(self.config['queue']['sleep'])
+        self.wakeup.clear()
+
+    def notify(self, reason=None):
+        """
+        Wake up the queue thread so that it runs a scheduling tick immediately
+        :param reason: one of 'provider', 'exit', 'gpu released', 'queue edit' or None
+        :return: None
+        """
+        if reason == 'gpu released':
+            self.pending_releases.append(time.time())
+        self.wakeup.set()
+
+    def listen_provider_queue(self):
+        """
+        Blocks on the provider queue and wakes up the queue thread as soon as a new container arrives
+        :return: None
+        """
+        while not self.terminating_flag:
+            try:
+                container = self.queue.get(timeout=1)
+            except queue.Empty:
+                continue
+            self.inbox.append(container)
+            self.notify('provider')
+
+    def on_docker_event(self, event):
+        """
+        Callback of the docker event listener, hands the event over to the queue thread and wakes it up
+        :param event: decoded docker event
+        :return: None
+        """
+        self.docker_events.append(event)
+        if event.get('Action') in ('die', 'oom'):
+            self.notify('gpu released' if docker_events.event_uses_gpu(event) else 'exit')
+        else:
+            self.notify()
+
+    def record_start(self, container):
+        """
+        Measure the time between the oldest pending gpu release and a gpu container starting
+        :param container: container that has just been started
+        :return: None
+        """
+        if not container.use_gpu or not self.pending_releases:
+            return
+        latency = time.time() - self.pending_releases.popleft()
+        self.start_latencies.append(latency)
+        self.logger.info('\tgpu release to container start latency: {:.3f}s'.format(latency))
 
     def lock_update(self, is_lock):
         """
@@ -140,6 +266,7 @@ class DopQContainer():
             self.lock_state = True
         else:
             self.lock_state = False
+            self.notify('queue edit')
 
     def restore(self, key):
         """
@@ -199,8 +326,6 @@ class DopQContainer():
             """
             file_name, member = assignment_tuple
             full_path = os.path.join(path, file_name)
-            for container in member:
-                container.stop_stats_stream()
             with open(full_path, 'wb') as f:
                 dill.dump(member, f)
 
@@ -224,50 +349,111 @@ class DopQContainer():
         """
         Summary of the function:
         ------------------------
-        (a) Remove specific container from the running container.
-        (b) list the containers which have been done executing, i.e., status : 'exited'
+        (a) Process the docker events that arrived since the last call
+        (b) Remove containers that died from the running containers
         (c) Insert that container at the top of the history list (Latest executed container)
+        (d) The status of all running containers is refreshed with one docker list call per tick, containers that
+            exited without an event being received (e.g. while the stream was reconnected) are moved as well.
+            A 'resync' event forces this refresh and reconciles the gpu ledger.
+        (e) The final state of all containers that exited since the last call is inspected concurrently
 
         Parameters:
         -----------
         :arg: None
         :return: None
         """
-        print("Call is in update_running_containers(), curr. length: ", len(self.running_containers))
+        force_refresh = False
+        finished = []
+        while self.docker_events:
+            event = self.docker_events.popleft()
+            action = event.get('Action', event.get('status'))
+
+            if action == 'resync':
+                force_refresh = True
+                continue
+
+            job_id = docker_events.event_job_id(event)
+            container = next((c for c in self.running_containers if c.job_id == job_id), None)
+            if container is None:
+                continue
+
+            if action == 'oom':
+                container.invalidate()
+                self.logger.warning('\tcontainer {} ran out of memory'.format(container.name))
+            elif action == 'die' and container not in finished:
+                finished.append(container)
+
+        self.refresh_running_containers(force=force_refresh)
         for container in self.running_containers:
-            if container.status == 'exited':
-                container.stop_stats_stream()
-                self.history.insert(0, container)
-                self.running_containers.remove(container)
+            if container not in finished and container.status in ('exited', 'dead', REMOVED):
+                finished.append(container)
 
-        print("(dopq) Current history_list length: ", len(self.history))
-        print("(dopq) Current History: ")
-        for c in self.history:
-            print(c.history_info())
-        print("Current running_list length: ", len(self.running_containers))
+        fetched = container_refresh.fetch_snapshots(finished)
+        for container in finished:
+            self.finish_container(container, refresh=container.job_id not in fetched)
+        if force_refresh:
+            self.reconcile_ledgers()
+
+    def reconcile_ledgers(self):
+        """
+        rebuild the gpu, memory and core ledgers from the running containers and the containers the start pool is
+        still creating or starting, whose resources are reserved as well
+        :return: None
+        """
+        containers = list(self.running_containers) + list(self.starting.values())
+        self.gpu_allocator.reconcile(containers)
+        self.memory_ledger.reconcile(containers)
+        if self.core_ledger is not None:
+            self.core_ledger.reconcile(containers)
+
+    def refresh_running_containers(self, force=False):
+        """
+        update the cached state of all running containers with a single docker call
+        :param force: refresh even if the last refresh is younger than the inspect ttl
+        :return: None
+        """
+        try:
+            self.refresher.refresh(list(self.running_containers), force=force)
+        except APIError:
+            self.logger.error(traceback.format_exc())
+
+    def finish_container(self, container, refresh=True):
+        """
+        move a container that has exited from the running containers to the history, where it is kept as an
+        immutable HistoryRecord that does not need docker anymore
+        :param container: Container object
+        :param refresh: inspect the container for its final state, False if its snapshot has just been fetched
+        :return: None
+        """
+        container.stop_stats_stream()
+        self.log_pump.drop(container.job_id)
+        self.running_containers.remove(container)
+        self.release(container)
+        self.helper_obj.add_to_history(HistoryRecord.from_container(container, refresh=refresh))
+        self.container_list.rekey(container.user)
+        print("(dopq) Container {} finished, history length: {}, running: {}".format(
+            container.name, len(self.history), len(self.running_containers)))
 
     def update_container_list(self):
         """
         Summary of the function:
         ------------------------
         (a) Update the container list by adding new images obtained from the provider process
-        (b) sort the updated container list according to the penalty calculation.
+        (b) new containers are pushed into the priority queue, which keeps them ordered by the penalty calculation.
 
         Parameters:
         -----------
         :arg: None
         :return: None
         """
-        update_list = []
-        print("Queue Size Now : ", self.queue.qsize())
-        while not self.queue.empty():
-            update_list.append(self.queue.get())
-        self.container_list += update_list
+        num_new = 0
+        while self.inbox:
+            self.container_list.push(self.inbox.popleft())
+            num_new += 1
 
-        self.container_list = sorted(self.container_list, key=self.helper_obj.sort_fn)
-        print("(dopq) Current Container List: ")
-        for container in self.container_list:
-            print(container.history_info())
+        if num_new:
+            print("(dopq) Enqueued {} new containers, current container list length: {}".format(
+                num_new, len(self.container_list)))
 
     def cont_update_after_deletion(self, del_list):
         """
@@ -283,16 +469,275 @@ class DopQContainer():
         """
         for cont_dict in del_list:
             print("Should Deleted this Cont.: ", cont_dict)
-            for container in self.container_list:
-                temp = container.history_info()
-                if cont_dict["name"] == temp["name"]:
-                    self.container_list.remove(container)
+            job_id = cont_dict.get("job id")
+            if job_id is not None:
+                self.container_list.remove(job_id)
+                continue
+
+            # fall back to the name for clients that do not send the job id
+            for container in self.container_list.ordered(where=lambda c: c.name == cont_dict["name"]):
+                self.container_list.remove(container.job_id)
 
         print("container_list Length (after deletion): ", len(self.container_list))
-        print("container_list (after deletion): ")
+        self.notify('queue edit')
 
-        for c in self.container_list:
-            print(c.history_info())
+    def reserve(self, container, keep_free_memory=0):
+        """
+        Reserve the resources a container needs to run, i.e. host memory, gpus and, with cpu pinning, cpu cores local
+        to the gpus. The pinned cores are stored in container.cpuset. Containers that set cpuset_cpus in their run
+        params keep their own cores and are not pinned.
+        :param container: Container object
+        :param keep_free_memory: bytes of host memory that have to stay free after the reservation
+        :return: list of reserved gpu minors (['none'] for cpu containers), None if the container does not fit
+        """
+        if not self.memory_ledger.reserve(container.job_id, container.config.required_memory_bytes,
+                                          keep_free=keep_free_memory):
+            return None
+        if not container.use_gpu:
+            minors = ['none']
+        else:
+            minors = self.gpu_allocator.allocate(container.job_id, container.config.num_gpus,
+                                                 gpu_memory=container.config.required_gpu_memory_bytes)
+            if minors is None:
+                self.memory_ledger.release(container.job_id)
+                return None
+
+        # cores pinned by an earlier run, or before pinning was switched off, are not held anymore
+        container.cpuset = None
+        if self.core_ledger is not None and 'cpuset_cpus' not in container.config.run_params:
+            if container.use_gpu:
+                cpuset = self.core_ledger.allocate(container.job_id, self.required_cores(container),
+                                                   nodes=self.gpu_nodes(minors))
+            else:
+                cpuset = self.pin_spare_cores(container)
+            if cpuset is None:
+                self.gpu_allocator.release(container.job_id)
+                self.memory_ledger.release(container.job_id)
+                return None
+            container.cpuset = cpuset
+        return minors
+
+    def cores_per_gpu(self):
+        """
+        :return: cpu cores pinned per gpu, cpu.cores.per.gpu or, if that is 0, the host cores divided by the gpus plus
+                 one share that is left for cpu containers
+        """
+        per_gpu = self.config['queue']['cpu_cores_per_gpu']
+        if per_gpu <= 0:
+            per_gpu = max(1, self.core_ledger.num_cores // (len(self.gpu_allocator.minors) + 1))
+        return per_gpu
+
+    def required_cores(self, container):
+        """
+        :param container: Container object
+        :return: number of cpu cores to pin the container to, the declared num_cpus or cores_per_gpu per gpu (cpu
+                 containers count as one gpu)
+        """
+        num_cpus = container.config.num_cpus
+        if num_cpus:
+            return int(num_cpus)
+        return self.cores_per_gpu() * max(1, container.config.num_gpus)
+
+    @staticmethod
+    def gpu_nodes(minors):
+        """
+        :param minors: gpu minors as strings
+        :return: NUMA node of each gpu whose node is known
+        """
+        numa_nodes = gpu_backend.get_backend().numa_nodes()
+        return [numa_nodes[int(minor)] for minor in minors if minor.isdigit() and int(minor) in numa_nodes]
+
+    def pin_spare_cores(self, container):
+        """
+        Pin a cpu container to cores that are not needed for jobs on the free gpus, starting on the node with most of
+        them
+        :param container: Container object
+        :return: tuple of (cpus, memory nodes), None if there are not enough spare cores
+        """
+        spare = dict((node, max(0, cores)) for node, cores in self.spare_cores().items())
+        # a declaration larger than the cores that can ever be spare would block the queue for good
+        required = self.required_cores(container)
+        num_cores = min(required,
+                        max(1, self.core_ledger.num_cores - self.cores_per_gpu() * len(self.gpu_allocator.minors)))
+        if num_cores < required and container.job_id not in self.clamped:
+            self.clamped.add(container.job_id)
+            self.logger.warning('\tcontainer {} declares {} cpus, it is pinned to the {} cores that are not kept for '
+                                'gpu jobs'.format(container.name, required, num_cores))
+        if sum(spare.values()) < num_cores:
+            return None
+        nodes = sorted(spare, key=lambda node: (-spare[node], node))[:1]
+        return self.core_ledger.allocate(container.job_id, num_cores, nodes=nodes, limits=spare)
+
+    def spare_cores(self):
+        """
+        :return: dictionary mapping NUMA node to its free cores minus the cores needed for jobs on its free gpus
+        """
+        numa_nodes = gpu_backend.get_backend().numa_nodes()
+        spare = self.core_ledger.free_cores()
+        for minor in self.gpu_allocator.free_minors():
+            if numa_nodes.get(minor) in spare:
+                spare[numa_nodes[minor]] -= self.cores_per_gpu()
+        return spare
+
+    def release(self, container):
+        """
+        Release all resources reserved for a container
+        :param container: Container object
+        :return: None
+        """
+        self.gpu_allocator.release(container.job_id)
+        self.memory_ledger.release(container.job_id)
+        if self.core_ledger is not None:
+            self.core_ledger.release(container.job_id)
+        container.cpuset = None
+
+    def select_next(self):
+        """
+        Summary of the function:
+        ------------------------
+        (a) Reserve resources for the first container in the queue and take it out of the queue
+        (b) If the first container does not fit and backfill is enabled, look at the next containers in priority order
+            and take the first one that fits into the free resources instead
+        (c) Once the blocked head has been bypassed 'backfill.max.bypass' times by gpu containers, free gpus and the
+            memory the head requires are kept for it and only cpu containers that fit into the remaining memory can be
+            backfilled until the head has been started
+        (d) Containers that require more than the host can ever provide are skipped, they neither run nor block
+
+        Parameters:
+        -----------
+        :arg: None
+        :return: tuple of (container, reserved gpu minors) or None if no container can be started now
+        """
+        queue_config = self.config['queue']
+        depth = queue_config['backfill_depth'] if queue_config['backfill'] else 0
+        ordered = self.container_list.ordered(limit=depth + 1, where=self.can_ever_fit)
+        if not ordered:
+            return None
+        head = ordered[0]
+
+        minors = self.reserve(head)
+        if minors is not None:
+            self.blocked_head = None
+            self.head_bypasses = 0
+            self.container_list.remove(head.job_id)
+            return head, minors
+
+        if not queue_config['backfill']:
+            return None
+
+        if self.blocked_head != head.job_id:
+            self.blocked_head = head.job_id
+            self.head_bypasses = 0
+        head_reserved = self.head_bypasses >= queue_config['backfill_max_bypass']
+        keep_free_memory = head.config.required_memory_bytes if head_reserved else 0
+
+        for candidate in ordered[1:]:
+            if head_reserved and candidate.use_gpu:
+                continue
+
+            minors = self.reserve(candidate, keep_free_memory=keep_free_memory)
+            if minors is not None:
+                if candidate.use_gpu:
+                    self.head_bypasses += 1
+                self.container_list.remove(candidate.job_id)
+                self.logger.info('\tbackfilled {} past blocked container {}'.format(candidate.name, head.name))
+                return candidate, minors
+
+        return None
+
+    def can_ever_fit(self, container):
+        """
+        Check whether a container fits into the host once nothing else is running, reports containers that do not
+        :param container: Container object
+        :return: True if the container can be started at some point
+        """
+        fits = self.memory_ledger.can_fit(container.config.required_memory_bytes) and \
+            (not container.use_gpu or container.config.num_gpus <= len(self.gpu_allocator.minors))
+        if not fits and container.job_id not in self.unfittable:
+            self.unfittable.add(container.job_id)
+            self.logger.error('\tcontainer {} requires more memory or gpus than the host provides, it is skipped '
+                              'until it is removed from the queue'.format(container.name))
+        return fits
+
+    def schedule_tick(self):
+        """
+        Summary of the function:
+        ------------------------
+        (a) Select and reserve containers until no queued container fits the remaining resources
+        (b) Hand the selected containers to the start pool, which creates and starts them in its worker threads. The
+            scheduler does not wait for docker and can take the next decision right away.
+        (c) The results are picked up by collect_started in a later tick, the reservations are held until then
+
+        Parameters:
+        -----------
+        :arg: None
+        :return: list of containers handed to the start pool
+        """
+        launched = []
+        while True:
+            selection = self.select_next()
+            if selection is None:
+                break
+            container, minors = selection
+            # the reservation is visible to reconcile_ledgers before the worker has created the container
+            container.gpu_minors = minors
+            self.starting[container.job_id] = container
+            self.start_pool.submit(self.launch_container, container, minors)
+            launched.append(container)
+
+        return launched
+
+    def launch_container(self, container, minors):
+        """
+        worker of the start pool: create and start a container, the result is passed back to the scheduler thread
+        :param container: Container object with reserved resources
+        :param minors: reserved gpu minors
+        :return: None
+        """
+        try:
+            container.create(gpu_minors=minors, link_costs=self.gpu_allocator.link_costs)
+            container.start()
+        except Exception as e:
+            self.logger.error(traceback.format_exc())
+            self.start_results.append((container, e))
+        else:
+            self.start_results.append((container, None))
+        self.notify('container launched')
+
+    def collect_started(self):
+        """
+        Summary of the function:
+        ------------------------
+        (a) Move the containers the start pool has started to the running containers
+        (b) A failing container does not stall the others: its resources are released and it is put back into the
+            queue (IOError) or dropped (APIError and anything else)
+
+        Parameters:
+        -----------
+        :arg: None
+        :return: list of started containers
+        """
+        started = []
+        while self.start_results:
+            container, error = self.start_results.popleft()
+            self.starting.pop(container.job_id, None)
+
+            if error is None:
+                # add to running containers and write log message
+                self.running_containers.append(container)
+                container.start_stats_stream()
+                self.log_pump.watch(container)
+                self.record_start(container)
+                started.append(container)
+                self.logger.info('\tsuccessfully ran a container from {}'.format(container))
+                continue
+
+            self.release(container)
+            # APIError derives from IOError as well, but retrying a container docker refused does not help
+            if isinstance(error, IOError) and not isinstance(error, APIError):
+                self.container_list.push(container)
+
+        return started
 
     ################################## Execute Priority Queue #################################
     # This private API is launched in a separate process.
@@ -306,7 +751,7 @@ class DopQContainer():
         ------------------------
         (a) Method for running the priority queue infinitely
         (b) Update the container list and running container list
-        (c) Runs in a separate multiprocess
+        (c) Runs in a separate thread, a tick is triggered by notify() or after the sleep interval at the latest
 
         Parameters:
         -----------
@@ -321,46 +766,21 @@ class DopQContainer():
 
                 if self.lock_state:
                     print("DoPQ is in lock state (infinity loop)")
-                    time.sleep(1)
+                    self.sleep()
                     continue
                 else:
                     print("DoPQ is running without interruption")
                     self.update_container_list()
+                    self.collect_started()
                     self.update_running_containers() # For cleaning up running containers
                     if len(self.container_list) == 0:
+                        # released gpus are not waited for by anyone, nothing to measure
+                        self.pending_releases.clear()
                         self.sleep()
                         continue
 
-                    container = self.container_list.pop(0) # get next container
-                    gpu = container.use_gpu
-
-                    for c in self.container_list:
-                        print(c.history_info())
-
-                    gpu = container.use_gpu
-                    free_minors = get_gpus_status()
-                    if len(free_minors) == 0 and gpu: # keep cycling if container requires gpu but none are available
-                        self.container_list.insert(0, container)
-                        self.sleep()
-                        continue
-
-                    # start the container, write to log and append it to running containers
-                    try:
-                        container.start()
-
-                    except IOError as e:
-                        # put container back in the queue if not enough gpus are available
-                        self.container_list.insert(0, container)
-                        continue
-
-                    except APIError:
-                        continue
-
-                    else:
-                        # add to running containers and write log message
-                        self.running_containers.append(container)
-                        self.logger.info('\tsuccessfully ran a container from {}'.format(container))
-                        self.sleep()
+                    self.schedule_tick() # start every container that fits into the free resources
+                    self.sleep()
 
         except Exception as e:
             self.logger.error(traceback.format_exc())
@@ -368,9 +788,19 @@ class DopQContainer():
         finally:
             # save history, container list and running containers whenever the loop is exited for whatever reason
             print("DoPQ thread is about to stop ... saving all data")
+            self.start_pool.shutdown(wait=True)
+            self.collect_started()
+            stats_collector.get_collector().stop()
+            self.log_pump.stop()
+            gpu.get_sampler().stop()
+            if self.gpu_telemetry.record_snapshot in gpu.get_sampler().listeners:
+                gpu.get_sampler().listeners.remove(self.gpu_telemetry.record_snapshot)
             self.save('all')
 
     def dopq_stop(self):
         if self.status == 'running':
             print("Terminating the thread")
+            self.event_listener.stop()
+            self.notify()
             self.dopq_process.join()
+            self.provider_listener.join()
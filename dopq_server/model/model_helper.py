@@ -1,12 +1,89 @@
 import os
+import math
 import pickledb
 import configparser
 import numpy as np
 
 
+class PenaltyIndex(object):
+    """
+    Running, exponentially decayed penalty score per user.
+
+    The penalty of a user is sum(exp(-i)) over all positions i in the history (0 = latest) that belong to that user.
+    Instead of rebuilding this sum on every call, every history entry gets a monotonically increasing stamp k and the
+    index stores log(sum(exp(k))) per user. Pushing an entry to the head of the history is then O(1) and the stored
+    values (ranks) of all other users stay valid, since the decay of older entries only lives in the common offset.
+    User names are compared case insensitively.
+    """
+
+    def __init__(self, history=None):
+        self._log_scores = {}
+        self._length = 0
+        self.rebuild(history if history is not None else [])
+
+    def rebuild(self, history):
+        """
+        Recompute the index from scratch, e.g. after restoring or clearing the history
+        :param history: list of containers, latest container first
+        :return: None
+        """
+        self._log_scores = {}
+        self._length = 0
+        for container in reversed(history):
+            self.push(container.user)
+
+    def push(self, user):
+        """
+        Account for a new entry of user at the head of the history
+        :param user: name of the user the finished container belongs to
+        :return: None
+        """
+        user = self.key(user)
+        stamp = float(self._length)
+        log_score = self._log_scores.get(user)
+        if log_score is None:
+            self._log_scores[user] = stamp
+        else:
+            # log(exp(a) + exp(b)) without overflowing
+            high, low = max(log_score, stamp), min(log_score, stamp)
+            self._log_scores[user] = high + math.log1p(math.exp(low - high))
+        self._length += 1
+
+    def rank(self, user):
+        """
+        Order preserving, scale free version of the penalty. Ranks of different users can be compared with each other
+        and do not change when entries of other users are pushed.
+        :param user: name of the user
+        :return: log of the undecayed score, -inf if the user has no history
+        """
+        return self._log_scores.get(self.key(user), float('-inf'))
+
+    def penalty(self, user):
+        """
+        :param user: name of the user
+        :return: decayed penalty of the user
+        """
+        log_score = self._log_scores.get(self.key(user))
+        if log_score is None:
+            return 0.0
+        return math.exp(log_score - (self._length - 1))
+
+    def __len__(self):
+        return self._length
+
+    @staticmethod
+    def key(user):
+        """
+        :param user: name of the user
+        :return: normalised name the scores are stored under
+        """
+        return user.lower()
+
+
 class ModelHelper():
     def __init__(self):
         self.dopq_history = None
+        self.penalty_index = PenaltyIndex()
 
     def build_directories(self, paths):
         """
@@ -56,6 +133,21 @@ class ModelHelper():
         config.set('queue', 'verbose', 'yes')
         config.set('queue', 'sleep.interval', '10')
         config.set('queue', 'max.gpu.assignment', '1')
+        config.set('queue', 'backfill', 'yes')
+        config.set('queue', 'backfill.depth', '50')
+        config.set('queue', 'backfill.max.bypass', '8')
+        config.set('queue', 'memory.headroom', '8g')
+        config.set('queue', 'gpu.packing', 'no')
+        config.set('queue', 'gpu.max.jobs', '4')
+        config.set('queue', 'start.workers', '4')
+        config.set('queue', 'gpu.sample.interval', '2')
+        config.set('queue', 'gpu.backend', 'auto')
+        config.set('queue', 'gpu.fake.count', '2')
+        config.set('queue', 'gpu.fake.topology', '')
+        config.set('queue', 'gpu.topology', 'yes')
+        config.set('queue', 'gpu.telemetry.levels', '1:3600,60:10080')
+        config.set('queue', 'cpu.pinning', 'no')
+        config.set('queue', 'cpu.cores.per.gpu', '0')
 
         config.add_section('docker')
         config.set('docker', 'mount.volumes',
@@ -64,6 +156,12 @@ class ModelHelper():
         config.set('docker', 'network.mode', 'host')
         config.set('docker', 'mem.limit', '32g')
         config.set('docker', 'logging.interval', '10')
+        config.set('docker', 'inspect.ttl', '2')
+        config.set('docker', 'stats.samples', '60')
+        config.set('docker', 'log.max.size', '10m')
+        config.set('docker', 'log.backups', '5')
+        config.set('docker', 'log.compress', 'yes')
+        config.set('docker', 'log.tail.lines', '1000')
 
         config.add_section('fetcher')
         #config.set('fetcher', 'valid.executors', 'reza,anees,ilja,markus,kubilay')
@@ -104,12 +202,34 @@ class ModelHelper():
                        'auto_remove': config.getboolean('docker', 'remove'),
                        'mem_limit': config.get('docker', 'mem.limit'),
                        'network_mode': config.get('docker', 'network.mode'),
-                       'logging_interval': config.getint('docker', 'logging.interval')},
+                       'logging_interval': config.getint('docker', 'logging.interval'),
+                       'inspect_ttl': config.getfloat('docker', 'inspect.ttl', fallback=2.0),
+                       'stats_samples': config.getint('docker', 'stats.samples', fallback=60),
+                       'log_max_size': config.get('docker', 'log.max.size', fallback='10m'),
+                       'log_backups': config.getint('docker', 'log.backups', fallback=5),
+                       'log_compress': config.getboolean('docker', 'log.compress', fallback=True),
+                       'log_tail_lines': config.getint('docker', 'log.tail.lines', fallback=1000)},
 
             'queue': {'max_history': config.getint('queue', 'max.history'),
                       'verbose': config.getboolean('queue', 'verbose'),
                       'sleep': config.getint('queue', 'sleep.interval'),
-                      'max_gpus': config.getint('queue', 'max.gpu.assignment')},
+                      'max_gpus': config.getint('queue', 'max.gpu.assignment'),
+                      'backfill': config.getboolean('queue', 'backfill', fallback=True),
+                      'backfill_depth': config.getint('queue', 'backfill.depth', fallback=50),
+                      'backfill_max_bypass': config.getint('queue', 'backfill.max.bypass', fallback=8),
+                      'memory_headroom': config.get('queue', 'memory.headroom', fallback='8g'),
+                      'gpu_packing': config.getboolean('queue', 'gpu.packing', fallback=False),
+                      'gpu_max_jobs': config.getint('queue', 'gpu.max.jobs', fallback=4),
+                      'start_workers': config.getint('queue', 'start.workers', fallback=4),
+                      'gpu_sample_interval': config.getfloat('queue', 'gpu.sample.interval', fallback=2.0),
+                      'gpu_backend': config.get('queue', 'gpu.backend', fallback='auto'),
+                      'gpu_fake_count': config.getint('queue', 'gpu.fake.count', fallback=2),
+                      'gpu_fake_topology': config.get('queue', 'gpu.fake.topology', fallback=''),
+                      'gpu_topology': config.getboolean('queue', 'gpu.topology', fallback=True),
+                      'gpu_telemetry_levels': config.get('queue', 'gpu.telemetry.levels',
+                                                         fallback='1:3600,60:10080'),
+                      'cpu_pinning': config.getboolean('queue', 'cpu.pinning', fallback=False),
+                      'cpu_cores_per_gpu': config.getint('queue', 'cpu.cores.per.gpu', fallback=0)},
 
             'builder': {'sleep': config.getint('builder', 'sleep.interval'),
                         'load': config.get('builder', 'load.suffix').split(','),
@@ -129,9 +249,20 @@ class ModelHelper():
 
     def set_dopq_history(self, history):
         self.dopq_history = history
+        self.penalty_index.rebuild(history)
+
+    def add_to_history(self, container):
+        """
+        insert a finished container at the head of the history and update the penalty index in O(1)
+        :param container: container object that has finished executing
+        :return: None
+        """
+        self.dopq_history.insert(0, container)
+        self.penalty_index.push(self.get_user(container))
 
     def get_user_oh(self, user_name):
-        user_oh = [int(self.get_user(el) == user_name.lower()) for el in self.dopq_history]
+        user_key = PenaltyIndex.key(user_name)
+        user_oh = [int(PenaltyIndex.key(self.get_user(el)) == user_key) for el in self.dopq_history]
         return np.array(user_oh)
 
     def calc_exp_decay(self):
@@ -154,6 +285,14 @@ class ModelHelper():
         return self.split_and_calc_penalty(container), container.created_at
 
     def calc_penalty(self, user_name):
+        return self.penalty_index.penalty(user_name)
+
+    def calc_penalty_full(self, user_name):
+        """
+        reference implementation of calc_penalty that recomputes the penalty over the whole history
+        :param user_name: name of the user
+        :return: decayed penalty of the user
+        """
         user_oh = self.get_user_oh(user_name)
         return np.sum(user_oh * self.calc_exp_decay())
 
@@ -1,5 +1,21 @@
 import time
 import psutil
+import numpy as np
+
+# (section, path) of the values taken from a docker stats sample, in column order of the sample matrix
+_SAMPLE_FIELDS = (
+    ('cpu_stats', ('cpu_usage', 'total_usage')),
+    ('precpu_stats', ('cpu_usage', 'total_usage')),
+    ('cpu_stats', ('system_cpu_usage',)),
+    ('precpu_stats', ('system_cpu_usage',)),
+    ('cpu_stats', ('throttling_data', 'periods')),
+    ('precpu_stats', ('throttling_data', 'periods')),
+    ('cpu_stats', ('throttling_data', 'throttled_periods')),
+    ('precpu_stats', ('throttling_data', 'throttled_periods')),
+    ('cpu_stats', ('throttling_data', 'throttled_time')),
+    ('memory_stats', ('usage',)),
+    ('memory_stats', ('limit',)),
+)
 
 
 class CPU(object):
@@ -35,3 +51,71 @@ class CPU(object):
 
     def cpu_percent(self):
         return CPU.instance.cpu_percent()
+
+
+def _lookup(section, path):
+    for key in path:
+        if not isinstance(section, dict):
+            return 0
+        section = section.get(key)
+    return section or 0
+
+
+def _online_cpus(sample):
+    cpu_stats = sample.get('cpu_stats', {})
+    online = cpu_stats.get('online_cpus')
+    if not online:
+        # older daemons only report the per cpu usage
+        online = len(cpu_stats.get('cpu_usage', {}).get('percpu_usage') or ()) or 1
+    return online
+
+
+def _memory_breakdown(sample):
+    """
+    page cache and anonymous memory (rss) of a container, cgroup v1 and v2 use different names
+    """
+    stats = sample.get('memory_stats', {}).get('stats', {})
+    cache = stats.get('cache', stats.get('file', 0))
+    rss = stats.get('rss', stats.get('anon', 0))
+    return cache, rss
+
+
+def container_usages(samples):
+    """
+    Computes the cpu usage of many containers at once from their docker stats samples, the same way 'docker stats'
+    does: the container's cpu time delta over the system cpu time delta between the sample and the previous one
+    (precpu_stats), scaled by the number of online cpus. Throttling is the share of the cfs periods since the previous
+    sample in which the container was throttled.
+
+    :param samples: list of docker stats samples, None for containers without a sample yet
+    :return: list of dictionaries (None for missing samples) with the keys 'cpu' and 'throttled' (percent),
+             'throttled time' (seconds in total), 'memory', 'memory limit', 'memory cache' and 'memory rss' (bytes)
+    """
+    valid = [i for i, sample in enumerate(samples) if sample]
+    usages = [None] * len(samples)
+    if not valid:
+        return usages
+
+    values = np.array([[_lookup(samples[i].get(section), path) for section, path in _SAMPLE_FIELDS]
+                       + [_online_cpus(samples[i])] + list(_memory_breakdown(samples[i])) for i in valid],
+                      dtype=np.float64)
+    (total, pre_total, system, pre_system, periods, pre_periods, throttled, pre_throttled, throttled_time,
+     memory, memory_limit, online, cache, rss) = values.T
+
+    cpu_delta = total - pre_total
+    system_delta = system - pre_system
+    cpu_valid = (system_delta > 0) & (cpu_delta >= 0)
+    cpu = np.where(cpu_valid, cpu_delta / np.where(cpu_valid, system_delta, 1) * online * 100.0, 0.0)
+
+    period_delta = periods - pre_periods
+    throttled_delta = throttled - pre_throttled
+    throttled_valid = period_delta > 0
+    throttled_share = np.where(throttled_valid, throttled_delta / np.where(throttled_valid, period_delta, 1) * 100.0,
+                               0.0)
+
+    for row, i in enumerate(valid):
+        usages[i] = {'cpu': round(float(cpu[row]), 1), 'throttled': round(float(throttled_share[row]), 1),
+                     'throttled time': float(throttled_time[row]) / 1e9, 'memory': int(memory[row]),
+                     'memory limit': int(memory_limit[row]), 'memory cache': int(cache[row]),
+                     'memory rss': int(rss[row])}
+    return usages
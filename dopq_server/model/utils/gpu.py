@@ -6,54 +6,142 @@ gpu.py
 Helpers for GPU information retrieval
 """
 
-import os
-import re
 import time
-import docker
-import GPUtil
+import types
 import threading
+import traceback
+import collections
 
+from dopq_server.model.utils import log
+from dopq_server.model.utils.gpu_backend import get_backend
+from dopq_server.model.docker_helper import docker_client
 
-class GPU(object):
+LOG = log.get_module_log(__name__)
 
-    @classmethod
-    def stop_hardware_monitor(cls):
-        if cls.instance is None:
-            pass
-        elif cls.instance.thread.isAlive():
-            cls.instance.thread._Thread__stop()
 
-    class __GPU(object):
+# sampling period of the gpu sampler in seconds, if it is not set from the config
+SAMPLE_PERIOD = 2.0
 
-        def __init__(self):
-            self.stats = 0
-            self._stats = 0
-            self.thread = threading.Thread(target=self.update_stats)
-
-        def update_stats(self):
-            while True:
-                self.stats = GPUtil.getGPUs()
-
-        def gpu_stats(self):
-
-            if not self.thread.isAlive():
-                self.thread = threading.Thread(target=self.update_stats)
-                self.thread.start()
-
-            while self.stats == 0:
-                time.sleep(0.1)
-
-            return self.stats
+GPUSnapshot = collections.namedtuple('GPUSnapshot', ['time', 'gpus', 'count'])
+GPUSnapshot.__doc__ = """
+immutable result of one sampling round: time of the sample, tuple of read-only per gpu dictionaries (see
+gpu_backend.INFO_KEYS) and the number of the sample
+"""
 
-    instance = None
+EMPTY_SNAPSHOT = GPUSnapshot(0, (), 0)
 
-    def __init__(self):
 
-        if GPU.instance is None:
-            GPU.instance = GPU.__GPU()
+class GPUSampler(object):
+    """
+    Queries the GPU backend every period seconds in a background thread and publishes the result as an immutable
+    snapshot. Readers take the latest snapshot without waiting for the backend. Listeners are called with every new
+    snapshot in the sampler thread.
+    """
 
-    def gpu_stats(self):
-        return GPU.instance.gpu_stats()
+    def __init__(self, period=SAMPLE_PERIOD):
+        """
+        :param period: seconds between two samples
+        """
+        self.period = period
+        self.snapshot = EMPTY_SNAPSHOT
+        self.sample_count = 0
+        self.sample_seconds = 0.0
+        self.listeners = []
+        self.thread = None
+        self._stop_flag = threading.Event()
+        self._lock = threading.Lock()
+
+    @property
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    @property
+    def started(self):
+        # true once start has been called, also after the sampler has been stopped again
+        return self.thread is not None
+
+    def start(self, period=None):
+        """
+        start sampling, does nothing if the sampler is running already
+        :param period: seconds between two samples, keeps the current period if None
+        :return: None
+        """
+        with self._lock:
+            if period is not None:
+                self.period = period
+            if self.running:
+                return
+            self._stop_flag.clear()
+            self.thread = threading.Thread(target=self.run, name='DoPQ-GPUSampler')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def stop(self, timeout=None):
+        """
+        stop sampling and wait for the sampler thread
+        :param timeout: seconds to wait for the thread
+        :return: None
+        """
+        self._stop_flag.set()
+        thread = self.thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join(timeout)
+
+    def sample(self):
+        """
+        query the gpus once and publish the result
+        :return: the new GPUSnapshot
+        """
+        start = time.time()
+        gpus = tuple(types.MappingProxyType(info) for info in get_backend().query())
+        end = time.time()
+        with self._lock:
+            self.sample_count += 1
+            self.sample_seconds += end - start
+            self.snapshot = snapshot = GPUSnapshot(end, gpus, self.sample_count)
+
+        for listener in list(self.listeners):
+            try:
+                listener(snapshot)
+            except Exception:
+                LOG.error(traceback.format_exc())
+        return snapshot
+
+    def run(self):
+        while not self._stop_flag.is_set():
+            try:
+                self.sample()
+            except Exception:
+                LOG.error(traceback.format_exc())
+            self._stop_flag.wait(self.period)
+
+    def latest(self):
+        """
+        latest snapshot, only the very first call samples synchronously if the sampler has not produced one yet
+        :return: GPUSnapshot
+        """
+        snapshot = self.snapshot
+        if snapshot.count == 0:
+            snapshot = self.sample()
+        return snapshot
+
+    def overhead(self):
+        """
+        :return: dictionary with the number of samples, their mean duration in seconds and the sampling period
+        """
+        with self._lock:
+            count, seconds = self.sample_count, self.sample_seconds
+        return {'samples': count, 'mean': seconds / count if count else 0.0, 'period': self.period}
+
+
+_sampler = GPUSampler()
+
+
+def get_sampler():
+    """
+    :return: the gpu sampler of this process
+    """
+    return _sampler
 
 
 def get_system_gpus():
@@ -61,13 +149,7 @@ def get_system_gpus():
     Returns the GPU minors available on the system
     :return: GPU minors available on the system
     """
-    minors = []
-    for dev in os.listdir("/dev"):
-        match_dt = re.search(r'nvidia(\d+)', dev)
-        if match_dt is not None:
-            minor = int(match_dt.group(1))
-            minors.append(minor)
-    return minors
+    return get_backend().minors()
 
 
 def get_assigned_gpus(client=None):
@@ -82,7 +164,7 @@ def get_assigned_gpus(client=None):
     if client is None:
 
         # get a client
-        client = docker.from_env()
+        client = docker_client.get_client()
 
     # get system minors
     minors = get_system_gpus()
@@ -134,12 +216,14 @@ def get_gpus_status(client=None):
     return free_gpus, assigned_gpus
 
 
-def get_gpu_infos(device_ids=None, interval=2):
+def get_gpu_infos(device_ids=None, interval=SAMPLE_PERIOD):
     """
-    Provides a dictionary mapping each GPU minor (or requested) to all relevant information.
+    Provides a dictionary mapping each GPU minor (or requested) to all relevant information. The information is taken
+    from the latest snapshot of the gpu sampler, which is started if it has never been started. A stopped sampler is not
+    restarted, its last snapshot is returned.
 
     :param device_ids: List or single GPU minor to include or None if all shall be shown.
-    :param interval: integer representing the seconds that GPU waits before fetching the data again
+    :param interval: sampling period in seconds, if the sampler has to be started
     :return: Dictionary mapping each GPU minor to its information.
     """
 
@@ -153,11 +237,13 @@ def get_gpu_infos(device_ids=None, interval=2):
         if device_ids == ['all']:
             device_ids = None
 
-    gpu = GPU()
-    gpu_list = gpu.gpu_stats()
+    sampler = get_sampler()
+    if not sampler.started:
+        sampler.start(interval)
+    gpu_list = sampler.latest().gpus
     if device_ids is None:
-        gpu_dict = dict([(gpu_i.id, gpu_i.__dict__) for gpu_i in gpu_list])
+        gpu_dict = dict([(gpu_i['id'], dict(gpu_i)) for gpu_i in gpu_list])
     else:
-        gpu_dict = dict([(gpu_i.id, gpu_i.__dict__) for gpu_i in gpu_list if str(gpu_i.id) in device_ids])
+        gpu_dict = dict([(gpu_i['id'], dict(gpu_i)) for gpu_i in gpu_list if str(gpu_i['id']) in device_ids])
 
     return gpu_dict
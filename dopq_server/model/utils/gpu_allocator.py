@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+gpu_allocator.py
+
+Bookkeeping of the GPU minors held by DoPQ jobs
+"""
+
+import math
+import itertools
+import threading
+
+from dopq_server.model.utils import log
+from dopq_server.model.utils.gpu import get_system_gpus, get_assigned_gpus, get_gpu_infos
+from dopq_server.model.utils.gpu_backend import get_backend, link_cost
+
+LOG = log.get_module_log(__name__)
+
+EXTERNAL = 'external'
+
+# above this number of candidate sets the minors are chosen greedily instead of comparing all sets
+MAX_COMBINATIONS = 2000
+
+
+def read_link_costs():
+    """
+    :return: dictionary mapping (minor, minor) to the link cost (see gpu_backend.LINK_COSTS), None if the topology of
+             the GPUs is not known
+    """
+    topology = get_backend().topology()
+    if not topology:
+        return None
+    return dict(((int(minor), int(other)), link_cost(link))
+                for minor, row in topology.items() for other, link in row.items())
+
+
+def select_minors(candidates, count, costs=None):
+    """
+    Choose count minors out of the candidates with the best interconnect. A set is better if its worst pairwise link
+    is better, ties are broken by the sum of all pairwise links and then by the lowest minors. A single minor is taken
+    from where it splits the fewest good links, i.e. the candidate whose best link to the other candidates is worst.
+    :param candidates: list of free minors
+    :param count: number of minors to choose
+    :param costs: link costs from read_link_costs, the lowest minors are chosen if None
+    :return: list of count minors, in candidate order
+    """
+    if costs is None or count < 1 or len(candidates) <= count:
+        return list(candidates[:count])
+
+    def cost(a, b):
+        return costs.get((a, b), costs.get((b, a), link_cost('SYS')))
+
+    def rank(minors):
+        links = [cost(a, b) for a, b in itertools.combinations(minors, 2)]
+        return max(links), sum(links), sorted(minors)
+
+    if count == 1:
+        best = min(candidates, key=lambda m: (-min(cost(m, other) for other in candidates if other != m), m))
+        return [best]
+
+    if math.comb(len(candidates), count) <= MAX_COMBINATIONS:
+        chosen = min(itertools.combinations(candidates, count), key=rank)
+    else:
+        # grow a set from every candidate, always adding the minor with the cheapest links to the set so far
+        sets = []
+        for seed in candidates:
+            minors = [seed]
+            while len(minors) < count:
+                minors.append(min((m for m in candidates if m not in minors),
+                                  key=lambda m: (max(cost(m, o) for o in minors), sum(cost(m, o) for o in minors), m)))
+            sets.append(minors)
+        chosen = min(sets, key=rank)
+
+    return [minor for minor in candidates if minor in chosen]
+
+
+class GPUAllocator(object):
+    """
+    Ledger that records which GPU minor is held by which DoPQ job.
+
+    The ledger is reconciled with docker once (at startup or after the docker events stream was interrupted) and is
+    afterwards only updated through allocate() and release(), so scheduling decisions do not need to list containers.
+    GPUs used by containers that were not started by DoPQ are recorded as held by EXTERNAL.
+
+    By default a minor is held exclusively by one job. In packing mode, jobs that declare a gpu memory requirement
+    can share a minor as long as the sum of their declared memory fits the memory of the card and the number of jobs
+    on the minor stays below max_jobs_per_gpu. Jobs without a declaration always get whole GPUs.
+
+    If the topology of the GPUs is known, exclusive jobs get the free minors with the best interconnect (see
+    select_minors), otherwise the lowest free minors.
+    """
+
+    def __init__(self, minors=None, packing=False, max_jobs_per_gpu=1, memory_total=None, topology_aware=True,
+                 link_costs=None):
+        """
+        :param minors: GPU minors that may be handed out, all system GPUs if None
+        :param packing: whether several jobs may share one minor
+        :param max_jobs_per_gpu: maximum number of jobs on one minor in packing mode
+        :param memory_total: dictionary mapping minor to card memory in bytes, read from get_gpu_infos if None
+        :param topology_aware: whether minors are chosen by their interconnect
+        :param link_costs: dictionary mapping (minor, minor) to the link cost, read from the gpu backend if None
+        """
+        self.minors = sorted(minors if minors is not None else get_system_gpus())
+        self.packing = packing
+        self.max_jobs_per_gpu = max(1, max_jobs_per_gpu)
+        if packing and memory_total is None:
+            memory_total = dict((int(minor), int(info['memoryTotal'] * 1024 ** 2))
+                                for minor, info in get_gpu_infos().items())
+        self.memory_total = memory_total if memory_total is not None else {}
+        if topology_aware and link_costs is None:
+            link_costs = read_link_costs()
+            if link_costs is None:
+                LOG.info("\tgpu topology is not known, the lowest free minors are assigned")
+        self.link_costs = link_costs if topology_aware else None
+        # minor -> {job id: declared gpu memory in bytes, None for exclusive use}
+        self._holders = {}
+        self._lock = threading.Lock()
+
+    def reconcile(self, containers, client=None):
+        """
+        Rebuild the ledger from the running DoPQ containers and the GPUs assigned to any other container on the host
+        :param containers: running Container objects
+        :param client: Docker API client.
+        :return: None
+        """
+        holders = {}
+        for container in containers:
+            gpu_memory = container.config.required_gpu_memory_bytes if self.packing else None
+            for minor in self._parse_minors(container.gpu_minors):
+                holders.setdefault(minor, {})[container.job_id] = gpu_memory
+
+        for minor in get_assigned_gpus(client):
+            if minor not in holders:
+                holders[minor] = {EXTERNAL: None}
+
+        with self._lock:
+            self._holders = holders
+
+        LOG.info("\tgpu ledger reconciled, held minors: {}".format(sorted(holders.keys())))
+
+    def allocate(self, job_id, num_gpus, gpu_memory=None):
+        """
+        Atomically reserve num_gpus minors for a job
+        :param job_id: job id of the container the gpus are reserved for
+        :param num_gpus: number of requested gpus
+        :param gpu_memory: declared gpu memory per minor in bytes, None for exclusive use
+        :return: list of minors as strings, None if not enough gpus are available
+        """
+        with self._lock:
+            if self.packing and gpu_memory is not None:
+                candidates = self._shareable(gpu_memory)
+            else:
+                gpu_memory = None
+                candidates = [minor for minor in self.minors if not self._holders.get(minor)]
+
+            if len(candidates) < num_gpus:
+                return None
+
+            if gpu_memory is None:
+                minors = select_minors(candidates, num_gpus, self.link_costs)
+            else:
+                minors = candidates[:num_gpus]
+            for minor in minors:
+                self._holders.setdefault(minor, {})[job_id] = gpu_memory
+
+        return [str(minor) for minor in minors]
+
+    def release(self, job_id):
+        """
+        Free all minors held by a job
+        :param job_id: job id of the container
+        :return: list of released minors
+        """
+        released = []
+        with self._lock:
+            for minor, jobs in list(self._holders.items()):
+                if job_id in jobs:
+                    del jobs[job_id]
+                    released.append(minor)
+                if not jobs:
+                    del self._holders[minor]
+
+        return released
+
+    def free_minors(self):
+        """
+        :return: list of minors that are not held by anyone
+        """
+        with self._lock:
+            return [minor for minor in self.minors if not self._holders.get(minor)]
+
+    def held_by(self, job_id):
+        """
+        :param job_id: job id of the container
+        :return: list of minors held by the job
+        """
+        with self._lock:
+            return sorted(minor for minor, jobs in self._holders.items() if job_id in jobs)
+
+    def _shareable(self, gpu_memory):
+        """
+        minors that can take another job with the given memory, fullest first so that jobs are packed tightly and
+        empty GPUs stay available for exclusive jobs. Must be called with the lock held.
+        """
+        candidates = []
+        for minor in self.minors:
+            jobs = self._holders.get(minor, {})
+            if None in jobs.values() or len(jobs) >= self.max_jobs_per_gpu:
+                continue
+            remaining = self.memory_total.get(minor, 0) - sum(jobs.values())
+            if remaining >= gpu_memory:
+                candidates.append((remaining, minor))
+
+        return [minor for _, minor in sorted(candidates)]
+
+    @staticmethod
+    def _parse_minors(gpu_minors):
+        if not gpu_minors:
+            return []
+        return [int(minor) for minor in gpu_minors if minor.isdigit()]
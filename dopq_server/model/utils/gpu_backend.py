@@ -0,0 +1,444 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+gpu_backend.py
+
+Interchangeable sources of GPU information: NVML, nvidia-smi (through GPUtil) and a fake for machines without GPUs
+"""
+
+import os
+import re
+import threading
+import subprocess
+
+import GPUtil
+
+from dopq_server.model.utils import log
+from dopq_server.model.utils.numa import pci_numa_node
+
+try:
+    import pynvml
+except ImportError:
+    pynvml = None
+
+LOG = log.get_module_log(__name__)
+
+# keys of the per gpu dictionaries returned by GPUBackend.query, the attributes of GPUtil.GPU plus the power draw
+INFO_KEYS = ('id', 'uuid', 'name', 'serial', 'driver', 'display_mode', 'display_active', 'load', 'memoryUtil',
+             'memoryTotal', 'memoryUsed', 'memoryFree', 'temperature', 'power')
+
+# relative cost of the link between two GPUs as reported by nvidia-smi topo -m, lower is better
+LINK_COSTS = {'X': 0, 'NV': 1, 'PIX': 2, 'PXB': 3, 'PHB': 4, 'NODE': 5, 'SYS': 6, 'SOC': 6}
+
+_backend = None
+_lock = threading.Lock()
+
+
+def gpu_info(**values):
+    """
+    :return: dictionary with all INFO_KEYS, missing values are None
+    """
+    info = dict.fromkeys(INFO_KEYS)
+    info.update(values)
+    return info
+
+
+def link_cost(link):
+    """
+    :param link: link name of nvidia-smi topo -m, e.g. 'NV2', 'PIX' or 'SYS'
+    :return: cost of the link from LINK_COSTS, unknown links cost as much as a link across sockets
+    """
+    link = link.strip().upper()
+    if link.startswith('NV'):
+        return LINK_COSTS['NV']
+    return LINK_COSTS.get(link, LINK_COSTS['SYS'])
+
+
+class GPUBackend(object):
+    """
+    Interface of a source of GPU information. Memory values are in MiB, load and memoryUtil in [0, 1], temperature in
+    degrees Celsius and power in watts.
+    """
+
+    name = None
+    _topology = None
+    _numa_nodes = None
+
+    def minors(self):
+        """
+        :return: list of the GPU minors (int) of the system
+        """
+        raise NotImplementedError
+
+    def query(self):
+        """
+        :return: list of dictionaries with the INFO_KEYS, one per GPU, 'id' is the minor
+        """
+        raise NotImplementedError
+
+    def topology(self):
+        """
+        link matrix of the GPUs, read once and cached since the interconnect does not change at runtime
+        :return: dictionary mapping minor to a dictionary mapping minor to the link name (see LINK_COSTS), None if the
+                 topology is not known
+        """
+        if self._topology is None:
+            try:
+                self._topology = self.read_topology() or {}
+            except Exception as e:
+                LOG.warning("Could not read the gpu topology: {}".format(e))
+                self._topology = {}
+        return self._topology or None
+
+    def read_topology(self):
+        return None
+
+    def numa_nodes(self):
+        """
+        NUMA node of each GPU, read once and cached
+        :return: dictionary mapping minor to the NUMA node the GPU is attached to, GPUs with unknown node are missing
+        """
+        if self._numa_nodes is None:
+            try:
+                self._numa_nodes = self.read_numa_nodes() or {}
+            except Exception as e:
+                LOG.warning("Could not read the numa nodes of the gpus: {}".format(e))
+                self._numa_nodes = {}
+        return self._numa_nodes
+
+    def read_numa_nodes(self):
+        return None
+
+    def close(self):
+        pass
+
+
+class SMIBackend(GPUBackend):
+    """
+    Queries nvidia-smi through GPUtil, a subprocess is started for every query. Minors are found by scanning /dev.
+    """
+
+    name = 'smi'
+
+    def minors(self):
+        minors = []
+        for dev in os.listdir("/dev"):
+            match_dt = re.search(r'nvidia(\d+)', dev)
+            if match_dt is not None:
+                minors.append(int(match_dt.group(1)))
+        return minors
+
+    def query(self):
+        return [gpu_info(**gpu_i.__dict__) for gpu_i in GPUtil.getGPUs()]
+
+    def read_topology(self):
+        output = subprocess.check_output(['nvidia-smi', 'topo', '-m'], universal_newlines=True, timeout=30)
+        return parse_topology_matrix(output)
+
+    def read_numa_nodes(self):
+        output = subprocess.check_output(['nvidia-smi', '--query-gpu=index,pci.bus_id', '--format=csv,noheader'],
+                                         universal_newlines=True, timeout=30)
+        nodes = {}
+        for line in output.splitlines():
+            if ',' in line:
+                minor, bus_id = line.split(',', 1)
+                node = pci_numa_node(bus_id)
+                if node is not None:
+                    nodes[int(minor)] = node
+        return nodes
+
+
+class NVMLBackend(GPUBackend):
+    """
+    Queries the NVIDIA management library directly. The library is initialized once and the device handles are kept,
+    a query is a few library calls per GPU instead of a subprocess.
+    """
+
+    name = 'nvml'
+
+    def __init__(self):
+        if pynvml is None:
+            raise ImportError('pynvml is not installed')
+        pynvml.nvmlInit()
+        self.driver = self._text(pynvml.nvmlSystemGetDriverVersion())
+        self.handles = []
+        for index in range(pynvml.nvmlDeviceGetCount()):
+            handle = pynvml.nvmlDeviceGetHandleByIndex(index)
+            self.handles.append((pynvml.nvmlDeviceGetMinorNumber(handle), handle))
+        self._pid = os.getpid()
+
+    @staticmethod
+    def _text(value):
+        return value.decode('utf-8') if isinstance(value, bytes) else value
+
+    @staticmethod
+    def _optional(function, *args):
+        try:
+            return function(*args)
+        except pynvml.NVMLError:
+            return None
+
+    def minors(self):
+        return [minor for minor, _ in self.handles]
+
+    def query(self):
+        infos = []
+        for minor, handle in self.handles:
+            memory = pynvml.nvmlDeviceGetMemoryInfo(handle)
+            utilization = self._optional(pynvml.nvmlDeviceGetUtilizationRates, handle)
+            power = self._optional(pynvml.nvmlDeviceGetPowerUsage, handle)
+            total, used = memory.total / 1024.0 ** 2, memory.used / 1024.0 ** 2
+            infos.append(gpu_info(
+                id=minor, uuid=self._text(pynvml.nvmlDeviceGetUUID(handle)),
+                name=self._text(pynvml.nvmlDeviceGetName(handle)),
+                serial=self._text(self._optional(pynvml.nvmlDeviceGetSerial, handle)), driver=self.driver,
+                load=utilization.gpu / 100.0 if utilization is not None else None,
+                memoryUtil=used / total if total else 0.0, memoryTotal=total, memoryUsed=used,
+                memoryFree=memory.free / 1024.0 ** 2,
+                temperature=self._optional(pynvml.nvmlDeviceGetTemperature, handle, pynvml.NVML_TEMPERATURE_GPU),
+                power=power / 1000.0 if power is not None else None))
+        return infos
+
+    def read_topology(self):
+        bus_ids = dict((minor, self._text(pynvml.nvmlDeviceGetPciInfo(handle).busId).lower())
+                       for minor, handle in self.handles)
+        levels = {getattr(pynvml, 'NVML_TOPOLOGY_INTERNAL', 0): 'PIX',
+                  getattr(pynvml, 'NVML_TOPOLOGY_SINGLE', 10): 'PIX',
+                  getattr(pynvml, 'NVML_TOPOLOGY_MULTIPLE', 20): 'PXB',
+                  getattr(pynvml, 'NVML_TOPOLOGY_HOSTBRIDGE', 30): 'PHB',
+                  getattr(pynvml, 'NVML_TOPOLOGY_NODE', 40): 'NODE',
+                  getattr(pynvml, 'NVML_TOPOLOGY_SYSTEM', 50): 'SYS'}
+
+        topology = {}
+        for minor, handle in self.handles:
+            nvlinks = self._nvlink_peers(handle)
+            row = topology[minor] = {}
+            for other, other_handle in self.handles:
+                if other == minor:
+                    row[other] = 'X'
+                elif nvlinks.get(bus_ids[other]):
+                    row[other] = 'NV{}'.format(nvlinks[bus_ids[other]])
+                else:
+                    level = self._optional(pynvml.nvmlDeviceGetTopologyCommonAncestor, handle, other_handle)
+                    row[other] = levels.get(level, 'SYS')
+        return topology
+
+    def read_numa_nodes(self):
+        nodes = {}
+        for minor, handle in self.handles:
+            node = pci_numa_node(self._text(pynvml.nvmlDeviceGetPciInfo(handle).busId))
+            if node is not None:
+                nodes[minor] = node
+        return nodes
+
+    def _nvlink_peers(self, handle):
+        """
+        :return: dictionary mapping the pci bus id of each NVLink peer to the number of active links to it
+        """
+        peers = {}
+        for link in range(getattr(pynvml, 'NVML_NVLINK_MAX_LINKS', 18)):
+            if not self._optional(pynvml.nvmlDeviceGetNvLinkState, handle, link):
+                continue
+            remote = self._optional(pynvml.nvmlDeviceGetNvLinkRemotePciInfo, handle, link)
+            if remote is not None:
+                bus_id = self._text(remote.busId).lower()
+                peers[bus_id] = peers.get(bus_id, 0) + 1
+        return peers
+
+    def close(self):
+        if self._pid == os.getpid():
+            pynvml.nvmlShutdown()
+
+
+class FakeBackend(GPUBackend):
+    """
+    Deterministic GPUs for tests, benchmarks and machines without GPUs. Load and used memory of each fake GPU are
+    set with set_usage, temperature and power follow the load. Topology and NUMA nodes are unknown unless given.
+    """
+
+    name = 'fake'
+
+    def __init__(self, num_gpus=2, memory_total=24576.0, topology=None, numa_nodes=None):
+        """
+        :param num_gpus: number of fake GPUs, minors 0 .. num_gpus - 1
+        :param memory_total: memory per GPU in MiB
+        :param topology: link matrix (see GPUBackend.topology) or a description for grouped_topology, e.g.
+                         'nvlink=2,socket=4', every socket of a description is a NUMA node
+        :param numa_nodes: dictionary mapping minor to NUMA node
+        """
+        self.memory_total = float(memory_total)
+        self.usage = dict((minor, (0.0, 0.0)) for minor in range(num_gpus))
+        self.query_count = 0
+        if isinstance(topology, str) and topology:
+            spec = parse_topology_spec(topology)
+            topology = self.grouped_topology(num_gpus, **spec)
+            if numa_nodes is None and spec.get('socket'):
+                numa_nodes = dict((minor, minor // spec['socket']) for minor in range(num_gpus))
+        self.fake_topology = topology or None
+        self.fake_numa_nodes = numa_nodes
+
+    @staticmethod
+    def grouped_topology(num_gpus, nvlink=1, socket=0):
+        """
+        link matrix of consecutive minors grouped like on a typical multi socket server
+        :param num_gpus: number of GPUs
+        :param nvlink: number of consecutive minors connected by NVLink
+        :param socket: number of consecutive minors on one CPU socket, all on one socket if 0
+        :return: link matrix
+        """
+        nvlink, socket = max(1, nvlink), socket or num_gpus
+        topology = {}
+        for minor in range(num_gpus):
+            row = topology[minor] = {}
+            for other in range(num_gpus):
+                if other == minor:
+                    row[other] = 'X'
+                elif minor // nvlink == other // nvlink:
+                    row[other] = 'NV2'
+                elif minor // socket == other // socket:
+                    row[other] = 'NODE'
+                else:
+                    row[other] = 'SYS'
+        return topology
+
+    def read_topology(self):
+        return self.fake_topology
+
+    def read_numa_nodes(self):
+        return self.fake_numa_nodes
+
+    def set_usage(self, minor, load=0.0, memory_used=0.0):
+        """
+        :param minor: GPU minor
+        :param load: utilization in [0, 1]
+        :param memory_used: used memory in MiB
+        """
+        self.usage[int(minor)] = (float(load), float(memory_used))
+
+    def minors(self):
+        return sorted(self.usage)
+
+    def query(self):
+        self.query_count += 1
+        infos = []
+        for minor in self.minors():
+            load, used = self.usage[minor]
+            infos.append(gpu_info(
+                id=minor, uuid='GPU-fake-{}'.format(minor), name='Fake GPU', serial=str(minor), driver='fake',
+                display_mode='Disabled', display_active='Disabled', load=load, memoryUtil=used / self.memory_total,
+                memoryTotal=self.memory_total, memoryUsed=used, memoryFree=self.memory_total - used,
+                temperature=30.0 + 50.0 * load, power=50.0 + 250.0 * load))
+        return infos
+
+
+def parse_topology_matrix(output):
+    """
+    :param output: output of nvidia-smi topo -m
+    :return: link matrix of the GPU rows and columns, NICs and the affinity columns are ignored
+    """
+    lines = [re.sub(r'\x1b\[[0-9;]*m', '', line) for line in output.splitlines() if line.strip()]
+    if not lines:
+        return None
+    columns = [cell.strip() for cell in lines[0].split('\t')]
+
+    topology = {}
+    for line in lines[1:]:
+        cells = [cell.strip() for cell in line.split('\t')]
+        match = re.match(r'GPU(\d+)$', cells[0])
+        if match is None:
+            continue
+        row = topology[int(match.group(1))] = {}
+        for column, cell in zip(columns[1:], cells[1:]):
+            other = re.match(r'GPU(\d+)$', column)
+            if other is not None:
+                row[int(other.group(1))] = cell
+    return topology or None
+
+
+def parse_topology_spec(value):
+    """
+    :param value: description of a fake topology like 'nvlink=2,socket=4'
+    :return: keyword arguments of FakeBackend.grouped_topology
+    """
+    spec = {}
+    for item in value.split(','):
+        key, _, number = item.partition('=')
+        if key.strip() not in ('nvlink', 'socket'):
+            raise ValueError('unknown fake topology key: {}'.format(key))
+        spec[key.strip()] = int(number)
+    return spec
+
+
+def create_backend(name='auto', fake_gpus=2, fake_topology=None):
+    """
+    :param name: 'nvml', 'smi', 'fake' or 'auto' (NVML if it can be initialized, nvidia-smi otherwise)
+    :param fake_gpus: number of GPUs of the fake backend
+    :param fake_topology: topology of the fake backend, see FakeBackend
+    :return: GPUBackend instance
+    """
+    name = name.lower()
+    if name == 'fake':
+        return FakeBackend(fake_gpus, topology=fake_topology)
+    if name == 'smi':
+        return SMIBackend()
+    if name == 'nvml':
+        return NVMLBackend()
+    if name != 'auto':
+        raise ValueError('unknown gpu backend: {}'.format(name))
+
+    try:
+        return NVMLBackend()
+    except Exception as e:
+        LOG.info("NVML is not available ({}), falling back to nvidia-smi".format(e))
+        return SMIBackend()
+
+
+def configure(name='auto', fake_gpus=2, fake_topology=None):
+    """
+    set the GPU backend of this process from the config. With 'auto', a backend that has been set already (e.g. a fake
+    by a benchmark) is kept.
+    :param name: see create_backend
+    :param fake_gpus: number of GPUs of the fake backend
+    :param fake_topology: topology of the fake backend, see FakeBackend
+    :return: the backend
+    """
+    if name.lower() == 'auto' and _backend is not None:
+        return _backend
+    return set_backend(create_backend(name, fake_gpus, fake_topology))
+
+
+def get_backend():
+    """
+    :return: the GPU backend of this process, chosen automatically on first use if none has been set
+    """
+    global _backend
+    if _backend is None:
+        with _lock:
+            if _backend is None:
+                _backend = create_backend()
+    return _backend
+
+
+def set_backend(backend):
+    """
+    replace the GPU backend of this process
+    :param backend: GPUBackend instance
+    :return: the backend
+    """
+    global _backend
+    with _lock:
+        previous, _backend = _backend, backend
+    if previous is not None and previous is not backend:
+        previous.close()
+    return backend
+
+
+def _forget_nvml():
+    global _backend
+    # NVML handles of the parent must not be used in a forked child, it initializes its own backend
+    if isinstance(_backend, NVMLBackend):
+        _backend = None
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_forget_nvml)
@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+gpu_telemetry.py
+
+Time series of the GPU usage in preallocated numpy ring buffers at several resolutions
+"""
+
+import time
+import threading
+
+import numpy as np
+
+from dopq_server.model.utils import log
+
+LOG = log.get_module_log(__name__)
+
+# recorded values of each gpu, keys of the gpu info dictionaries
+METRICS = ('load', 'memoryUsed', 'temperature', 'power')
+
+# (seconds per slot, number of slots): 1s for an hour and 1min for a week
+DEFAULT_LEVELS = ((1, 3600), (60, 7 * 24 * 60))
+
+
+def parse_levels(value):
+    """
+    :param value: config string like '1:3600,60:10080' (seconds per slot:number of slots)
+    :return: tuple of (resolution, length) tuples, finest first
+    """
+    levels = []
+    for item in value.split(','):
+        resolution, length = item.split(':')
+        levels.append((float(resolution), int(length)))
+    return tuple(sorted(levels))
+
+
+class TelemetryLevel(object):
+    """
+    Ring buffer of one resolution. Each slot holds the mean of all samples that fell into its time bucket, the slot of
+    the current bucket is updated with every sample.
+    """
+
+    def __init__(self, resolution, length, shape):
+        """
+        :param resolution: seconds per slot
+        :param length: number of slots
+        :param shape: shape of one sample, (number of gpus, number of metrics)
+        """
+        self.resolution = resolution
+        self.length = length
+        self.times = np.full(length, np.nan)
+        self.values = np.full((length,) + tuple(shape), np.nan, dtype=np.float32)
+        self._bucket = None
+        self._sum = np.zeros(shape)
+        self._count = np.zeros(shape)
+
+    @property
+    def nbytes(self):
+        return self.times.nbytes + self.values.nbytes + self._sum.nbytes + self._count.nbytes
+
+    @property
+    def span(self):
+        return self.resolution * self.length
+
+    def add(self, timestamp, values):
+        """
+        :param timestamp: unix time of the sample
+        :param values: array of the sample shape, NaN for missing values
+        :return: None
+        """
+        bucket = int(timestamp // self.resolution)
+        if bucket != self._bucket:
+            self._bucket = bucket
+            self._sum[:] = 0
+            self._count[:] = 0
+
+        valid = ~np.isnan(values)
+        self._sum[valid] += values[valid]
+        self._count[valid] += 1
+
+        slot = bucket % self.length
+        self.times[slot] = bucket * self.resolution
+        with np.errstate(invalid='ignore', divide='ignore'):
+            self.values[slot] = self._sum / self._count
+
+    def select(self, start, end):
+        """
+        :return: (times, values) of the slots between start and end, ordered by time
+        """
+        mask = (self.times >= start) & (self.times <= end)
+        indices = np.nonzero(mask)[0]
+        order = indices[np.argsort(self.times[indices])]
+        return self.times[order], self.values[order]
+
+
+class GPUTelemetry(object):
+    """
+    Records the METRICS of every GPU at all levels. The memory footprint is fixed when the store is created and does
+    not grow with the uptime.
+    """
+
+    def __init__(self, minors, levels=DEFAULT_LEVELS):
+        """
+        :param minors: GPU minors to record
+        :param levels: tuple of (seconds per slot, number of slots)
+        """
+        self.minors = sorted(int(minor) for minor in minors)
+        self._rows = dict((minor, row) for row, minor in enumerate(self.minors))
+        shape = (len(self.minors), len(METRICS))
+        self.levels = [TelemetryLevel(resolution, length, shape) for resolution, length in sorted(levels)]
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def footprint(num_gpus, levels=DEFAULT_LEVELS):
+        """
+        :return: bytes the ring buffers of a store with these parameters occupy
+        """
+        slot_bytes = 8 + 4 * num_gpus * len(METRICS)
+        return sum(length * slot_bytes for _, length in levels) + len(levels) * 2 * 8 * num_gpus * len(METRICS)
+
+    @property
+    def nbytes(self):
+        return sum(level.nbytes for level in self.levels)
+
+    def record(self, timestamp, infos):
+        """
+        :param timestamp: unix time of the sample
+        :param infos: iterable of gpu info dictionaries (see gpu_backend.INFO_KEYS)
+        :return: None
+        """
+        values = np.full((len(self.minors), len(METRICS)), np.nan)
+        for info in infos:
+            row = self._rows.get(int(info['id']))
+            if row is None:
+                continue
+            values[row] = [np.nan if info.get(metric) is None else info[metric] for metric in METRICS]
+
+        with self._lock:
+            for level in self.levels:
+                level.add(timestamp, values)
+
+    def record_snapshot(self, snapshot):
+        """
+        listener for the gpu sampler
+        :param snapshot: gpu.GPUSnapshot
+        :return: None
+        """
+        self.record(snapshot.time, snapshot.gpus)
+
+    def query(self, start=None, end=None, minors=None, resolution=None):
+        """
+        :param start: unix time, defaults to one hour before end
+        :param end: unix time, defaults to now
+        :param minors: list of GPU minors, all if None
+        :param resolution: seconds per slot of the level to read, the finest level that reaches back to start if None
+        :return: dictionary with the 'resolution', the slot 'times' and per minor a dictionary of metric -> values
+                 (None where no sample has been recorded)
+        """
+        now = time.time()
+        end = now if end is None else end
+        start = end - 3600 if start is None else start
+
+        if resolution is not None:
+            level = min(self.levels, key=lambda l: abs(l.resolution - resolution))
+        else:
+            # a level holds the last span seconds up to now
+            reaching = [l for l in self.levels if now - l.span <= start]
+            level = reaching[0] if reaching else self.levels[-1]
+
+        with self._lock:
+            times, values = level.select(start, end)
+
+        minors = self.minors if minors is None else [int(minor) for minor in minors if int(minor) in self._rows]
+        series = {}
+        for minor in minors:
+            row = values[:, self._rows[minor], :]
+            series[minor] = dict((metric, [None if np.isnan(v) else float(v) for v in row[:, column]])
+                                 for column, metric in enumerate(METRICS))
+        return {'resolution': level.resolution, 'times': times.tolist(), 'gpus': series}
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+memory.py
+
+Host memory bookkeeping for the admission control of the queue
+"""
+
+import threading
+import psutil
+
+from dopq_server.model.utils import log
+
+LOG = log.get_module_log(__name__)
+
+UNITS = {'b': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3, 't': 1024 ** 4}
+
+
+def parse_memory(value):
+    """
+    Converts a docker style memory string to bytes. Values without unit are interpreted as GB, like the mem limit in
+    ContainerConfig.docker_params.
+    :param value: e.g. '32g', '512m', '1.5g' or 20
+    :return: number of bytes as int
+    """
+    value = str(value).strip().lower()
+    if value.endswith('b') and len(value) > 1 and value[-2] in UNITS:
+        value = value[:-1]
+    if value and value[-1] in UNITS:
+        return int(float(value[:-1]) * UNITS[value[-1]])
+    return int(float(value) * UNITS['g'])
+
+
+class MemoryLedger(object):
+    """
+    Tracks the host memory reserved by running jobs against the host capacity minus a headroom
+    """
+
+    def __init__(self, headroom=0, capacity=None):
+        """
+        :param headroom: memory (bytes or docker style string) that is never handed out to jobs
+        :param capacity: total host memory in bytes, read from the system if None
+        """
+        if capacity is None:
+            capacity = psutil.virtual_memory().total
+        self.capacity = int(capacity)
+        self.headroom = parse_memory(headroom)
+        self._reservations = {}
+        self._lock = threading.Lock()
+
+    @property
+    def reserved(self):
+        return sum(self._reservations.values())
+
+    @property
+    def free(self):
+        return self.capacity - self.headroom - self.reserved
+
+    def can_fit(self, amount):
+        """
+        :param amount: memory in bytes
+        :return: True if the amount fits into the capacity minus the headroom once no other job holds memory
+        """
+        return amount <= self.capacity - self.headroom
+
+    def reconcile(self, containers):
+        """
+        Rebuild the reservations from the running containers
+        :param containers: running Container objects
+        :return: None
+        """
+        with self._lock:
+            self._reservations = dict((c.job_id, c.config.required_memory_bytes) for c in containers)
+
+    def reserve(self, job_id, amount, keep_free=0):
+        """
+        Atomically reserve memory for a job if it fits
+        :param job_id: job id of the container
+        :param amount: memory in bytes
+        :param keep_free: bytes that have to stay free after the reservation, e.g. for a job that waits for gpus
+        :return: True if the memory has been reserved
+        """
+        with self._lock:
+            if job_id in self._reservations:
+                return True
+            if self.free - keep_free < amount:
+                return False
+            self._reservations[job_id] = amount
+        return True
+
+    def release(self, job_id):
+        """
+        :param job_id: job id of the container
+        :return: number of released bytes
+        """
+        with self._lock:
+            return self._reservations.pop(job_id, 0)
@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+numa.py
+
+NUMA topology of the host and bookkeeping of the cpu cores pinned to DoPQ jobs
+"""
+
+import os
+import glob
+import threading
+
+from dopq_server.model.utils import log
+
+LOG = log.get_module_log(__name__)
+
+SYSFS = '/sys'
+
+
+def parse_cpu_list(value):
+    """
+    :param value: cpu list in sysfs / cpuset format, e.g. '0-11,24-35'
+    :return: sorted list of cpu numbers
+    """
+    cpus = set()
+    for item in value.strip().split(','):
+        item = item.strip()
+        if not item:
+            continue
+        first, _, last = item.partition('-')
+        cpus.update(range(int(first), int(last or first) + 1))
+    return sorted(cpus)
+
+
+def format_cpu_list(cpus):
+    """
+    :param cpus: iterable of cpu numbers
+    :return: cpu list in cpuset format with ranges, e.g. '0-3,8'
+    """
+    ranges = []
+    for cpu in sorted(set(cpus)):
+        if ranges and ranges[-1][1] == cpu - 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ','.join(str(first) if first == last else '{}-{}'.format(first, last) for first, last in ranges)
+
+
+def read_host_nodes(sysfs=SYSFS):
+    """
+    :param sysfs: mount point of sysfs
+    :return: dictionary mapping NUMA node to the sorted list of its online cpus, a single node 0 with all cpus on
+             hosts without NUMA information
+    """
+    try:
+        with open(os.path.join(sysfs, 'devices/system/cpu/online')) as f:
+            online = set(parse_cpu_list(f.read()))
+    except (IOError, ValueError):
+        online = set(range(os.cpu_count() or 1))
+
+    nodes = {}
+    for path in glob.glob(os.path.join(sysfs, 'devices/system/node/node[0-9]*')):
+        try:
+            with open(os.path.join(path, 'cpulist')) as f:
+                cpus = [cpu for cpu in parse_cpu_list(f.read()) if cpu in online]
+        except (IOError, ValueError):
+            continue
+        if cpus:
+            nodes[int(os.path.basename(path)[len('node'):])] = cpus
+
+    return nodes or {0: sorted(online)}
+
+
+def pci_numa_node(bus_id, sysfs=SYSFS):
+    """
+    :param bus_id: pci bus id, e.g. '00000000:3B:00.0' (NVML) or '0000:3b:00.0' (sysfs)
+    :param sysfs: mount point of sysfs
+    :return: NUMA node of the device, None if it is not known
+    """
+    domain, _, rest = bus_id.strip().lower().rpartition(':')
+    domain, _, bus = domain.rpartition(':')
+    address = '{:04x}:{}:{}'.format(int(domain or '0', 16), bus, rest)
+    try:
+        with open(os.path.join(sysfs, 'bus/pci/devices', address, 'numa_node')) as f:
+            node = int(f.read())
+    except (IOError, ValueError):
+        return None
+    return node if node >= 0 else None
+
+
+class CoreLedger(object):
+    """
+    Records which cpu cores are pinned to which DoPQ job, so that no core is handed to two jobs at the same time.
+
+    Cores are taken from the NUMA nodes of the job's GPUs first, split over the nodes in proportion to the GPUs on
+    them. Cores that the nodes of the GPUs do not have free are taken from the other nodes with the most free cores.
+    The memory nodes of a job are the nodes of its cores.
+    """
+
+    def __init__(self, nodes=None):
+        """
+        :param nodes: dictionary mapping NUMA node to its cpus, read from sysfs if None
+        """
+        self.nodes = dict((int(node), sorted(cpus)) for node, cpus in
+                          (nodes if nodes is not None else read_host_nodes()).items())
+        self.node_of = dict((cpu, node) for node, cpus in self.nodes.items() for cpu in cpus)
+        # cpu -> job id
+        self._holders = {}
+        self._lock = threading.Lock()
+
+    @property
+    def num_cores(self):
+        return len(self.node_of)
+
+    def reconcile(self, containers):
+        """
+        Rebuild the ledger from the cpusets of the running containers
+        :param containers: running Container objects
+        :return: None
+        """
+        holders = {}
+        for container in containers:
+            if container.cpuset is not None:
+                holders.update((cpu, container.job_id) for cpu in container.cpuset[0] if cpu in self.node_of)
+
+        with self._lock:
+            self._holders = holders
+
+    def allocate(self, job_id, num_cores, nodes=(), limits=None):
+        """
+        Atomically pin cores to a job
+        :param job_id: job id of the container
+        :param num_cores: number of cores, at most all cores of the host
+        :param nodes: preferred NUMA nodes, e.g. the node of each of the job's GPUs. A node may be listed several
+                      times, the cores are split over the entries.
+        :param limits: dictionary mapping NUMA node to the most cores that may be taken from it, no limit if None
+        :return: tuple of (list of cpus, list of memory nodes), None if not enough cores are free
+        """
+        num_cores = max(1, min(num_cores, self.num_cores))
+        with self._lock:
+            free = dict((node, [cpu for cpu in cpus if cpu not in self._holders]) for node, cpus in self.nodes.items())
+            if limits is not None:
+                free = dict((node, cpus[:max(0, limits.get(node, 0))]) for node, cpus in free.items())
+            if sum(len(cpus) for cpus in free.values()) < num_cores:
+                return None
+
+            preferred = [node for node in nodes if node in free]
+            cpus = []
+            # the share of each preferred node first, so that a job on two nodes leaves cores for the other gpus
+            for node in sorted(set(preferred)):
+                share = -(-num_cores * preferred.count(node) // len(preferred))
+                taken = free[node][:min(share, num_cores - len(cpus))]
+                free[node] = free[node][len(taken):]
+                cpus += taken
+
+            others = sorted((node for node in free if node not in preferred), key=lambda n: -len(free[n]))
+            for node in sorted(set(preferred)) + others:
+                cpus += free[node][:num_cores - len(cpus)]
+
+            for cpu in cpus:
+                self._holders[cpu] = job_id
+
+        return sorted(cpus), sorted(set(self.node_of[cpu] for cpu in cpus))
+
+    def release(self, job_id):
+        """
+        :param job_id: job id of the container
+        :return: list of released cpus
+        """
+        with self._lock:
+            released = [cpu for cpu, holder in self._holders.items() if holder == job_id]
+            for cpu in released:
+                del self._holders[cpu]
+        return sorted(released)
+
+    def held_by(self, job_id):
+        """
+        :param job_id: job id of the container
+        :return: sorted list of the cpus pinned to the job
+        """
+        with self._lock:
+            return sorted(cpu for cpu, holder in self._holders.items() if holder == job_id)
+
+    def free_cores(self):
+        """
+        :return: dictionary mapping NUMA node to the number of its free cores
+        """
+        with self._lock:
+            return dict((node, sum(1 for cpu in cpus if cpu not in self._holders))
+                        for node, cpus in self.nodes.items())
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+test_container_queue.py
+
+Ordering of the heap based container queue compared to sorting the list by the penalty of its users
+"""
+
+import uuid
+import random
+
+from dopq_server.model.model_helper import ModelHelper
+from dopq_server.model.container_handler.container_queue import ContainerQueue
+
+
+class FakeContainer(object):
+
+    def __init__(self, user, created_at):
+        self.user = user
+        self.created_at = created_at
+        self.job_id = str(uuid.uuid4())
+
+    def __repr__(self):
+        return '{}@{}'.format(self.user, self.created_at)
+
+
+def make_queue(history_users, queued):
+    helper = ModelHelper()
+    helper.set_dopq_history([FakeContainer(user, 0) for user in history_users])
+    containers = [FakeContainer(user, created_at) for user, created_at in queued]
+    return helper, ContainerQueue(helper.penalty_index, containers), containers
+
+
+def finish(helper, queue, user):
+    helper.add_to_history(FakeContainer(user, 0))
+    queue.rekey(user)
+
+
+def assert_sorted_like_baseline(helper, queue, containers):
+    expected = sorted((c for c in containers if c in queue), key=helper.sort_fn)
+    assert list(queue) == expected
+    assert queue.peek() is (expected[0] if expected else None)
+
+
+def random_workload(seed):
+    rng = random.Random(seed)
+    users = ['anna', 'Ben', 'carl', 'dora', 'eve']
+    history = [rng.choice(users) for _ in range(30)]
+    queued = [(rng.choice(users), created_at) for created_at in rng.sample(range(1000), 60)]
+    return rng, users, history, queued
+
+
+def test_ordering_matches_sorted_list():
+    for seed in range(5):
+        _, _, history, queued = random_workload(seed)
+        helper, queue, containers = make_queue(history, queued)
+        assert_sorted_like_baseline(helper, queue, containers)
+
+
+def test_ordering_after_remove_pop_and_finished_jobs():
+    rng, users, history, queued = random_workload(7)
+    helper, queue, containers = make_queue(history, queued)
+
+    for step in range(40):
+        if step % 3 == 0:
+            expected = sorted(queue.ordered(), key=helper.sort_fn)[0]
+            assert queue.pop() is expected
+        elif step % 3 == 1:
+            victim = rng.choice(containers)
+            expected = victim if victim in queue else None
+            assert queue.remove(victim.job_id) is expected
+        else:
+            finish(helper, queue, rng.choice(users))
+        assert_sorted_like_baseline(helper, queue, containers)
+
+    assert queue.remove('no such job') is None
+
+
+def test_ordering_after_history_clear():
+    _, users, history, queued = random_workload(3)
+    helper, queue, containers = make_queue(history, queued)
+
+    helper.set_dopq_history([])
+    queue.rekey_all()
+    assert_sorted_like_baseline(helper, queue, containers)
+
+    for user in users[:3] + users[:1]:
+        finish(helper, queue, user)
+        assert_sorted_like_baseline(helper, queue, containers)
+
+
+def test_ordered_returns_snapshots():
+    helper, queue, containers = make_queue(['a'], [('a', 1), ('b', 2), ('b', 3), ('c', 4)])
+
+    snapshot = list(queue)
+    for container in containers:
+        if container.user == 'b':
+            queue.remove(container.job_id)
+
+    assert [c.user for c in snapshot] == ['b', 'b', 'c', 'a']
+    assert [c.user for c in queue] == ['c', 'a']
+    assert [c.user for c in queue.ordered(limit=1)] == ['c']
+    assert [c.user for c in queue.ordered(where=lambda c: c.user == 'a')] == ['a']
+
+
+def test_clear_history_then_schedule():
+    helper, queue, _ = make_queue(['a', 'a', 'a', 'b'], [('a', 1), ('b', 2)])
+
+    # clearing the history as DataPlatform.clear_dopq_history_list does
+    helper.set_dopq_history([])
+    queue.rekey_all()
+    finish(helper, queue, 'b')
+
+    assert helper.calc_penalty('a') == 0.0
+    assert helper.calc_penalty('b') == 1.0
+    assert queue.pop().user == 'a'
+
+
+def test_mixed_case_users_share_their_penalty():
+    helper, queue, _ = make_queue(['bob', 'Bob', 'carl'], [('Bob', 1), ('carl', 2)])
+
+    assert helper.calc_penalty('Bob') == helper.calc_penalty('bob') > helper.calc_penalty('carl')
+    assert [c.user for c in queue] == ['carl', 'Bob']
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+test_gpu_allocator.py
+
+Choice of gpu minors by their interconnect and the bookkeeping of the gpu ledger
+"""
+
+from dopq_server.model.utils.gpu_allocator import GPUAllocator, select_minors
+from dopq_server.model.utils.gpu_backend import link_cost
+
+
+def two_pairs():
+    # minors 0-1 and 2-3 are NVLink pairs, the pairs are connected over the cpu interconnect
+    costs = {}
+    for a in range(4):
+        for b in range(4):
+            if a != b:
+                costs[(a, b)] = link_cost('NV2' if a // 2 == b // 2 else 'SYS')
+    return costs
+
+
+def test_select_minors_without_topology_takes_lowest():
+    assert select_minors([3, 1, 2], 2) == [3, 1]
+    assert select_minors([0, 1], 3) == [0, 1]
+
+
+def test_select_minors_keeps_pairs_together():
+    costs = two_pairs()
+    assert select_minors([0, 1, 2, 3], 2, costs) == [0, 1]
+    assert select_minors([0, 2, 3], 2, costs) == [2, 3]
+    # a single gpu is taken from the broken pair, so the intact pair stays free
+    assert select_minors([0, 2, 3], 1, costs) == [0]
+
+
+def test_exclusive_allocation_and_release():
+    allocator = GPUAllocator(minors=[0, 1, 2, 3], link_costs=two_pairs())
+
+    assert allocator.allocate('a', 1) == ['0']
+    assert allocator.allocate('b', 2) == ['2', '3']
+    assert allocator.allocate('c', 2) is None
+    assert allocator.free_minors() == [1]
+
+    assert allocator.release('b') == [2, 3]
+    assert allocator.held_by('b') == []
+    assert allocator.allocate('c', 2) == ['2', '3']
+
+
+def test_packing_shares_minors_up_to_memory_and_job_limit():
+    gb = 1024 ** 3
+    allocator = GPUAllocator(minors=[0, 1], packing=True, max_jobs_per_gpu=2, memory_total={0: 16 * gb, 1: 16 * gb},
+                             topology_aware=False)
+
+    assert allocator.allocate('a', 1, gpu_memory=6 * gb) == ['0']
+    # the fullest minor that still fits is used, the other one stays free for exclusive jobs
+    assert allocator.allocate('b', 1, gpu_memory=6 * gb) == ['0']
+    assert allocator.allocate('c', 1, gpu_memory=2 * gb) == ['1']
+    assert allocator.allocate('d', 1) is None
+
+    allocator.release('c')
+    assert allocator.allocate('d', 1) == ['1']
@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+test_gpu_telemetry.py
+
+Level selection of the gpu telemetry store
+"""
+
+import time
+
+from dopq_server.model.utils.gpu_telemetry import GPUTelemetry
+from dopq_server.model.utils.gpu_backend import FakeBackend
+
+
+def record(telemetry, backend, seconds):
+    now = time.time()
+    for offset in range(seconds, 0, -1):
+        telemetry.record(now - offset, backend.query())
+
+
+def test_default_query_uses_finest_level():
+    backend = FakeBackend(2)
+    telemetry = GPUTelemetry(backend.minors())
+    record(telemetry, backend, 120)
+
+    result = telemetry.query()
+
+    assert result['resolution'] == 1
+    assert len(result['times']) >= 119
+    assert sorted(result['gpus']) == [0, 1]
+
+
+def test_range_beyond_finest_level_uses_coarser_level():
+    backend = FakeBackend(1)
+    telemetry = GPUTelemetry(backend.minors())
+    record(telemetry, backend, 120)
+
+    now = time.time()
+    assert telemetry.query(start=now - 2 * 3600, end=now)['resolution'] == 60
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+test_memory.py
+
+Host memory admission ledger
+"""
+
+from dopq_server.model.utils.memory import MemoryLedger, parse_memory
+
+GB = 1024 ** 3
+
+
+class FakeConfig(object):
+
+    def __init__(self, required_memory_bytes):
+        self.required_memory_bytes = required_memory_bytes
+
+
+class FakeContainer(object):
+
+    def __init__(self, job_id, required_memory_bytes):
+        self.job_id = job_id
+        self.config = FakeConfig(required_memory_bytes)
+
+
+def test_parse_memory():
+    assert parse_memory('512m') == 512 * 1024 ** 2
+    assert parse_memory('1.5g') == int(1.5 * GB)
+    assert parse_memory('2GB') == 2 * GB
+    assert parse_memory(20) == 20 * GB
+
+
+def test_reserve_and_release():
+    ledger = MemoryLedger(headroom='8g', capacity=32 * GB)
+
+    assert ledger.reserve('a', 16 * GB)
+    assert not ledger.reserve('b', 16 * GB)
+    # reserving twice for the same job does not count twice
+    assert ledger.reserve('a', 16 * GB)
+    assert ledger.free == 8 * GB
+
+    assert ledger.release('a') == 16 * GB
+    assert ledger.release('a') == 0
+    assert ledger.free == 24 * GB
+
+
+def test_keep_free_leaves_room_for_the_head():
+    ledger = MemoryLedger(capacity=32 * GB)
+
+    assert not ledger.reserve('a', 8 * GB, keep_free=30 * GB)
+    assert ledger.reserve('a', 8 * GB, keep_free=24 * GB)
+
+
+def test_can_fit_ignores_current_reservations():
+    ledger = MemoryLedger(headroom='8g', capacity=32 * GB)
+    ledger.reserve('a', 20 * GB)
+
+    assert ledger.can_fit(24 * GB)
+    assert not ledger.can_fit(25 * GB)
+
+
+def test_reconcile_replaces_reservations():
+    ledger = MemoryLedger(capacity=32 * GB)
+    ledger.reserve('gone', 30 * GB)
+
+    ledger.reconcile([FakeContainer('a', 4 * GB), FakeContainer('b', 6 * GB)])
+
+    assert ledger.reserved == 10 * GB
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+test_numa.py
+
+Cpu list parsing and the core ledger used for cpu pinning
+"""
+
+from dopq_server.model.utils.numa import CoreLedger, format_cpu_list, parse_cpu_list
+
+
+class FakeContainer(object):
+
+    def __init__(self, job_id, cpuset):
+        self.job_id = job_id
+        self.cpuset = cpuset
+
+
+def two_nodes():
+    return CoreLedger({0: range(0, 8), 1: range(8, 16)})
+
+
+def test_cpu_list_round_trip():
+    assert parse_cpu_list('0-3,8,10-11\n') == [0, 1, 2, 3, 8, 10, 11]
+    assert format_cpu_list([11, 0, 1, 2, 3, 8, 10]) == '0-3,8,10-11'
+
+
+def test_cores_come_from_the_gpu_nodes():
+    ledger = two_nodes()
+
+    cpus, mems = ledger.allocate('a', 4, nodes=[1])
+    assert cpus == [8, 9, 10, 11] and mems == [1]
+
+    # one gpu on each node splits the cores over both nodes
+    cpus, mems = ledger.allocate('b', 4, nodes=[0, 1])
+    assert cpus == [0, 1, 12, 13] and mems == [0, 1]
+
+
+def test_spill_to_other_nodes_and_exhaustion():
+    ledger = two_nodes()
+    ledger.allocate('a', 6, nodes=[0])
+
+    cpus, mems = ledger.allocate('b', 4, nodes=[0])
+    assert cpus == [6, 7, 8, 9] and mems == [0, 1]
+    assert ledger.allocate('c', 7) is None
+    assert ledger.free_cores() == {0: 0, 1: 6}
+
+
+def test_limits_keep_reserved_cores_free():
+    ledger = two_nodes()
+
+    cpus, _ = ledger.allocate('a', 5, nodes=[1], limits={0: 2, 1: 3})
+    assert cpus == [0, 1, 8, 9, 10]
+    assert ledger.allocate('b', 4, limits={0: 1, 1: 2}) is None
+
+
+def test_release_and_reconcile():
+    ledger = two_nodes()
+    ledger.allocate('a', 2)
+
+    assert ledger.release('a') == [0, 1]
+    assert ledger.release('a') == []
+
+    ledger.reconcile([FakeContainer('b', ([3, 4, 99], [0])), FakeContainer('c', None)])
+    assert ledger.held_by('b') == [3, 4]
+    assert ledger.free_cores() == {0: 6, 1: 8}